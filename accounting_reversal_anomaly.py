@@ -1,100 +1,103 @@
-import requests
 import json
-import threading
-import csv
 import sys
-from concurrent.futures import ThreadPoolExecutor
-from utils import setup_proxy, get_headers, disable_ssl_warnings, get_network_config, get_api_config, ensure_output_dir
+from utils import setup_proxy, disable_ssl_warnings, get_api_config, build_lookup_url, show_available_assets, get_asset_file_path, ensure_output_dir, get_http_session, iter_ids, InputItems, log_verbose, get_output_file, get_shard_output_file, open_file
+from lookup_engine import run_lookup_job, process_item
 from constants import DEFAULT_PATHS, DEFAULTS
 
-# ================================================================
-# INITIALIZATION
-# ================================================================
-
-# Setup proxy and disable SSL warnings
-if not setup_proxy():
-    sys.exit(1)
-
-disable_ssl_warnings()
-
 # ================================================================
 # CONFIGURATION
 # ================================================================
 
-# Show available .txt files and let user choose
-from utils import show_available_assets, get_asset_file_path
+# CSV, or Parquet with OUTPUT_FORMAT=parquet; one file per shard with SHARD_COUNT
+OUTPUT_FILE = get_shard_output_file(get_output_file(DEFAULT_PATHS['output_responses']))
 
-print("Accounting Reversal Anomaly Detection")
-print("====================================")
-
-show_available_assets(['.txt'])
-
-input_filename = input("Please enter the input file name (e.g., 'input_transactions.txt'): ").strip()
-
-# Get the full path to the input file
-INPUT_FILE = get_asset_file_path(input_filename) if input_filename else DEFAULT_PATHS['input_transactions']
-OUTPUT_FILE = DEFAULT_PATHS['output_responses']
-
-# Get API configuration and network settings
+# Get API configuration
 API_CONFIG = get_api_config()
-HEADERS = get_headers()
-network_config = get_network_config()
-MAX_WORKERS = network_config['max_workers']
 
 # ================================================================
 # SCRIPT LOGIC
 # ================================================================
 
-# Shared list to store results and a lock for thread-safe updates
-results = []
-lock = threading.Lock()
+def get_transaction_id(args):
+    """
+    Returns the transaction ID of a task tuple (used as its progress journal key).
+    """
+    return args[0]
+
+def build_lookups(args):
+    """
+    Constructs the API URL for a transaction.
+    Each item is a tuple of (transaction_id, base_url, endpoint_suffix, service_choice).
+    """
+    transaction_id, base_url, endpoint_suffix, service_choice = args
+    return [(service_choice, build_lookup_url(API_CONFIG[service_choice], transaction_id))]
 
-def process_transaction(args):
+def build_result_row(args, responses):
     """
-    Constructs the API URL, makes a GET request, and records the response.
-    This function now accepts a tuple of arguments.
+    Records the response for a transaction as an output row.
     """
     transaction_id, base_url, endpoint_suffix, service_choice = args
-    url = f"{base_url}/{transaction_id}{endpoint_suffix}"
+    response = responses[service_choice]
 
     status_code = "Error"
     response_output = DEFAULTS['no_response']
 
-    try:
-        response = requests.get(url, headers=HEADERS, verify=False, timeout=network_config['timeout'])
+    if response.error:
+        response_output = DEFAULTS['no_response']
+        # Optional: Print the error for debugging
+        # print(f"Error for {transaction_id}: {response.detail}")
+    else:
         status_code = response.status_code
 
         if response.status_code == 200:
             if service_choice == 'hermes':
                 try:
-                    # For Hermes, parse the JSON and extract the reconciliation state
-                    data = response.json()
-                    response_output = data.get('data', {}).get('reconciliationState', DEFAULTS['reconciliation_state_not_found'])
+                    # For Hermes, extract the reconciliation state
+                    response_output = response.field('data.reconciliationState', DEFAULTS['reconciliation_state_not_found'])
                 except json.JSONDecodeError:
                     response_output = DEFAULTS['json_decode_error']
             else:
-                # For 'ro', keep the full response body
-                response_output = json.dumps(response.json())
+                # For 'ro', keep the full response body exactly as received
+                response_output = response.text
         else:
             # For non-200 responses, record the status code and text
             response_output = f"Body: {response.text}"
 
-    except (requests.exceptions.RequestException, Exception) as e:
-        response_output = DEFAULTS['no_response']
-        # Optional: Print the error for debugging
-        # print(f"Error for {transaction_id}: {e}")
-
-    # Use a lock to safely append the result to the shared list
-    with lock:
-        results.append([transaction_id, status_code, response_output])
+    log_verbose(f"Processed: {transaction_id}")
+    log_verbose(build_lookup_url(API_CONFIG[service_choice], transaction_id))
+    return [transaction_id, status_code, response_output]
 
-    print(f"Processed: {transaction_id}")
-    print(url)
+def process_transaction(args):
+    """
+    Looks up a single transaction and returns its output row.
+    This function accepts a tuple of arguments.
+    """
+    return process_item(args, build_lookups, build_result_row)
 
 def main():
     """
     Main function to handle user input, read transactions, and process them.
     """
+    # Setup proxy and disable SSL warnings
+    if not setup_proxy():
+        sys.exit(1)
+
+    disable_ssl_warnings()
+
+    # Show available .txt files and let user choose
+    print("Accounting Reversal Anomaly Detection")
+    print("====================================")
+
+    show_available_assets(['.txt'])
+
+    input_filename = input("Please enter the input file name (e.g., 'input_transactions.txt'): ").strip()
+
+    # Get the full path to the input file
+    input_file = get_asset_file_path(input_filename) if input_filename else DEFAULT_PATHS['input_transactions']
+
+    # Create the shared pooled HTTP session up front (fails fast if the token is missing)
+    get_http_session()
+
     # Prompt the user for the service choice
     while True:
         service_choice = input("Please enter Service (hermes or ro): ").lower().strip()
@@ -108,38 +111,39 @@ def main():
     base_url = API_CONFIG[service_choice]["base_url"]
     endpoint_suffix = API_CONFIG[service_choice]["endpoint_suffix"]
 
+    # .gz and .zst inputs are decompressed on the fly
     try:
-        with open(INPUT_FILE, 'r') as f:
-            transactions = [line.strip() for line in f if line.strip()]
+        f = open_file(input_file)
     except FileNotFoundError:
-        print(f"Error: The file '{INPUT_FILE}' was not found.")
+        print(f"Error: The file '{input_file}' was not found.")
         return
 
-    if not transactions:
-        print(f"The file '{INPUT_FILE}' is empty. No transactions to process.")
-        return
-
-    print(f"Starting to process {len(transactions)} transactions using the '{service_choice}' service...")
-
-    # Create a list of tuples for the executor, passing the service_choice to each task
-    tasks = [(txn_id, base_url, endpoint_suffix, service_choice) for txn_id in transactions]
+    # Ensure output directory exists
+    ensure_output_dir()
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        executor.map(process_transaction, tasks)
+    print(f"Starting to process transactions from '{input_file}' using the '{service_choice}' service...")
 
-    print("\nAll transactions processed. Writing results to file.")
+    # Use a more descriptive header for the third column based on the service
+    header = ["transactionId", "statusCode", "reconciliationState" if service_choice == 'hermes' else "responseBody"]
 
-    # Ensure output directory exists
-    ensure_output_dir()
+    with f:
+        # Lazily build a tuple per transaction, passing the service_choice to each task
+        tasks = InputItems(f, lambda lines: ((txn_id, base_url, endpoint_suffix, service_choice)
+                                             for txn_id in iter_ids(lines)))
+        summary = run_lookup_job(tasks, build_lookups, build_result_row, OUTPUT_FILE, header,
+                                 item_key=get_transaction_id,
+                                 run_name=f"accounting_reversal_anomaly:{service_choice}:{input_file}",
+                                 column_types={"statusCode": "int64"})
 
-    # Write the final results to a CSV file
-    with open(OUTPUT_FILE, 'w', newline='') as f:
-        writer = csv.writer(f)
-        # Use a more descriptive header for the third column based on the service
-        header = ["transactionId", "statusCode", "reconciliationState" if service_choice == 'hermes' else "responseBody"]
-        writer.writerow(header)
-        writer.writerows(results)
+    if not summary.processed and not summary.restored:
+        print(f"The file '{input_file}' is empty. No transactions to process.")
+        return
 
+    print("\nAll transactions processed.")
+    if summary.restored:
+        print(f"{summary.restored} results were restored from the previous run.")
+    if summary.failed:
+        print(f"{summary.failed} lookups failed and will be retried on the next run.")
     print(f"Results successfully written to '{OUTPUT_FILE}'.")
 
 if __name__ == "__main__":
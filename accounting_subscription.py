@@ -1,128 +1,118 @@
 #Hermes <-> Accounting Subscription Setup Transaction Anomaly Detection Report {date}
 
-import requests
 import json
-import threading
-import csv
 import sys
-from concurrent.futures import ThreadPoolExecutor
-from utils import setup_proxy, get_headers, disable_ssl_warnings, get_network_config, get_api_config, ensure_output_dir
+from utils import setup_proxy, disable_ssl_warnings, get_api_config, build_lookup_url, show_available_assets, get_asset_file_path, ensure_output_dir, get_http_session, InputItems, log_verbose, get_output_file, get_shard_output_file, open_file
+from lookup_engine import run_lookup_job, process_item
 from constants import DEFAULT_PATHS, DEFAULTS
 
-# ================================================================
-# INITIALIZATION
-# ================================================================
-
-# Setup proxy and disable SSL warnings
-if not setup_proxy():
-    sys.exit(1)
-
-disable_ssl_warnings()
-
 # ================================================================
 # CONFIGURATION
 # ================================================================
 
-# Get the input file name from the user (expects a .txt file with one ID per line)
-from utils import show_available_assets, get_asset_file_path
-
-show_available_assets(['.txt'])
-
-input_filename = input("Please enter the input file name (e.g., 'input_transactions.txt'): ").strip()
-
-# Get the full path to the input file
-INPUT_FILE = get_asset_file_path(input_filename)
-
 # File to write the output CSV to
-OUTPUT_FILE = DEFAULT_PATHS['output_responses']
+# CSV, or Parquet with OUTPUT_FORMAT=parquet; one file per shard with SHARD_COUNT
+OUTPUT_FILE = get_shard_output_file(get_output_file(DEFAULT_PATHS['output_responses']))
 
-# Get API configuration and network settings
+# Get API configuration
 API_CONFIG = get_api_config()
-HEADERS = get_headers()
-network_config = get_network_config()
-MAX_WORKERS = network_config['max_workers']
 
 # ================================================================
 # SCRIPT LOGIC
 # ================================================================
 
-# Shared list to store results and a lock for thread-safe updates
-results = []
-lock = threading.Lock()
+def build_lookups(oma_id):
+    """
+    Constructs the API URL for a given OMA ID.
+    """
+    return [("mandate_check", build_lookup_url(API_CONFIG["mandate_check"], oma_id))]
 
-def process_transaction(oma_id):
+def build_result_row(oma_id, responses):
     """
-    Constructs the API URL for a given OMA ID, makes the request,
-    and records the reconciliation state from the response.
+    Records the reconciliation state from the response for a given OMA ID.
     """
-    base_url = API_CONFIG["mandate_check"]["base_url"]
-    endpoint_suffix = API_CONFIG["mandate_check"]["endpoint_suffix"]
-    url = f"{base_url}{oma_id}{endpoint_suffix}"
+    response = responses["mandate_check"]
 
     status_code = "Error"
     response_output = DEFAULTS['no_response']
 
-    try:
-        response = requests.get(url, headers=HEADERS, verify=False, timeout=network_config['timeout'])
+    if response.error:
+        response_output = DEFAULTS['no_response']
+        # print(f"Error for {oma_id}: {response.detail}") # Uncomment for debugging
+    else:
         status_code = response.status_code
 
         if response.status_code == 200:
             try:
-                # Parse the JSON and extract the reconciliation state
-                data = response.json()
-                response_output = data.get('data', {}).get('reconciliationState', DEFAULTS['reconciliation_state_not_found'])
+                # Extract the reconciliation state from the JSON body
+                response_output = response.field('data.reconciliationState', DEFAULTS['reconciliation_state_not_found'])
             except json.JSONDecodeError:
                 response_output = DEFAULTS['json_decode_error']
         else:
             # For non-200 responses, record the error text
             response_output = f"Body: {response.text}"
 
-    except (requests.exceptions.RequestException, Exception) as e:
-        response_output = DEFAULTS['no_response']
-        # print(f"Error for {oma_id}: {e}") # Uncomment for debugging
-
-    # Use a lock to safely append the result to the shared list
-    with lock:
-        results.append([oma_id, status_code, response_output])
+    log_verbose(f"Processed: {oma_id}")
+    return [oma_id, status_code, response_output]
 
-    print(f"Processed: {oma_id}")
+def process_transaction(oma_id):
+    """
+    Looks up a single OMA ID and returns its output row.
+    """
+    return process_item(oma_id, build_lookups, build_result_row)
 
 def main():
     """
     Main function to read OMA IDs from a text file, process them concurrently,
     and write the results to a new file.
     """
-    oma_ids = []
-    try:
-        with open(INPUT_FILE, mode='r', encoding='utf-8') as f:
-            # Read each line from the file, strip whitespace, and add to the list if it's not empty
-            oma_ids = [line.strip() for line in f if line.strip()]
-    except FileNotFoundError:
-        print(f"Error: The input file '{INPUT_FILE}' was not found.")
-        return
+    # Setup proxy and disable SSL warnings
+    if not setup_proxy():
+        sys.exit(1)
 
-    if not oma_ids:
-        print(f"No OMA IDs found in '{INPUT_FILE}'. No transactions to process.")
-        return
+    disable_ssl_warnings()
+
+    # Get the input file name from the user (expects a .txt file with one ID per line)
+    show_available_assets(['.txt'])
 
-    print(f"Starting to process {len(oma_ids)} transactions...")
+    input_filename = input("Please enter the input file name (e.g., 'input_transactions.txt'): ").strip()
 
-    # Use a thread pool to execute all API calls concurrently
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        executor.map(process_transaction, oma_ids)
+    # Get the full path to the input file
+    input_file = get_asset_file_path(input_filename)
 
-    print("\nAll transactions processed. Writing results to file.")
+    # Create the shared pooled HTTP session up front (fails fast if the token is missing)
+    get_http_session()
+
+    # .gz and .zst inputs are decompressed on the fly
+    try:
+        f = open_file(input_file)
+    except FileNotFoundError:
+        print(f"Error: The input file '{input_file}' was not found.")
+        return
 
     # Ensure output directory exists
     ensure_output_dir()
 
-    # Write the final results to a CSV file
-    with open(OUTPUT_FILE, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        header = ["OMA_ID", "StatusCode", "ReconciliationState"]
-        writer.writerow(header)
-        writer.writerows(results)
+    print(f"Starting to process transactions from '{input_file}'...")
+
+    # Stream the non-empty lines of the file into the lookup engine, execute
+    # all API calls concurrently and write each result row as it completes.
+    # An interrupted run resumes from its progress journal.
+    header = ["OMA_ID", "StatusCode", "ReconciliationState"]
+    with f:
+        summary = run_lookup_job(InputItems(f), build_lookups, build_result_row, OUTPUT_FILE, header,
+                                 item_key=str, run_name=f"accounting_subscription:{input_file}",
+                                 column_types={"StatusCode": "int64"})
+
+    if not summary.processed and not summary.restored:
+        print(f"No OMA IDs found in '{input_file}'. No transactions to process.")
+        return
 
+    print("\nAll transactions processed.")
+    if summary.restored:
+        print(f"{summary.restored} results were restored from the previous run.")
+    if summary.failed:
+        print(f"{summary.failed} lookups failed and will be retried on the next run.")
     print(f"Results successfully written to '{OUTPUT_FILE}'.")
 
 if __name__ == "__main__":
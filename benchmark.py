@@ -0,0 +1,298 @@
+"""
+Throughput benchmark for the PhonePe API scripts.
+
+Starts the local mock services (see mock_server.py) and drives each
+script's lookups (its build_lookups / build_result_row through the lookup
+engine) over generated input, then reports requests/sec, p99 latency and
+peak RSS per script. Each script runs in its own process, so its peak RSS
+(the largest of it and its lookup processes) and its connection pools
+and limiters are its own.
+
+Usage:
+    python benchmark.py                                       # every script, baseline profile
+    python benchmark.py --scripts refunds_housekeeping --profiles fast degraded --rows 20000
+    python benchmark.py --engine async --save output/bench_async.json
+    python benchmark.py --processes 4                         # lookups spread over 4 processes
+    python benchmark.py --compare output/bench_async.json     # flag regressions against a saved run
+
+The mock services run in a separate process; for very fast profiles their
+own request handling can still become the limit, so compare runs on the
+same machine and profile.
+"""
+
+import argparse
+import csv
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from mock_server import MOCK_PROFILES
+
+# ================================================================
+# CONFIGURATION
+# ================================================================
+
+# Scripts to benchmark: module, input kind, and the CSV columns or the
+# service choice where the script needs one
+BENCHMARK_SCRIPTS = {
+    "refunds_housekeeping": {"module": "refunds_housekeeping", "input": "ids"},
+    "accounting_subscription": {"module": "accounting_subscription", "input": "ids"},
+    "payment_service_debug": {"module": "payment_service_debug", "input": "ids"},
+    "accounting_reversal_anomaly:hermes": {"module": "accounting_reversal_anomaly", "input": "reversal", "service": "hermes"},
+    "accounting_reversal_anomaly:ro": {"module": "accounting_reversal_anomaly", "input": "reversal", "service": "ro"},
+    "forward_anomaly_v1": {"module": "forward_anomaly_v1", "input": "csv",
+                           "columns": ["Merchant_Id", "Merchant_Transaction_Id", "Payment_Transaction_Id"]},
+    "payments_transactions_v1": {"module": "payments_transactions_v1", "input": "csv",
+                                 "columns": ["Merchant ID", "Merchant Transaction Id", "Payment Id"]},
+}
+
+# Input rows generated per script
+BENCHMARK_ROWS = 5000
+
+# A change counts as a regression beyond this fraction (10%)
+REGRESSION_THRESHOLD = 0.10
+
+# ================================================================
+# SCRIPT RUN (child process)
+# ================================================================
+
+def write_input(path, spec, rows):
+    """
+    Write a generated input file of unique IDs for a script.
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        if spec['input'] == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(spec['columns'])
+            for n in range(rows):
+                writer.writerow([f"M{n % 97:04d}", f"MT{n:09d}", f"P{n:09d}"])
+        else:
+            for n in range(rows):
+                f.write(f"BENCH{n:09d}\n")
+
+def peak_rss_mb():
+    """
+    Peak resident set size in MB of this process or of its largest finished
+    child, such as a lookup process with --processes (None where unsupported).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports KB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def run_script(name, rows, work_dir):
+    """
+    Run one script's lookups over generated input and return its measurements.
+    Expects the environment to point at the mock services.
+    """
+    from utils import InputItems, iter_ids, get_output_file
+    from lookup_engine import run_lookup_job
+
+    spec = BENCHMARK_SCRIPTS[name]
+    module = importlib.import_module(spec['module'])
+    input_file = os.path.join(work_dir, 'input.csv' if spec['input'] == 'csv' else 'input.txt')
+    output_file = get_output_file(os.path.join(work_dir, 'output.csv'))
+    write_input(input_file, spec, rows)
+
+    with open(input_file, 'r', encoding='utf-8') as f:
+        if spec['input'] == 'csv':
+            items = InputItems(f, csv.DictReader)
+            item_key = module.get_row_key
+        elif spec['input'] == 'reversal':
+            api_config = module.API_CONFIG[spec['service']]
+            items = InputItems(f, lambda lines: ((txn_id, api_config['base_url'], api_config['endpoint_suffix'], spec['service'])
+                                                 for txn_id in iter_ids(lines)))
+            item_key = module.get_transaction_id
+        else:
+            items = InputItems(f)
+            item_key = str
+
+        start = time.monotonic()
+        summary = run_lookup_job(items, module.build_lookups, module.build_result_row, output_file,
+                                 ["id", "status_code", "result", "extra"], item_key=item_key,
+                                 run_name=f"benchmark:{name}")
+        elapsed = time.monotonic() - start
+
+    with open(os.environ['METRICS_FILE'], 'r', encoding='utf-8') as f:
+        metrics = json.load(f)
+    services = metrics['services'].values()
+    errors = sum(count for service in services for status, count in service['statuses'].items()
+                 if not status.isdigit() or int(status) >= 400)
+
+    return {
+        'rows': summary.processed,
+        'failed': summary.failed,
+        'seconds': round(elapsed, 2),
+        'requests': metrics['requests'],
+        'requests_per_second': round(metrics['requests'] / elapsed, 1) if elapsed else 0.0,
+        'p99_ms': max((service['latency_ms']['p99'] for service in services), default=0.0),
+        'errors': errors,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+# ================================================================
+# BENCHMARK (parent process)
+# ================================================================
+
+@contextmanager
+def mock_services(profile):
+    """
+    Run the mock services with a profile in a separate process.
+
+    Yields:
+        Environment variables pointing the scripts at the mock
+    """
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py'), '--profile', profile],
+        stdout=subprocess.PIPE, text=True
+    )
+    try:
+        env = {}
+        for line in process.stdout:
+            if line.startswith('export '):
+                name, value = line[len('export '):].strip().split('=', 1)
+                env[name] = value
+            elif line.startswith('Press Ctrl+C'):
+                break
+        if process.poll() is not None:
+            raise RuntimeError(f"The mock services failed to start (exit code {process.returncode}).")
+        yield env
+    finally:
+        process.terminate()
+        process.wait()
+
+def run_scenario(name, profile, engine, rows, mock_env, processes=1):
+    """
+    Run one script in a fresh process against the running mock.
+
+    Returns:
+        Dict of measurements, or None if the run failed
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        env = dict(os.environ, **mock_env)
+        env.update({
+            'AUTHORIZATION_TOKEN': os.getenv('AUTHORIZATION_TOKEN') or 'benchmark',
+            'LOOKUP_ENGINE': engine,
+            'LOOKUP_PROCESSES': str(processes),
+            'SHARD_COUNT': '1',
+            'RESPONSE_CACHE': '0',
+            'RESUME': '0',
+            'VERBOSE': '0',
+            'PROGRESS_INTERVAL': '0',
+            'METRICS_FILE': os.path.join(work_dir, 'metrics.json')
+        })
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run', name, '--rows', str(rows), '--work-dir', work_dir],
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+        )
+    if process.returncode != 0:
+        print(f"Error: {name} ({profile}) failed:\n{process.stderr.strip()}")
+        return None
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    if result['requests'] and result['errors'] == result['requests']:
+        # Every request failed (e.g. a URL the mock has no route for): not a throughput measurement
+        print(f"Error: {name} ({profile}) got an error response for all {result['requests']} requests.")
+        return None
+    result.update({'script': name, 'profile': profile, 'engine': engine, 'processes': processes})
+    return result
+
+def compare_results(results, previous):
+    """
+    Print the change of every scenario against a saved run and flag regressions.
+
+    Returns:
+        Number of regressions
+    """
+    previous = {(r['script'], r['profile'], r['engine']): r for r in previous}
+    regressions = 0
+    print("\nComparison with the saved run:")
+    for result in results:
+        old = previous.get((result['script'], result['profile'], result['engine']))
+        if old is None:
+            continue
+        changes = []
+        for key, label, higher_is_better in (('requests_per_second', 'req/s', True),
+                                             ('p99_ms', 'p99', False),
+                                             ('peak_rss_mb', 'RSS', False)):
+            if not old.get(key) or result.get(key) is None:
+                continue
+            change = (result[key] - old[key]) / old[key]
+            regressed = -change > REGRESSION_THRESHOLD if higher_is_better else change > REGRESSION_THRESHOLD
+            regressions += regressed
+            changes.append(f"{label} {change:+.0%}{' REGRESSION' if regressed else ''}")
+        print(f"  {result['script']:<36} {result['profile']:<9} {', '.join(changes)}")
+    return regressions
+
+def print_results(results):
+    print(f"\n{'script':<36} {'profile':<9} {'engine':<7} {'rows':>7} {'req/s':>9} "
+          f"{'p99 ms':>8} {'errors':>7} {'failed':>7} {'RSS MB':>7}")
+    for r in results:
+        print(f"{r['script']:<36} {r['profile']:<9} {r['engine']:<7} {r['rows']:>7} {r['requests_per_second']:>9,.0f} "
+              f"{r['p99_ms']:>8.1f} {r['errors']:>7} {r['failed']:>7} {r['peak_rss_mb'] or 0:>7.1f}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the PhonePe API scripts against local mock services.")
+    parser.add_argument('--scripts', nargs='+', choices=list(BENCHMARK_SCRIPTS), default=list(BENCHMARK_SCRIPTS),
+                        help="Scripts to benchmark (default: all)")
+    parser.add_argument('--profiles', nargs='+', choices=list(MOCK_PROFILES), default=['baseline'],
+                        help="Mock latency/error profiles (default: baseline)")
+    parser.add_argument('--engine', choices=['thread', 'async'], default=os.getenv('LOOKUP_ENGINE', 'thread'),
+                        help="Lookup engine to benchmark")
+    parser.add_argument('--processes', type=int, default=int(os.getenv('LOOKUP_PROCESSES', 1)),
+                        help="Worker processes running the lookups (LOOKUP_PROCESSES)")
+    parser.add_argument('--rows', type=int, default=BENCHMARK_ROWS, help="Input rows per script")
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Compare with results saved by an earlier --save")
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    """
+    Main function to run every selected script against every selected profile and report the results.
+    """
+    args = parse_args()
+
+    if args.run:
+        # Child process: run one script and report its measurements as the last output line
+        print(json.dumps(run_script(args.run, args.rows, args.work_dir)))
+        return 0
+
+    results = []
+    for profile in args.profiles:
+        with mock_services(profile) as mock_env:
+            for name in args.scripts:
+                print(f"Benchmarking {name} ({profile} profile, {args.engine} engine, "
+                      f"{args.processes} process(es), {args.rows} rows)...")
+                result = run_scenario(name, profile, args.engine, args.rows, mock_env, args.processes)
+                if result:
+                    results.append(result)
+
+    print_results(results)
+
+    if args.save:
+        directory = os.path.dirname(args.save)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to '{args.save}'.")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare_results(results, json.load(f))
+        if regressions:
+            print(f"{regressions} regression(s) beyond {REGRESSION_THRESHOLD:.0%}.")
+            return 1
+    return 0 if len(results) == len(args.scripts) * len(args.profiles) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
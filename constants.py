@@ -57,13 +57,235 @@ QUERY_PARAMS = {
 NETWORK_CONFIG = {
     "max_workers": 80,
     "request_timeout": 15,
+    # Lookup engine: "thread" (ThreadPoolExecutor) or "async" (asyncio + aiohttp)
+    "engine": "thread",
+    # Worker processes running the lookups, each with its own engine and connection pools
+    "processes": 1,
+    # Maximum requests in flight when running with the async engine
+    "async_concurrency": 1000,
+    # Input items buffered between the file reader and the workers
+    "input_queue_size": 10000,
+    # Look up each distinct ID once and write its result for every input line that repeats it
+    "dedupe_input": True,
+    "connection_pool": {
+        # Number of per-host pools kept open (one per service in API_BASE_URLS is enough)
+        "max_hosts": 10,
+        # Block instead of opening throwaway connections once a host pool is exhausted
+        "block": True
+    },
     "proxy": {
+        # Set to False to connect directly (e.g. to the local mock server of benchmark.py)
+        "enabled": True,
         "type": "SOCKS5",
         "host": "localhost",
-        "port": 1080
+        "port": 1080,
+        # Several SOCKS endpoints ("host:port") to spread connections over; empty: just host:port above
+        "endpoints": [],
+        # Consecutive failed connections after which an endpoint is evicted
+        "max_failures": 5,
+        # Seconds an evicted endpoint is left alone before a health check may bring it back
+        "eviction_time": 30,
+        # Seconds between health checks (a SOCKS5 handshake) of every endpoint
+        "health_check_interval": 10,
+        # Seconds a health check may take to connect and get the handshake answer
+        "health_check_timeout": 3
+    }
+}
+
+# ================================================================
+# RATE LIMITS
+# ================================================================
+
+# Token-bucket limits shared by every worker in the process. "rate" is
+# requests per second (None = unlimited), "burst" the number of requests
+# that may go out at once after an idle period. Override per service with
+# RATE_LIMIT_<SERVICE>=rate[:burst], e.g. RATE_LIMIT_HERMES=500:100
+RATE_LIMITS = {
+    "services": {
+        "hermes": {"rate": None, "burst": 100},
+        "refund_orchestrator": {"rate": None, "burst": 50},
+        "payment_service": {"rate": None, "burst": 50},
+        "payment_gateway": {"rate": None, "burst": 50}
+    },
+    # Optional extra limits per endpoint, keyed by get_api_config() name,
+    # applied on top of the service limit, e.g. "payments_debug": {"rate": 100, "burst": 20}
+    "endpoints": {}
+}
+
+# ================================================================
+# ADAPTIVE CONCURRENCY
+# ================================================================
+
+CONCURRENCY_CONFIG = {
+    # Adapt the number of in-flight requests per service to its latency and error rate
+    "adaptive": True,
+    # Bounds and starting point for the in-flight limit of each service
+    "floor": 4,
+    "ceiling": 512,
+    "initial": 80,
+    # Multiplicative decrease on timeouts, connection errors, 429 and 5xx
+    "backoff_ratio": 0.7,
+    # Latency above this multiple of the best observed latency counts as congestion
+    "latency_tolerance": 2.0,
+    # Per-service overrides of the values above, keyed by API_BASE_URLS service name
+    "services": {
+        "payment_service": {"ceiling": 256}
     }
 }
 
+# ================================================================
+# CIRCUIT BREAKER
+# ================================================================
+
+CIRCUIT_BREAKER_CONFIG = {
+    # Stop sending requests to a service while most of its recent requests fail
+    "enabled": True,
+    # Recent requests per service the failure rate is measured over
+    "window": 50,
+    # Requests needed in the window before the circuit may open
+    "min_requests": 20,
+    # Share of timeouts, connection errors and 5xx in the window that opens the circuit (429 does not count)
+    "failure_ratio": 0.5,
+    # Seconds the circuit stays open before probe requests are sent; doubled
+    # after every failed probe, up to max_open_time
+    "open_time": 15.0,
+    "max_open_time": 300.0,
+    # Probe requests allowed while half-open; the circuit closes once they all succeed
+    "probes": 3,
+    # Seconds a circuit may stay open before its waiting lookups are written as
+    # failed (retried by the next run) instead of waiting longer
+    "give_up_after": 1800.0,
+    # Per-service overrides of the values above, keyed by API_BASE_URLS service name
+    "services": {}
+}
+
+# ================================================================
+# RETRY CONFIGURATION
+# ================================================================
+
+RETRY_CONFIG = {
+    # Total attempts per lookup, including the first one
+    "max_attempts": 4,
+    # Backoff before retry n is a random delay in [0, min(max_delay, base_delay * 2^n)]
+    "base_delay": 0.5,
+    "max_delay": 30.0
+}
+
+# ================================================================
+# OUTPUT CONFIGURATION
+# ================================================================
+
+OUTPUT_CONFIG = {
+    # Rows written per batch by the result writer
+    "batch_size": 1000,
+    # Maximum seconds a result row waits before being flushed to disk
+    "flush_interval": 2.0,
+    # fsync policy: "batch" (after every batch), "close" (end of run) or "never"
+    "fsync": "batch",
+    # Result rows buffered between the workers and the writer thread
+    "queue_size": 10000,
+    # Resume an interrupted run from its progress journal (output file + ".journal")
+    "resume": True,
+    # Output format of the lookup scripts, filter_mids.py and split_large_files.py: "csv" or "parquet"
+    "format": "csv",
+    # Compression of CSV outputs: "none", "gzip" (.csv.gz) or "zstd" (.csv.zst, needs zstandard)
+    "compression": "none",
+    # Parquet compression codec ("zstd", "snappy", "gzip" or "none")
+    "parquet_compression": "zstd",
+    # Rows per Parquet row group; a group is written as soon as it is full
+    "parquet_row_group_rows": 100000,
+    # Type the columns of filtered/split CSVs from a sample of the file (False: every column is text)
+    "parquet_infer_types": True
+}
+
+# ================================================================
+# SHARDING (splitting one input across several hosts)
+# ================================================================
+
+SHARD_CONFIG = {
+    # This host's shard (0 to count - 1); each host looks up the IDs whose stable hash falls in its shard
+    "index": 0,
+    # Number of shards the input is split into (1: no sharding)
+    "count": 1
+}
+
+# ================================================================
+# RESPONSE PARSING
+# ================================================================
+
+PARSING_CONFIG = {
+    # JSON decoder: "auto" (orjson when installed, else the standard library), "orjson" or "json"
+    "json_backend": "auto"
+}
+
+# ================================================================
+# RESPONSE CACHE
+# ================================================================
+
+CACHE_CONFIG = {
+    # Serve repeat lookups of the same URL from a local SQLite cache. Off by
+    # default: the scripts are meant to show the services' current state
+    "enabled": False,
+    "path": "output/response_cache.sqlite3",
+    # With the cache on, output column telling where a row's responses came
+    # from: "cache", "live" or "mixed"
+    "source_column": "response_source",
+    # Seconds a 200 response stays valid while its state can still change
+    "ttl": 300,
+    # Seconds a 200 response stays valid once it reports a terminal state
+    "terminal_ttl": 30 * 24 * 3600,
+    # Oldest entries are evicted beyond this many cached responses
+    "max_entries": 2000000,
+    # Response fields holding the state, as dotted paths from the top of the JSON body
+    # ("state" is the top-level field only, never a "state" nested in another object)
+    "state_fields": ["data.reconciliationState", "state"]
+}
+
+# States that never change once reached; responses reporting them use terminal_ttl
+TERMINAL_STATES = {"RECONCILED", "COMPLETED"}
+
+# ================================================================
+# RUN METRICS
+# ================================================================
+
+METRICS_CONFIG = {
+    # Seconds between progress lines (0 disables them)
+    "progress_interval": 10.0,
+    # Latency histograms and status counts of the run, written when it ends
+    "path": "output/lookup_metrics.json",
+    # Print a line for every processed ID
+    "verbose": False
+}
+
+# ================================================================
+# FILE PROCESSING
+# ================================================================
+
+FILE_PROCESSING_CONFIG = {
+    # CSV column filter_mids.py matches merchant IDs against
+    "filter_column": "eventdata_merchantid",
+    # Merchant IDs filter_mids.py keeps when none are given
+    "default_mids": ["VIRALOONLINE"],
+    # Parser for the filter column: "auto" (pyarrow when installed), "pyarrow" or "pandas"
+    "engine": "auto",
+    # Worker processes scanning byte ranges of the file in parallel (None: one per CPU core)
+    "workers": None,
+    # Size of the byte range each worker scans at a time, in MB
+    "range_size_mb": 64,
+    # Rows per part written by split_large_files.py
+    "rows_per_part": 500000,
+    # Shards written by split_large_files.py when partitioning by a key column
+    "shard_count": 16
+}
+
+# Compressed inputs and outputs, recognised by file extension: codec and the
+# level used when writing (gzip level 1 compresses about 3x faster than the
+# default 6 for files a few percent larger)
+COMPRESSION_CODECS = {
+    ".gz": {"codec": "gzip", "level": 1},
+    ".zst": {"codec": "zstd", "level": 3}
+}
+
 # ================================================================
 # FILE PATHS
 # ================================================================
@@ -0,0 +1,306 @@
+"""
+Sidecar index for large asset CSVs.
+
+A one-time pass maps every value of a key column (such as
+eventdata_merchantid) to the byte offsets of its rows, and stores that
+next to the file ('assets/<file>.index/'). filter_mids.py then seeks
+straight to the matching rows, so a repeat query costs time in proportion
+to the rows it returns rather than to the size of the file.
+
+The index records the size and modification time of the CSV; once the CSV
+changes, the index no longer matches and is discarded.
+
+Usage:
+    python csv_index.py     # pick a CSV from assets/ and the columns to index
+"""
+
+import json
+import os
+import re
+import sys
+import time
+import numpy as np
+from utils import (show_available_assets, get_asset_file_path, get_file_processing_config, read_line_range,
+                   get_compression)
+from csv_ranges import (resolve_engine, read_csv_header, parser_header, get_chunks, chunk_size, column_values,
+                        worker_settings, scan_ranges, progress_line)
+
+# ================================================================
+# CONFIGURATION
+# ================================================================
+
+# Column, parser engine, workers and range size for the indexing pass
+FILE_CONFIG = get_file_processing_config()
+
+# Version of the index layout; indexes of another version are rebuilt
+INDEX_VERSION = 1
+
+# Matching rows read per batch when answering a query from the index
+READ_BATCH_ROWS = 50000
+
+# ================================================================
+# SCRIPT LOGIC
+# ================================================================
+
+def get_index_dir(source_file):
+    """
+    Directory holding the indexes of a CSV ('assets/events.csv' -> 'assets/events.csv.index').
+    """
+    return f"{source_file}.index"
+
+def _index_files(source_file, column):
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', column.strip())
+    prefix = os.path.join(get_index_dir(source_file), name)
+    return {part: f"{prefix}.{part}" for part in ('json', 'keys.npy', 'starts.npy', 'rows.npy')}
+
+def _source_state(source_file):
+    stat = os.stat(source_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _encode(values, engine):
+    """
+    Dictionary-encode column values.
+
+    Returns:
+        (distinct values, code of every value as an int32 array)
+    """
+    if engine == 'pyarrow':
+        encoded = values.combine_chunks().dictionary_encode()
+        return encoded.dictionary.to_pylist(), encoded.indices.to_numpy(zero_copy_only=False).astype(np.int32)
+    import pandas as pd
+    codes, distinct = pd.factorize(values)
+    return list(distinct), codes.astype(np.int32)
+
+def index_range(byte_range):
+    """
+    Find the key of every row in one byte range and where the row starts (runs in a worker process).
+
+    Returns:
+        (bytes scanned, distinct keys, key code per row, byte offset per row)
+    """
+    settings = worker_settings()
+    with open(settings['source_file'], 'rb') as f:
+        block = read_line_range(f, *byte_range, settings['data_start'])
+        position = f.tell() - len(block)
+    range_bytes = chunk_size(byte_range)
+    if not block:
+        return range_bytes, [], np.empty(0, np.int32), np.empty(0, np.uint64)
+
+    # Start of every non-blank line (the rows the parsers return)
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(data == ord('\n'))
+    if not block.endswith(b'\n'):
+        ends = np.append(ends, len(block))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts
+    blank = (lengths == 0) | ((lengths == 1) & (data[np.minimum(starts, len(data) - 1)] == ord('\r')))
+    starts = starts[~blank]
+
+    values = column_values(settings['header'] + block, settings['column'], settings['engine'])
+    if len(values) != len(starts):
+        raise ValueError(f"Rows and lines do not line up near byte {byte_range[0]}; "
+                         f"line breaks inside quoted values are not supported.")
+    distinct, codes = _encode(values, settings['engine'])
+    return range_bytes, distinct, codes, starts.astype(np.uint64) + position
+
+def build_index(source_file, column, config):
+    """
+    Index source_file by a key column in one parallel pass (see csv_ranges)
+    and write the index next to it.
+
+    Layout, per column, in the index directory:
+        <column>.keys.npy    sorted distinct keys (UTF-8 bytes)
+        <column>.starts.npy  where each key's rows begin in rows.npy
+        <column>.rows.npy    row byte offsets, grouped by key, in file order
+        <column>.json        the CSV's size and mtime when it was indexed
+
+    Returns:
+        (rows indexed, distinct keys)
+    """
+    if get_compression(source_file):
+        raise ValueError("Compressed files cannot be indexed: rows are read back by byte offset. "
+                         "Index the uncompressed CSV instead.")
+    header, raw_column, columns = read_csv_header(source_file, column)
+    if raw_column is None:
+        raise KeyError(f"Column '{column}' not found! Available columns: {columns}")
+
+    state = _source_state(source_file)
+    settings = {
+        'source_file': source_file,
+        'data_start': len(header),
+        'header': parser_header(header),
+        'column': raw_column,
+        'engine': resolve_engine(config['engine'])
+    }
+    chunks, total_bytes = get_chunks(source_file, len(header), config['range_size'])
+    print(f"Indexing '{raw_column}' of {total_bytes / 1024 / 1024:,.0f} MB with "
+          f"{config['workers']} {settings['engine']} worker(s)...")
+
+    key_ids = {}
+    all_codes = []
+    all_offsets = []
+    scanned = 0
+    for range_bytes, distinct, codes, offsets in scan_ranges(index_range, chunks, settings, config['workers']):
+        if len(codes):
+            mapping = np.array([key_ids.setdefault(key, len(key_ids)) for key in distinct], dtype=np.int32)
+            all_codes.append(mapping[codes])
+            all_offsets.append(offsets)
+        scanned += range_bytes
+        print(progress_line("Indexed", scanned, total_bytes))
+
+    if _source_state(source_file) != state:
+        raise ValueError(f"'{source_file}' changed while it was being indexed. Run the indexing again.")
+
+    # Keys are stored sorted, so a lookup is a binary search
+    keys = sorted(key_ids, key=lambda key: key.encode('utf-8'))
+    if any(key.endswith('\0') for key in keys):
+        raise ValueError(f"Values of '{raw_column}' ending in a NUL byte cannot be indexed.")
+    rank = np.empty(len(keys), dtype=np.int32)
+    rank[[key_ids[key] for key in keys]] = np.arange(len(keys), dtype=np.int32)
+    codes = rank[np.concatenate(all_codes)] if all_codes else np.empty(0, np.int32)
+    offsets = np.concatenate(all_offsets) if all_offsets else np.empty(0, np.uint64)
+    # Stable sort keeps every key's rows in file order
+    rows = offsets[np.argsort(codes, kind='stable')]
+    starts = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(keys))))).astype(np.uint64)
+
+    files = _index_files(source_file, raw_column)
+    os.makedirs(get_index_dir(source_file), exist_ok=True)
+    # Drop the metadata of an older index first, so its arrays are never read with the new ones
+    if os.path.exists(files['json']):
+        os.remove(files['json'])
+    encoded_keys = [key.encode('utf-8') for key in keys]
+    arrays = {
+        'keys.npy': np.array(encoded_keys, dtype=f"S{max(map(len, encoded_keys), default=0) or 1}"),
+        'starts.npy': starts,
+        'rows.npy': rows
+    }
+    for part, array in arrays.items():
+        # Write to a temporary name first, so an interrupted build never leaves a half-written index
+        with open(f"{files[part]}.tmp", 'wb') as f:
+            np.save(f, array)
+        os.replace(f"{files[part]}.tmp", files[part])
+    # The metadata goes last: an index without it is incomplete and ignored
+    with open(f"{files['json']}.tmp", 'w', encoding='utf-8') as f:
+        json.dump({'version': INDEX_VERSION, 'column': raw_column, 'rows': len(rows), 'keys': len(keys), **state}, f)
+    os.replace(f"{files['json']}.tmp", files['json'])
+    return len(rows), len(keys)
+
+class CsvIndex:
+    """
+    The index of one key column of a CSV, memory-mapped so a lookup only
+    reads the offsets of the keys asked for.
+
+    Usage:
+        index = load_index(source_file, column)
+        if index:
+            offsets, keys = index.lookup(['MID1', 'MID2'])
+            for lines, line_keys in index.read_rows(offsets, keys):
+                ...
+    """
+
+    def __init__(self, source_file, files, meta):
+        self.source_file = source_file
+        self.meta = meta
+        self.keys = np.load(files['keys.npy'], mmap_mode='r')
+        self.starts = np.load(files['starts.npy'], mmap_mode='r')
+        self.rows = np.load(files['rows.npy'], mmap_mode='r')
+
+    def lookup(self, values):
+        """
+        Byte offsets of the rows whose key is one of values.
+
+        Returns:
+            (offsets in file order, key of every offset)
+        """
+        found = []
+        parts = []
+        owners = []
+        for value in values:
+            encoded = value.encode('utf-8')
+            position = int(np.searchsorted(self.keys, encoded))
+            if position < len(self.keys) and self.keys[position] == encoded:
+                start, end = int(self.starts[position]), int(self.starts[position + 1])
+                parts.append(np.asarray(self.rows[start:end]))
+                owners.append(np.full(end - start, len(found), dtype=np.int32))
+                found.append(value)
+        if not parts:
+            return np.empty(0, np.uint64), []
+        offsets = np.concatenate(parts)
+        order = np.argsort(offsets, kind='stable')
+        return offsets[order], [found[owner] for owner in np.concatenate(owners)[order]]
+
+    def read_rows(self, offsets, keys, batch_rows=READ_BATCH_ROWS):
+        """
+        Lazily read the rows at offsets (from lookup) by seeking to each.
+
+        Yields:
+            (lines without line breaks, key of every line), batch_rows lines at a time
+        """
+        with open(self.source_file, 'rb') as f:
+            for batch_start in range(0, len(offsets), batch_rows):
+                lines = []
+                for offset in offsets[batch_start:batch_start + batch_rows]:
+                    f.seek(int(offset))
+                    lines.append(f.readline().rstrip(b'\n'))
+                yield lines, keys[batch_start:batch_start + len(lines)]
+
+def load_index(source_file, column):
+    """
+    Open the index of a column of source_file.
+
+    Returns:
+        CsvIndex, or None if the column is not indexed. An index built before
+        the CSV last changed (different size or mtime) is deleted.
+    """
+    if get_compression(source_file):
+        return None
+    files = _index_files(source_file, column)
+    try:
+        with open(files['json'], 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('version') != INDEX_VERSION or {key: meta.get(key) for key in ('size', 'mtime_ns')} != _source_state(source_file):
+        print(f"The index of '{column}' for '{source_file}' is out of date and was removed; "
+              f"run csv_index.py to rebuild it.")
+        for path in files.values():
+            if os.path.exists(path):
+                os.remove(path)
+        return None
+    return CsvIndex(source_file, files, meta)
+
+def main():
+    """
+    Main function to select a CSV and the key columns to index.
+    """
+    print("CSV Indexer")
+    print("===========")
+
+    available_files = show_available_assets(['.csv'])
+    if not available_files:
+        print("No CSV files found in assets directory!")
+        sys.exit(1)
+
+    file_name = input("Enter the name of the CSV file to index: ").strip()
+    source_file = get_asset_file_path(file_name)
+    if not os.path.isfile(source_file):
+        print(f"Error: The file '{source_file}' was not found.")
+        sys.exit(1)
+
+    columns = input(f"Enter the columns to index, comma-separated (default: {FILE_CONFIG['filter_column']}): ").strip()
+    columns = [column.strip() for column in columns.split(',') if column.strip()] or [FILE_CONFIG['filter_column']]
+
+    for column in columns:
+        start_time = time.time()
+        try:
+            rows, keys = build_index(source_file, column, FILE_CONFIG)
+        except (KeyError, ValueError, ImportError) as e:
+            print(f"Error: {e.args[0] if e.args else e}")
+            sys.exit(1)
+        print(f"Indexed {rows:,} rows with {keys:,} distinct values of '{column}' "
+              f"in {time.time() - start_time:.2f} seconds.")
+    print(f"Index written to '{get_index_dir(source_file)}'.")
+
+if __name__ == "__main__":
+    main()
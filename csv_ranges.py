@@ -0,0 +1,178 @@
+"""
+Parallel scanning of large CSV files by byte range.
+Shared by filter_mids.py and split_large_files.py: the file is cut into line-aligned byte ranges that worker processes parse column-wise.
+Compressed files (.gz, .zst) cannot be read by range, so they are decompressed as a stream and their blocks of lines are handed to the workers instead.
+"""
+
+import codecs
+import csv
+import importlib.util
+import io
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from utils import get_byte_ranges, read_line_range, open_file, get_compression, iter_line_blocks
+
+# Settings shared with the worker processes, set once per worker by _init_worker
+_worker_settings = None
+
+def resolve_engine(engine):
+    """
+    Pick the column parser: pyarrow when available (or requested), pandas otherwise.
+    """
+    if engine not in ('auto', 'pyarrow', 'pandas'):
+        raise ValueError(f"Unknown engine '{engine}'. Use 'auto', 'pyarrow' or 'pandas'.")
+    if engine == 'pandas':
+        return 'pandas'
+    if importlib.util.find_spec('pyarrow') is not None:
+        return 'pyarrow'
+    if engine == 'pyarrow':
+        raise ImportError("FILE_ENGINE=pyarrow needs pyarrow. Install it with: pip install pyarrow")
+    return 'pandas'
+
+def read_csv_header(source_file, column=None):
+    """
+    Read the header line of a CSV and find a column (ignoring surrounding whitespace).
+
+    Returns:
+        (header line as bytes, exact name of the column or None, list of stripped column names)
+    """
+    with open_file(source_file, 'rb') as f:
+        header = f.readline()
+    if not header.endswith(b'\n'):
+        header += b'\n'
+    columns = next(csv.reader([header.decode('utf-8-sig').rstrip('\r\n')]), [])
+    raw_column = next((name for name in columns if name.strip() == column), None)
+    return header, raw_column, [name.strip() for name in columns]
+
+def parser_header(header):
+    """
+    The header line as the parsers should see it before every block (without a BOM,
+    which would change the first column's name).
+    """
+    return header.removeprefix(codecs.BOM_UTF8)
+
+def split_lines(block):
+    """
+    Split a block of whole lines into its non-blank lines (without line breaks),
+    matching the rows the parsers return.
+    """
+    lines = block.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    return [line for line in lines if line.strip(b'\r')]
+
+def column_values(data, column, engine):
+    """
+    Parse only `column` of a CSV block (header included) as strings.
+
+    Returns:
+        pyarrow ChunkedArray or pandas Series, one value per row
+    """
+    if engine == 'pyarrow':
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+        table = pacsv.read_csv(
+            io.BytesIO(data),
+            read_options=pacsv.ReadOptions(use_threads=False),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=[column], column_types={column: pa.string()},
+                strings_can_be_null=False, quoted_strings_can_be_null=False
+            )
+        )
+        return table.column(column)
+
+    import pandas as pd
+    return pd.read_csv(io.BytesIO(data), usecols=[column], dtype=str, keep_default_na=False,
+                       skip_blank_lines=True)[column]
+
+def get_chunks(source_file, data_start, range_size):
+    """
+    The pieces of a CSV for the workers to scan: (start, end) byte ranges of
+    a plain file, or, for a compressed file, its decompressed blocks of whole
+    lines, read lazily as the workers ask for them.
+
+    Returns:
+        (iterable of chunks, total bytes to scan or None if unknown)
+    """
+    if get_compression(source_file) is None:
+        ranges = get_byte_ranges(source_file, data_start, range_size)
+        return ranges, sum(end - start for start, end in ranges)
+
+    def blocks():
+        with open_file(source_file, 'rb') as f:
+            f.read(data_start)
+            yield from iter_line_blocks(f, range_size)
+    return blocks(), None
+
+def chunk_size(chunk):
+    """
+    Bytes a chunk from get_chunks covers.
+    """
+    return len(chunk) if isinstance(chunk, bytes) else chunk[1] - chunk[0]
+
+def progress_line(verb, scanned, total_bytes):
+    """
+    Progress of a scan, e.g. '  - Scanned 64 of 259 MB (25%)' (without the
+    total for a compressed file, whose decompressed size is unknown).
+    """
+    if total_bytes is None:
+        return f"  - {verb} {scanned / 1024 / 1024:,.0f} MB"
+    return (f"  - {verb} {scanned / 1024 / 1024:,.0f} of {total_bytes / 1024 / 1024:,.0f} MB "
+            f"({100.0 * scanned / max(total_bytes, 1):.0f}%)")
+
+def read_range_rows(settings, chunk):
+    """
+    Read the lines of a chunk (a byte range, or a block of lines of a
+    compressed file) and parse their key column (in a worker process).
+
+    Returns:
+        (lines, column values), or ([], None) for an empty chunk
+    """
+    if isinstance(chunk, bytes):
+        block, where = chunk, "in a block of the decompressed file"
+    else:
+        start, end = chunk
+        with open(settings['source_file'], 'rb') as f:
+            block = read_line_range(f, start, end, settings['data_start'])
+        where = f"near byte {start}"
+    if not block:
+        return [], None
+    lines = split_lines(block)
+    values = column_values(settings['header'] + block, settings['column'], settings['engine'])
+    if len(values) != len(lines):
+        raise ValueError(f"Rows and lines do not line up {where}; "
+                         f"line breaks inside quoted values are not supported.")
+    return lines, values
+
+def worker_settings():
+    """
+    The settings passed to scan_ranges, inside a worker process.
+    """
+    return _worker_settings
+
+def _init_worker(settings):
+    global _worker_settings
+    _worker_settings = settings
+
+def scan_ranges(scan, ranges, settings, workers):
+    """
+    Run scan(chunk) for every chunk in worker processes and yield the
+    results in file order. At most 2 * workers chunks are in flight, so
+    memory stays bounded however large the file is.
+
+    Args:
+        scan: Top-level function of a chunk (reads worker_settings())
+        ranges: Iterable of chunks (see get_chunks)
+        settings: Picklable dict made available to every worker
+        workers: Number of worker processes
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(settings,)) as executor:
+        pending = iter(ranges)
+        in_flight = deque(executor.submit(scan, byte_range) for byte_range in
+                          (next(pending, None) for _ in range(workers * 2)) if byte_range is not None)
+        while in_flight:
+            result = in_flight.popleft().result()
+            next_range = next(pending, None)
+            if next_range is not None:
+                in_flight.append(executor.submit(scan, next_range))
+            yield result
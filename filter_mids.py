@@ -1,73 +1,287 @@
-import pandas as pd
-import time
+"""
+CSV filter for large event dumps.
+
+Keeps the rows whose merchant ID column matches any of a set of merchant
+IDs, in a single pass over the file however many IDs are given. The file
+is cut into byte ranges that worker processes scan in parallel; each worker
+parses only the merchant ID column (with pyarrow when installed, pandas
+otherwise) and matching rows are copied to the output byte for byte.
+
+Compressed dumps (.csv.gz, .csv.zst) are decompressed as a stream and
+their blocks of lines scanned by the same workers; outputs are compressed
+with OUTPUT_COMPRESSION.
+
+With OUTPUT_FORMAT=parquet the matching rows are written to Parquet
+instead, with column types inferred from the start of the file; the
+workers convert their rows, so typing costs no extra pass.
+
+If the file has an index of the filter column (built with csv_index.py),
+only the matching rows are read, by seeking to their offsets.
+"""
+
 import os
-from utils import show_available_assets, get_asset_file_path
+import re
+import sys
+import time
+from utils import (show_available_assets, get_asset_file_path, ensure_output_dir, get_file_processing_config,
+                   iter_ids, get_output_config, get_output_file, open_file, strip_compression)
+from csv_ranges import (resolve_engine, read_csv_header, parser_header, get_chunks, chunk_size, read_range_rows,
+                        worker_settings, scan_ranges, progress_line)
+from parquet_output import infer_csv_schema, csv_table, ParquetTableWriter
+from csv_index import load_index
+from constants import DEFAULT_PATHS
+
+# ================================================================
+# CONFIGURATION
+# ================================================================
+
+# Column, default merchant IDs, parser engine, workers and range size
+FILE_CONFIG = get_file_processing_config()
+
+# Output format (csv or parquet) and Parquet settings
+OUTPUT_CONFIG = get_output_config()
+
+# ================================================================
+# SCRIPT LOGIC
+# ================================================================
+
+def read_mids(value, default_mids):
+    """
+    Turn the user's answer into a set of merchant IDs: a file with one ID
+    per line (looked up in assets/), comma-separated IDs, or the defaults.
+    """
+    value = value.strip()
+    if not value:
+        return set(default_mids)
+    path = get_asset_file_path(value)
+    if os.path.isfile(path):
+        with open_file(path) as f:
+            return set(iter_ids(f))
+    return {mid.strip() for mid in value.split(',') if mid.strip()}
+
+def _matching_indices(values, mids, engine):
+    """
+    Returns:
+        (row indices, merchant IDs) of the values that are in mids
+    """
+    if engine == 'pyarrow':
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        mask = pc.is_in(values, value_set=pa.array(sorted(mids), type=pa.string()))
+        indices = mask.to_numpy(zero_copy_only=False).nonzero()[0]
+        return indices, values.take(indices).to_pylist()
+
+    indices = values.isin(mids).to_numpy().nonzero()[0]
+    return indices, values.iloc[indices].tolist()
+
+def scan_range(chunk):
+    """
+    Filter the lines of one chunk of the source file (runs in a worker process).
+
+    Returns:
+        (bytes scanned, groups, table) (see group_rows)
+    """
+    settings = worker_settings()
+    lines, values = read_range_rows(settings, chunk)
+    range_bytes = chunk_size(chunk)
+    if not lines:
+        return range_bytes, [], None
+
+    indices, mids = _matching_indices(values, settings['mids'], settings['engine'])
+    if not len(indices):
+        return range_bytes, [], None
+    return (range_bytes, *group_rows(settings, [lines[index] for index in indices], mids))
+
+def group_rows(settings, lines, mids):
+    """
+    Group matching lines for the outputs: all together, or (split) by merchant ID.
 
-# --- Configuration ---
-print("CSV Filter Script")
-print("================")
+    Returns:
+        (groups, table). For CSV output, groups lists (merchant ID or None,
+        lines as bytes) and table is None. For Parquet output, table holds
+        the rows converted and ordered by merchant ID, and groups lists
+        (merchant ID or None, (offset, rows)) spans of it, so every
+        merchant's rows are a zero-copy slice.
+    """
+    if settings['schema'] is not None:
+        table = csv_table(settings['header'], b''.join(line + b'\n' for line in lines), settings['schema'])
+        if not settings['split']:
+            return [(None, (0, table.num_rows))], table
+        positions = {}
+        for position, mid in enumerate(mids):
+            positions.setdefault(mid, []).append(position)
+        # One take instead of one per merchant: each table sent back costs a copy of its buffers
+        table = table.take([position for group in positions.values() for position in group])
+        groups = []
+        offset = 0
+        for mid, group in positions.items():
+            groups.append((mid, (offset, len(group))))
+            offset += len(group)
+        return groups, table
 
-# Show available CSV files in assets directory
-available_files = show_available_assets(['.csv'])
+    if not settings['split']:
+        return [(None, b''.join(line + b'\n' for line in lines))], None
+    groups = {}
+    for line, mid in zip(lines, mids):
+        groups.setdefault(mid, []).append(line + b'\n')
+    return [(mid, b''.join(group)) for mid, group in groups.items()], None
+
+def filter_file(source_file, output_path, mids, split, config, output_format='csv', output_config=None):
+    """
+    Write the rows of source_file whose filter column is one of mids, either
+    to output_path or (split) to one file per merchant ID in the output_path
+    directory, as CSV (compressed as OUTPUT_COMPRESSION) or (output_format
+    'parquet') as Parquet.
+
+    Returns:
+        Dict mapping output file to number of rows written
+    """
+    if output_format not in ('csv', 'parquet'):
+        raise ValueError(f"Unknown output format '{output_format}'. Use 'csv' or 'parquet'.")
+    header, raw_column, columns = read_csv_header(source_file, config['filter_column'])
+    if raw_column is None:
+        raise KeyError(f"Column '{config['filter_column']}' not found! Available columns: {columns}")
+
+    settings = {
+        'source_file': source_file,
+        'data_start': len(header),
+        'header': parser_header(header),
+        'column': raw_column,
+        'mids': frozenset(mids),
+        'engine': resolve_engine(config['engine']),
+        'split': split,
+        'schema': None
+    }
+    if output_format == 'parquet':
+        output_config = output_config or get_output_config()
+        settings['schema'] = infer_csv_schema(source_file, settings['header'], len(header), output_config['parquet_infer_types'])
+
+    index = load_index(source_file, raw_column)
+    if index is not None:
+        # Seek straight to the matching rows instead of scanning the whole file
+        offsets, keys = index.lookup(sorted(mids))
+        print(f"Reading {len(offsets):,} row(s) of {len(mids)} merchant ID(s) from the index...")
+        results = ((len(lines), *group_rows(settings, lines, line_keys))
+                   for lines, line_keys in index.read_rows(offsets, keys))
+        total = len(offsets)
+    else:
+        chunks, total_bytes = get_chunks(source_file, len(header), config['range_size'])
+        size = 'a compressed file' if total_bytes is None else f"{total_bytes / 1024 / 1024:,.0f} MB"
+        print(f"Scanning {size} with {config['workers']} {settings['engine']} worker(s) for {len(mids)} merchant ID(s)...")
+        if total_bytes is not None:
+            print(f"  (index '{raw_column}' with csv_index.py to make repeat queries read only the matching rows)")
+        results = scan_ranges(scan_range, chunks, settings, config['workers'])
+        total = total_bytes
+
+    outputs = {}
+    paths = {}
+    rows_written = {}
+
+    def output_for(mid):
+        if mid not in outputs:
+            if mid is None:
+                path = output_path
+            else:
+                path = get_output_file(os.path.join(output_path, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', mid)}.csv"), output_format)
+            if settings['schema'] is not None:
+                outputs[mid] = ParquetTableWriter(path, settings['schema'], output_config)
+            else:
+                outputs[mid] = open_file(path, 'wb')
+                outputs[mid].write(header)
+            paths[mid] = path
+            rows_written[path] = 0
+        return outputs[mid]
+
+    scanned = 0
+    try:
+        if split:
+            os.makedirs(output_path, exist_ok=True)
+        else:
+            output_for(None)
+        # Results arrive in file order, so the output keeps the order of the input
+        for progress, groups, table in results:
+            for mid, data in groups:
+                output = output_for(mid)
+                if table is not None:
+                    output.write(table.slice(*data))
+                    rows_written[paths[mid]] += data[1]
+                else:
+                    output.write(data)
+                    rows_written[paths[mid]] += data.count(b'\n')
+            scanned += progress
+            if index is not None:
+                print(f"  - Read {scanned:,} of {total:,} rows ({100.0 * scanned / max(total, 1):.0f}%)")
+            else:
+                print(progress_line("Scanned", scanned, total))
+    finally:
+        for output in outputs.values():
+            output.close()
+    return rows_written
+
+def main():
+    """
+    Main function to select the CSV file and merchant IDs and filter the file in one pass.
+    """
+    print("CSV Filter Script")
+    print("================")
+
+    # Show available CSV files in assets directory
+    available_files = show_available_assets(['.csv'])
+
+    if not available_files:
+        print("No CSV files found in assets directory!")
+        sys.exit(1)
 
-if available_files:
     print("\nPlease select a CSV file to filter:")
     source_filename = input("Enter the filename (e.g., 'VIRALO.csv'): ").strip()
     source_file = get_asset_file_path(source_filename)
-else:
-    print("No CSV files found in assets directory!")
-    exit(1)
-
-# Output file configuration
-output_filename = input("Enter output filename (e.g., 'filtered_data.csv'): ").strip()
-if not output_filename.endswith('.csv'):
-    output_filename += '.csv'
-output_file = f'output/{output_filename}'
-
-filter_column = 'eventdata_merchantid'
-filter_value = 'VIRALOONLINE'
-chunk_size = 100000  # Process 100,000 rows at a time
-# -------------------
-
-start_time = time.time()
-print(f"Starting to filter '{source_file}'...")
-
-# Use a flag to write the header only for the first chunk
-is_first_chunk = True
-
-# Create an iterator that reads the CSV in manageable chunks
-# Strip whitespace from column names to handle CSV formatting issues
-chunk_iterator = pd.read_csv(source_file, chunksize=chunk_size, low_memory=False)
-
-# Clean column names for the first chunk to verify the fix
-first_chunk = next(iter(pd.read_csv(source_file, chunksize=chunk_size, low_memory=False, nrows=1)))
-first_chunk.columns = first_chunk.columns.str.strip()
-if filter_column not in first_chunk.columns:
-    print(f"Warning: Column '{filter_column}' not found!")
-    print(f"Available columns: {list(first_chunk.columns)}")
-    exit(1)
-
-# Now create the actual iterator
-chunk_iterator = pd.read_csv(source_file, chunksize=chunk_size, low_memory=False)
-
-# Loop through each chunk
-for i, chunk in enumerate(chunk_iterator):
-    print(f"  - Processing chunk {i+1}...")
-    
-    # Strip whitespace from column names
-    chunk.columns = chunk.columns.str.strip()
-    
-    # Filter the chunk for rows where the column matches the value
-    filtered_chunk = chunk[chunk[filter_column] == filter_value]
-    
-    # If this is the first chunk, write to a new file with the header
-    if is_first_chunk and not filtered_chunk.empty:
-        filtered_chunk.to_csv(output_file, index=False, mode='w', header=True)
-        is_first_chunk = False
-    # For subsequent chunks, append to the file without the header
-    elif not filtered_chunk.empty:
-        filtered_chunk.to_csv(output_file, index=False, mode='a', header=False)
-
-end_time = time.time()
-print(f"\nFiltering complete! The new file is named '{output_file}'.")
-print(f"Total time taken: {end_time - start_time:.2f} seconds.")
\ No newline at end of file
+    if not os.path.isfile(source_file):
+        print(f"Error: The file '{source_file}' was not found.")
+        sys.exit(1)
+
+    # Merchant IDs: a .txt file with one ID per line, or comma-separated IDs
+    show_available_assets(['.txt'])
+    default_mids = ', '.join(FILE_CONFIG['default_mids'])
+    mids = read_mids(input(f"Enter a file with merchant IDs (one per line) or comma-separated IDs "
+                           f"(default: {default_mids}): "), FILE_CONFIG['default_mids'])
+    if not mids:
+        print("No merchant IDs given. Nothing to filter.")
+        sys.exit(1)
+
+    split = len(mids) > 1 and input("Write a separate file per merchant ID? (y/N): ").strip().lower() in ('y', 'yes')
+
+    # Output file (or directory of per-merchant files) configuration
+    output_format = OUTPUT_CONFIG['format']
+    try:
+        example = os.path.basename(get_output_file('filtered_data.csv', output_format))
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    output_filename = input(f"Enter output filename (e.g., '{example}'): ").strip()
+    if split:
+        output_name = re.sub(r'\.(csv|parquet)$', '', strip_compression(output_filename))
+        output_path = f"{DEFAULT_PATHS['output_dir']}/{output_name}"
+    else:
+        output_path = get_output_file(f"{DEFAULT_PATHS['output_dir']}/{output_filename}", output_format)
+
+    ensure_output_dir()
+
+    start_time = time.time()
+    print(f"Starting to filter '{source_file}'...")
+
+    try:
+        rows_written = filter_file(source_file, output_path, mids, split, FILE_CONFIG, output_format, OUTPUT_CONFIG)
+    except (KeyError, ValueError, ImportError) as e:
+        print(f"Error: {e.args[0] if e.args else e}")
+        sys.exit(1)
+
+    end_time = time.time()
+    total_rows = sum(rows_written.values())
+    if split:
+        print(f"\nFiltering complete! {total_rows} rows written to {len(rows_written)} files in '{output_path}'.")
+    else:
+        print(f"\nFiltering complete! {total_rows} rows written to '{output_path}'.")
+    print(f"Total time taken: {end_time - start_time:.2f} seconds.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+"""
+Flow control for PhonePe API scripts.
+Per-service rate limits, concurrency limits and circuit breakers shared by every worker in the process.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from utils import get_concurrency_config, get_circuit_breaker_config, get_rate_limit
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter: `rate` requests per second with bursts of up to `burst`.
+
+    reserve() takes a token and returns how long the caller must wait before
+    using it. Tokens may be borrowed from the future, so concurrent callers
+    queue up behind each other in order instead of polling.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take one token.
+
+        Returns:
+            Seconds to wait before sending the request (0 if a token was available)
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on the number of requests in flight to one service.
+
+    Every successful response below the latency threshold grows the limit by
+    1/limit (about +1 per round trip of requests); a timeout, connection
+    error, HTTP 429 or 5xx, or a short-term latency above `latency_tolerance`
+    times the long-term latency cuts it by `backoff_ratio`, at most once per
+    round trip. The limit always stays within [floor, ceiling].
+
+    Threads use acquire(); coroutines on the lookup engine's event loop use
+    acquire_async(). Every acquire must be paired with release().
+    """
+
+    # Weight of the newest sample in the short-term and long-term latency averages
+    _SHORT_SMOOTHING = 0.1
+    _LONG_SMOOTHING = 0.01
+
+    def __init__(self, service, floor, ceiling, initial, backoff_ratio, latency_tolerance):
+        self.service = service
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = float(min(max(initial, floor), ceiling))
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self._short_latency = None
+        self._long_latency = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = deque()
+
+    def acquire(self):
+        """
+        Block the calling thread until a request slot is free.
+        """
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        """
+        Wait on the event loop until a request slot is free.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Woken just before being cancelled: pass the wake-up on
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_async_waiters(1)
+                raise
+
+    def release(self, latency, overloaded):
+        """
+        Free a request slot and adapt the limit to the observed outcome.
+
+        Args:
+            latency: Seconds the request took
+            overloaded: True for timeouts, connection errors, HTTP 429 and 5xx
+        """
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            if not overloaded:
+                self._record_latency(latency)
+
+            congested = overloaded or (
+                self._short_latency > self._long_latency * self.latency_tolerance
+            )
+            if congested:
+                if now - self._last_decrease > (self._short_latency or 0.0):
+                    self.limit = max(self.floor, self.limit * self.backoff_ratio)
+                    self._last_decrease = now
+            elif self.in_flight >= self.limit / 2:
+                # Only grow while the current limit is actually being used
+                self.limit = min(self.ceiling, self.limit + 1.0 / self.limit)
+
+            # Wake only as many waiters as there are free slots
+            free_slots = max(0, int(self.limit) - self.in_flight)
+            self._cond.notify(free_slots)
+        self._wake_async_waiters(free_slots)
+
+    def _wake_async_waiters(self, count):
+        """
+        Wake up to `count` coroutines waiting in acquire_async(), skipping
+        cancelled ones. Safe to call from any thread: each waiter is resolved
+        on its own event loop.
+        """
+        woken = []
+        with self._cond:
+            while len(woken) < count and self._async_waiters:
+                loop, waiter = self._async_waiters.popleft()
+                if not waiter.done():
+                    woken.append((loop, waiter))
+        for loop, waiter in woken:
+            loop.call_soon_threadsafe(self._wake, waiter)
+
+    def _wake(self, waiter):
+        # Runs on the waiter's event loop
+        if waiter.done():
+            # Cancelled since it was picked: the slot goes to the next waiter
+            self._wake_async_waiters(1)
+        else:
+            waiter.set_result(None)
+
+    def _record_latency(self, latency):
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency
+        else:
+            self._short_latency += self._SHORT_SMOOTHING * (latency - self._short_latency)
+            self._long_latency += self._LONG_SMOOTHING * (latency - self._long_latency)
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one service.
+
+    While closed, every request goes out and its outcome is kept in a window
+    of the last `window` requests. Once the window holds at least
+    `min_requests` requests and `failure_ratio` of them failed (timeouts,
+    connection errors and 5xx), the circuit opens: allow() refuses every
+    request for `open_time` seconds, so lookups fail fast instead of each
+    waiting out a timeout. Then the circuit turns half-open and lets
+    `probes` requests through. It closes once they all succeed; a failed
+    probe opens it again for twice as long, up to `max_open_time`. Only the
+    probes decide: requests sent before the circuit opened may still end
+    while it is half-open, and their outcomes are ignored.
+
+    Usage:
+        ticket = breaker.allow()
+        if ticket is not None:
+            response = ...send the request...
+            breaker.record(CircuitBreaker.is_failure(response), ticket)
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, service, window, min_requests, failure_ratio, open_time, max_open_time, probes, give_up_after):
+        self.service = service
+        self.min_requests = min_requests
+        self.failure_ratio = failure_ratio
+        self.open_time = open_time
+        self.max_open_time = max_open_time
+        self.probes = probes
+        self.give_up_after = give_up_after
+        self.state = self.CLOSED
+        self.trips = 0
+        self._outcomes = deque(maxlen=window)
+        self._failures = 0
+        self._current_open_time = open_time
+        self._open_until = 0.0
+        self._opened_at = None
+        self._gave_up = False
+        self._probes_sent = 0
+        self._probes_passed = 0
+        # Half-open periods so far; probes are tagged with the one they belong to
+        self._probe_round = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_failure(response):
+        """
+        Check whether a FetchResult counts against the service: a timeout,
+        connection error or HTTP 5xx. A 429 is left to the rate and
+        concurrency limiters, since the service is answering.
+        """
+        if response.error:
+            return response.error in ('timeout', 'connection')
+        return response.status_code >= 500
+
+    def allow(self):
+        """
+        Check whether a request may be sent now. Every allowed request must
+        be followed by record() with the returned ticket.
+
+        Returns:
+            None while the circuit is open, or half-open with all its probes in
+            flight; otherwise the request's ticket: 0 while closed, or the
+            half-open round of a probe request
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0
+            if self.state == self.OPEN:
+                if time.monotonic() < self._open_until:
+                    return None
+                self.state = self.HALF_OPEN
+                self._probes_sent = 0
+                self._probes_passed = 0
+                self._probe_round += 1
+                print(f"Circuit breaker for {self.service} is half-open: sending {self.probes} probe request(s).")
+            if self._probes_sent < self.probes:
+                self._probes_sent += 1
+                return self._probe_round
+            return None
+
+    def record(self, failed, ticket=0):
+        """
+        Record the outcome of an allowed request.
+
+        Args:
+            failed: True for timeouts, connection errors and 5xx (see is_failure)
+            ticket: What allow() returned for the request
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if ticket != self._probe_round:
+                    # Sent before this half-open period: not a probe
+                    return
+                if failed:
+                    self._open(min(self.max_open_time, self._current_open_time * 2), "a probe request failed")
+                else:
+                    self._probes_passed += 1
+                    if self._probes_passed >= self.probes:
+                        self._close()
+            elif self.state == self.CLOSED:
+                if len(self._outcomes) == self._outcomes.maxlen:
+                    self._failures -= self._outcomes[0]
+                self._outcomes.append(failed)
+                self._failures += failed
+                count = len(self._outcomes)
+                if count >= self.min_requests and self._failures >= self.failure_ratio * count:
+                    self._open(self.open_time, f"{self._failures} of the last {count} requests failed")
+            # While open, late outcomes of requests sent before it opened are ignored
+
+    def retry_after(self):
+        """
+        Seconds after which a lookup refused by the circuit should be tried
+        again: the rest of the open time, spread by a random fraction of it so
+        held lookups do not all come back at once, or while the probes are in
+        flight, half to all of the open time.
+
+        Returns:
+            Seconds, or None once the circuit has stayed open for longer than
+            give_up_after (the lookup should be reported as failed)
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            now = time.monotonic()
+            if now - self._opened_at >= self.give_up_after:
+                if not self._gave_up:
+                    self._gave_up = True
+                    print(f"Circuit breaker for {self.service} has been open for {now - self._opened_at:.0f}s; "
+                          f"its lookups are written as failed from now on, to be retried by the next run.")
+                return None
+            if self.state == self.HALF_OPEN:
+                return random.uniform(0.5, 1.0) * self._current_open_time
+            return max(0.0, self._open_until - now) + random.uniform(0, self._current_open_time / 5)
+
+    def _open(self, open_time, reason):
+        # Called with the lock held
+        now = time.monotonic()
+        if self._opened_at is None:
+            self._opened_at = now
+            self.trips += 1
+            print(f"Circuit breaker for {self.service} opened: {reason}; failing fast for {open_time:.0f}s.")
+        else:
+            print(f"Circuit breaker for {self.service} re-opened: {reason}; failing fast for {open_time:.0f}s.")
+        self.state = self.OPEN
+        self._current_open_time = open_time
+        self._open_until = now + open_time
+
+    def _close(self):
+        # Called with the lock held
+        print(f"Circuit breaker for {self.service} closed: {self._probes_passed} probe request(s) succeeded "
+              f"after {time.monotonic() - self._opened_at:.0f}s.")
+        self.state = self.CLOSED
+        self._outcomes.clear()
+        self._failures = 0
+        self._current_open_time = self.open_time
+        self._opened_at = None
+        self._gave_up = False
+
+# Limiters shared by every engine and job in the process
+_rate_limiters = {}
+_concurrency_limiters = {}
+_circuit_breakers = {}
+_limiters_lock = threading.Lock()
+
+# Number of processes sharing the rate limits (see share_rate_limits)
+_rate_limit_share = 1
+
+def share_rate_limits(processes):
+    """
+    Split every rate limit evenly between `processes` processes running the
+    same run (see LOOKUP_PROCESSES), so together they stay within the limit.
+    Must be called before the first request of the process.
+    """
+    global _rate_limit_share
+    _rate_limit_share = max(1, processes)
+
+def get_rate_limiters(service, endpoint):
+    """
+    Get the shared token buckets that apply to a request: the service
+    bucket and, if configured, the endpoint bucket.
+
+    Returns:
+        List of TokenBucket (empty if the request is not rate limited)
+    """
+    buckets = []
+    with _limiters_lock:
+        for key, limit in ((('service', service), get_rate_limit(service=service)),
+                           (('endpoint', endpoint), get_rate_limit(endpoint=endpoint))):
+            if limit is None:
+                continue
+            if key not in _rate_limiters:
+                _rate_limiters[key] = TokenBucket(limit['rate'] / _rate_limit_share,
+                                                  max(1, limit['burst'] // _rate_limit_share))
+            buckets.append(_rate_limiters[key])
+    return buckets
+
+def get_concurrency_limiter(service):
+    """
+    Get the shared adaptive concurrency limiter for a service.
+
+    Returns:
+        AdaptiveConcurrencyLimiter, or None if adaptive concurrency is disabled
+    """
+    config = get_concurrency_config()
+    if not config['adaptive']:
+        return None
+
+    with _limiters_lock:
+        limiter = _concurrency_limiters.get(service)
+        if limiter is None:
+            service_config = {**config, **config['services'].get(service, {})}
+            limiter = AdaptiveConcurrencyLimiter(
+                service,
+                floor=service_config['floor'],
+                ceiling=service_config['ceiling'],
+                initial=service_config['initial'],
+                backoff_ratio=service_config['backoff_ratio'],
+                latency_tolerance=service_config['latency_tolerance']
+            )
+            _concurrency_limiters[service] = limiter
+        return limiter
+
+def get_circuit_breaker(service):
+    """
+    Get the shared circuit breaker for a service.
+
+    Returns:
+        CircuitBreaker, or None if circuit breakers are disabled
+    """
+    config = get_circuit_breaker_config()
+    if not config['enabled']:
+        return None
+
+    with _limiters_lock:
+        breaker = _circuit_breakers.get(service)
+        if breaker is None:
+            service_config = {**config, **config['services'].get(service, {})}
+            breaker = CircuitBreaker(
+                service,
+                window=service_config['window'],
+                min_requests=service_config['min_requests'],
+                failure_ratio=service_config['failure_ratio'],
+                open_time=service_config['open_time'],
+                max_open_time=service_config['max_open_time'],
+                probes=service_config['probes'],
+                give_up_after=service_config['give_up_after']
+            )
+            _circuit_breakers[service] = breaker
+        return breaker
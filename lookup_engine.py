@@ -0,0 +1,1023 @@
+"""
+Lookup engines for PhonePe API scripts.
+Runs the per-ID lookups of a script either on a thread pool or on an asyncio event loop.
+
+A script describes its work with two functions:
+    build_lookups(item)               -> list of (api_name, url) pairs to request
+    build_result_row(item, responses) -> output row, where responses maps
+                                         api_name to a FetchResult
+
+Each output row is passed on as on_row(row, key, final), where key is the
+item's ID (when an item_key function is given) and final is False if any
+lookup for the item failed with a retryable error.
+
+Items are pulled lazily from the input iterable, and each of their lookups
+is handed through a bounded queue to the workers of its service, so an
+item's lookups run concurrently and memory stays flat however large the
+input is.
+Lookups that fail with a retryable error (timeouts, connection errors,
+HTTP 429 and 5xx) are retried with exponential backoff and jitter.
+When most requests to a service fail, its circuit breaker opens: its
+lookups fail fast and wait, without using up their retries, until probe
+requests show that the service has recovered.
+Successful responses are cached on disk (see response_cache), so repeat
+runs only hit the network for lookups whose answer could have changed.
+With LOOKUP_PROCESSES the lookups are spread over several worker
+processes whose result rows are merged into the one output file.
+"""
+
+import asyncio
+import atexit
+import heapq
+import itertools
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from utils import (get_network_config, get_retry_config, get_concurrency_config, get_concurrency_ceiling,
+                   get_circuit_breaker_config, get_api_config, FetchResult, fetch, fetch_async, create_async_http_session,
+                   is_retryable_response, backoff_delay, id_hash, CompactIdSet, reset_http_session,
+                   get_shard_config, get_cache_config, shard_items)
+from flow_control import get_rate_limiters, get_concurrency_limiter, get_circuit_breaker, share_rate_limits, CircuitBreaker
+from result_writer import ResultWriter
+from progress_journal import ProgressJournal
+from response_cache import open_response_cache
+from metrics import RunMetrics
+
+# Sentinel telling a worker that the input is exhausted
+_STOP = object()
+
+# Outcome of run_lookup_job()
+LookupSummary = namedtuple('LookupSummary', ['processed', 'restored', 'failed'])
+
+class LookupWork:
+    """
+    An input item together with the lookups it still needs.
+
+    The pending lookups of an item run independently, possibly on different
+    services' workers; complete() tells the worker that finishes the last
+    one that the item is ready for its output row (or a retry).
+    """
+    __slots__ = ('item', 'pending', 'responses', 'attempt', 'remaining', '_lock')
+
+    def __init__(self, item, lookups):
+        self.item = item
+        self.pending = list(lookups)
+        self.responses = {}
+        self.attempt = 0
+        self.remaining = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Mark all pending lookups as in progress.
+        """
+        self.remaining = len(self.pending)
+
+    def complete(self, api_name, response):
+        """
+        Record the response of one pending lookup.
+
+        Returns:
+            True if it was the last pending lookup of the item
+        """
+        with self._lock:
+            self.responses[api_name] = response
+            self.remaining -= 1
+            return self.remaining == 0
+
+    def schedule_retry(self, retry_config, circuit_wait=None):
+        """
+        Keep only the lookups that failed with a retryable error as pending.
+
+        Lookups refused by an open circuit breaker do not use up an attempt:
+        they stay pending until circuit_wait(api_name) returns None (the
+        circuit has been open for too long), and the item waits at least
+        that long before they are sent again.
+
+        Returns:
+            Seconds to wait before retrying them, or None if the item is done
+        """
+        failed = []
+        held = []
+        delay = 0.0
+        for api_name, url in self.pending:
+            response = self.responses[api_name]
+            if response.error == 'circuit_open':
+                wait = circuit_wait(api_name) if circuit_wait else None
+                if wait is not None:
+                    held.append((api_name, url))
+                    delay = max(delay, wait)
+            elif is_retryable_response(response):
+                failed.append((api_name, url))
+        if failed and self.attempt + 1 >= retry_config['max_attempts']:
+            failed = []
+        if not failed and not held:
+            return None
+        self.pending = failed + held
+        if failed:
+            delay = max(delay, backoff_delay(self.attempt, retry_config))
+            self.attempt += 1
+        return delay
+
+class ServiceControls:
+    """
+    Flow control applied around every lookup request of a run.
+
+    Resolves each api name (a key of get_api_config()) to its service once,
+    paces requests through the shared token buckets of the service and the
+    endpoint, then gates them through the service's shared adaptive
+    concurrency limiter. While the service's circuit breaker is open,
+    requests are not sent and fail fast with the error 'circuit_open'. Api
+    names that are not in get_api_config() are treated as their own
+    service. With a ResponseCache, cached responses are
+    returned without touching the network and new 200 responses are cached.
+    With RunMetrics, every lookup is recorded; the latency covers only the
+    request itself, not the time spent waiting on the limiters.
+    """
+
+    def __init__(self, cache=None, metrics=None):
+        self._services = {api_name: config['service'] for api_name, config in get_api_config().items()}
+        self._controls = {}
+        self.cache = cache
+        self.metrics = metrics
+
+    def service(self, api_name):
+        return self._services.get(api_name, api_name)
+
+    def controls(self, api_name):
+        """
+        Get the (rate limiters, concurrency limiter, circuit breaker) of an api name.
+        """
+        if api_name not in self._controls:
+            service = self.service(api_name)
+            self._controls[api_name] = (get_rate_limiters(service, api_name), get_concurrency_limiter(service),
+                                        get_circuit_breaker(service))
+        return self._controls[api_name]
+
+    def concurrency_limit(self, service):
+        """
+        Current in-flight limit of a service's adaptive concurrency limiter.
+
+        Returns:
+            int, or None if adaptive concurrency is disabled
+        """
+        limiter = get_concurrency_limiter(service)
+        return None if limiter is None else int(limiter.limit)
+
+    def circuit_wait(self, api_name):
+        """
+        Seconds before a lookup refused by the circuit breaker of an api name's
+        service should be sent again (see CircuitBreaker.retry_after).
+        """
+        breaker = self.controls(api_name)[2]
+        return breaker.retry_after() if breaker is not None else None
+
+    def _refuse(self, api_name, breaker):
+        """
+        Fail fast for a request the service's circuit breaker did not allow.
+
+        Returns:
+            'circuit_open' FetchResult
+        """
+        response = FetchResult(None, b'', 'circuit_open', f"Circuit breaker for {breaker.service} is open")
+        self._record(api_name, None, response)
+        return response
+
+    @staticmethod
+    def _rate_limit_wait(buckets):
+        return max((bucket.reserve() for bucket in buckets), default=0.0)
+
+    def fetch(self, api_name, url):
+        if self.cache:
+            response = self.cache.get(url)
+            if response is not None:
+                self._record(api_name, None, response, cached=True)
+                return response
+
+        buckets, limiter, breaker = self.controls(api_name)
+        ticket = breaker.allow() if breaker is not None else 0
+        if ticket is None:
+            return self._refuse(api_name, breaker)
+        wait = self._rate_limit_wait(buckets)
+        if wait:
+            time.sleep(wait)
+        if limiter is not None:
+            limiter.acquire()
+        start = time.monotonic()
+        response = fetch(url)
+        latency = time.monotonic() - start
+        if limiter is not None:
+            limiter.release(latency, is_retryable_response(response))
+        if breaker is not None:
+            breaker.record(CircuitBreaker.is_failure(response), ticket)
+
+        self._record(api_name, latency, response)
+        if self.cache:
+            self.cache.put(url, response)
+        return response
+
+    async def fetch_async(self, session, api_name, url):
+        if self.cache:
+            response = self.cache.get(url)
+            if response is not None:
+                self._record(api_name, None, response, cached=True)
+                return response
+
+        buckets, limiter, breaker = self.controls(api_name)
+        ticket = breaker.allow() if breaker is not None else 0
+        if ticket is None:
+            return self._refuse(api_name, breaker)
+        wait = self._rate_limit_wait(buckets)
+        if wait:
+            await asyncio.sleep(wait)
+        if limiter is not None:
+            await limiter.acquire_async()
+        start = time.monotonic()
+        response = await fetch_async(session, url)
+        latency = time.monotonic() - start
+        if limiter is not None:
+            limiter.release(latency, is_retryable_response(response))
+        if breaker is not None:
+            breaker.record(CircuitBreaker.is_failure(response), ticket)
+
+        self._record(api_name, latency, response)
+        if self.cache:
+            self.cache.put(url, response)
+        return response
+
+    def _record(self, api_name, latency, response, cached=False):
+        if self.metrics:
+            self.metrics.record(self.service(api_name), api_name, latency, response, cached)
+
+# Flow control and thread pool of the single-item entry points, created on first use
+_item_controls = None
+_item_executor = None
+_item_lock = threading.Lock()
+
+def get_item_controls():
+    """
+    Get the ServiceControls and thread pool shared by every call of
+    process_item() and fetch_lookup(), so scripts calling them per ID go
+    through the same rate limits, concurrency limiters, circuit breakers and
+    response cache as the engines. The pool has up to MAX_WORKERS threads,
+    started as they are needed. The response cache is closed when the
+    process exits.
+
+    Returns:
+        (ServiceControls, ThreadPoolExecutor)
+    """
+    global _item_controls, _item_executor
+    with _item_lock:
+        if _item_controls is None:
+            cache = open_response_cache()
+            if cache:
+                atexit.register(cache.close)
+            _item_controls = ServiceControls(cache)
+            _item_executor = ThreadPoolExecutor(max_workers=get_network_config()['max_workers'])
+        return _item_controls, _item_executor
+
+def _fetch_lookup(controls, lookup):
+    api_name, url = lookup
+    try:
+        return controls.fetch(api_name, url)
+    except Exception as e:
+        return FetchResult(None, b'', 'failed', str(e))
+
+def process_item(item, build_lookups, build_result_row):
+    """
+    Run all lookups for one item concurrently and build its output row.
+
+    Requests go through the shared controls of get_item_controls(), and
+    failed lookups are retried as in the engines (see
+    LookupWork.schedule_retry), sleeping in the calling thread between
+    attempts.
+    """
+    controls, executor = get_item_controls()
+    retry_config = get_retry_config()
+    work = LookupWork(item, build_lookups(item))
+    while work.pending:
+        work.start()
+        responses = executor.map(lambda lookup: _fetch_lookup(controls, lookup), work.pending)
+        for (api_name, _), response in zip(work.pending, list(responses)):
+            work.complete(api_name, response)
+        delay = work.schedule_retry(retry_config, controls.circuit_wait)
+        if delay is None:
+            break
+        time.sleep(delay)
+    return build_result_row(item, work.responses)
+
+def fetch_lookup(api_name, url):
+    """
+    Run a single lookup like process_item() does.
+
+    Returns:
+        FetchResult
+    """
+    return process_item(url, lambda url: [(api_name, url)], lambda url, responses: responses[api_name])
+
+def response_source(responses):
+    """
+    Where an item's responses came from: 'cache', 'live' or 'mixed'.
+    """
+    cached = sum(1 for response in responses.values() if response.detail == 'cached')
+    if not cached:
+        return 'live'
+    return 'cache' if cached == len(responses) else 'mixed'
+
+def emit_row(item, responses, build_result_row, on_row, item_key, mark_source=False):
+    """
+    Build the output row for an item and pass it on with its key and finality.
+    With mark_source, the row ends with its response_source().
+    """
+    row = build_result_row(item, responses)
+    if mark_source:
+        row = list(row) + [response_source(responses)]
+    key = item_key(item) if item_key else None
+    final = not any(is_retryable_response(response) for response in responses.values())
+    on_row(row, key, final)
+
+def run_with_threads(items, build_lookups, build_result_row, on_row, item_key, max_workers, queue_size, controls=None):
+    """
+    Process items on per-service pools of worker threads.
+
+    Every lookup of an item is queued separately on the bounded queue of its
+    service and served by that service's worker threads, so an item's
+    lookups run concurrently and a slow service never holds up the workers
+    of another. The item's row is emitted once its last lookup completes.
+    With adaptive concurrency a service starts with as many threads as its
+    limiter's current limit and gains threads as the limit rises, up to
+    `max_workers`; otherwise it gets `max_workers` threads.
+
+    Lookups that fail with a retryable error are parked on a retry heap and
+    dispatched again once their backoff has elapsed, so a worker never
+    sleeps through a backoff while other lookups are waiting. No more input
+    is read while `queue_size` items wait on the heap (e.g. the lookups
+    held while a circuit breaker is open).
+
+    Returns:
+        Number of items read from the input
+    """
+    retry_config = get_retry_config()
+    controls = controls or ServiceControls()
+    service_queues = {}
+    service_threads = {}
+    threads = []
+    pools_lock = threading.Lock()
+    retry_heap = []
+    sequence = itertools.count()
+    state = threading.Condition()
+    outstanding = 0
+    stopping = False
+
+    def done():
+        nonlocal outstanding
+        with state:
+            outstanding -= 1
+            state.notify_all()
+
+    def finish(work):
+        try:
+            delay = work.schedule_retry(retry_config, controls.circuit_wait)
+            if delay is None:
+                emit_row(work.item, work.responses, build_result_row, on_row, item_key, controls.cache is not None)
+        except Exception as e:
+            print(f"Error processing {work.item}: {e}")
+            delay = None
+
+        if delay is None:
+            done()
+        else:
+            with state:
+                heapq.heappush(retry_heap, (time.monotonic() + delay, next(sequence), work))
+                state.notify_all()
+
+    def worker(service, lookups):
+        while True:
+            task = lookups.get()
+            if task is _STOP:
+                return
+            # Grow the pool before the task completes, so no thread starts after the last item is done
+            limit = controls.concurrency_limit(service)
+            if limit is not None and service_threads[service] < min(limit, max_workers):
+                with pools_lock:
+                    add_workers(service)
+            work, api_name, url = task
+            try:
+                response = controls.fetch(api_name, url)
+            except Exception as e:
+                response = FetchResult(None, b'', 'failed', str(e))
+            if work.complete(api_name, response):
+                finish(work)
+
+    def add_workers(service):
+        # Called with pools_lock held
+        limit = controls.concurrency_limit(service)
+        target = max_workers if limit is None else min(limit, max_workers)
+        while service_threads[service] < target:
+            thread = threading.Thread(target=worker, args=(service, service_queues[service]), daemon=True)
+            thread.start()
+            threads.append(thread)
+            service_threads[service] += 1
+
+    def service_queue(service):
+        with pools_lock:
+            if service not in service_queues:
+                service_queues[service] = queue.Queue(maxsize=queue_size)
+                service_threads[service] = 0
+                add_workers(service)
+            return service_queues[service]
+
+    def dispatch(work):
+        if not work.pending:
+            finish(work)
+            return
+        work.start()
+        for api_name, url in work.pending:
+            service_queue(controls.service(api_name)).put((work, api_name, url))
+
+    def retry_scheduler():
+        while True:
+            with state:
+                while not stopping and not (retry_heap and retry_heap[0][0] <= time.monotonic()):
+                    state.wait(retry_heap[0][0] - time.monotonic() if retry_heap else None)
+                if stopping:
+                    return
+                _, _, work = heapq.heappop(retry_heap)
+                state.notify_all()
+            dispatch(work)
+
+    scheduler = threading.Thread(target=retry_scheduler, daemon=True)
+    scheduler.start()
+
+    count = 0
+    for item in items:
+        with state:
+            while len(retry_heap) >= queue_size:
+                state.wait()
+            outstanding += 1
+        count += 1
+        try:
+            work = LookupWork(item, build_lookups(item))
+        except Exception as e:
+            print(f"Error processing {item}: {e}")
+            done()
+            continue
+        dispatch(work)
+
+    # Wait for every item, including the ones waiting on a retry, to finish
+    with state:
+        while outstanding:
+            state.wait()
+        stopping = True
+        state.notify_all()
+    scheduler.join()
+
+    with pools_lock:
+        for service, lookups in service_queues.items():
+            for _ in range(service_threads[service]):
+                lookups.put(_STOP)
+    for thread in threads:
+        thread.join()
+
+    return count
+
+async def _run_async(items, build_lookups, build_result_row, on_row, item_key, concurrency, queue_size, controls=None):
+    """
+    Process items with per-service pools of `concurrency` worker tasks, each
+    fed from a bounded asyncio queue. Every lookup of an item is queued on
+    its own service, and retries wait out their backoff in a separate task,
+    not in a worker. No more input is read while `queue_size` items wait on
+    a retry.
+    """
+    retry_config = get_retry_config()
+    controls = controls or ServiceControls()
+    service_queues = {}
+    workers = []
+    retry_tasks = set()
+    retry_room = asyncio.Event()
+    retry_room.set()
+    outstanding = 0
+    all_done = asyncio.Event()
+
+    def done():
+        nonlocal outstanding
+        outstanding -= 1
+        if not outstanding:
+            all_done.set()
+
+    def finish(work):
+        try:
+            delay = work.schedule_retry(retry_config, controls.circuit_wait)
+            if delay is None:
+                emit_row(work.item, work.responses, build_result_row, on_row, item_key, controls.cache is not None)
+        except Exception as e:
+            print(f"Error processing {work.item}: {e}")
+            delay = None
+
+        if delay is None:
+            done()
+        else:
+            task = asyncio.create_task(retry_later(work, delay))
+            retry_tasks.add(task)
+            task.add_done_callback(retry_done)
+            if len(retry_tasks) >= queue_size:
+                retry_room.clear()
+
+    def retry_done(task):
+        retry_tasks.discard(task)
+        if len(retry_tasks) < queue_size:
+            retry_room.set()
+
+    async def retry_later(work, delay):
+        await asyncio.sleep(delay)
+        await dispatch(work)
+
+    async def worker(session, lookups):
+        while True:
+            task = await lookups.get()
+            if task is _STOP:
+                return
+            work, api_name, url = task
+            try:
+                response = await controls.fetch_async(session, api_name, url)
+            except Exception as e:
+                response = FetchResult(None, b'', 'failed', str(e))
+            if work.complete(api_name, response):
+                finish(work)
+
+    async def dispatch(work):
+        if not work.pending:
+            finish(work)
+            return
+        work.start()
+        for api_name, url in work.pending:
+            service = controls.service(api_name)
+            if service not in service_queues:
+                service_queues[service] = asyncio.Queue(maxsize=queue_size)
+                workers.extend(asyncio.create_task(worker(session, service_queues[service]))
+                               for _ in range(concurrency))
+            await service_queues[service].put((work, api_name, url))
+
+    async with create_async_http_session(concurrency) as session:
+        count = 0
+        for item in items:
+            await retry_room.wait()
+            outstanding += 1
+            all_done.clear()
+            count += 1
+            try:
+                work = LookupWork(item, build_lookups(item))
+            except Exception as e:
+                print(f"Error processing {item}: {e}")
+                done()
+                continue
+            await dispatch(work)
+
+        # Wait for every item, including the ones waiting on a retry, to finish
+        if outstanding:
+            await all_done.wait()
+
+        for lookups in service_queues.values():
+            for _ in range(concurrency):
+                await lookups.put(_STOP)
+        await asyncio.gather(*workers)
+
+    return count
+
+def run_with_asyncio(items, build_lookups, build_result_row, on_row, item_key, concurrency, queue_size, controls=None):
+    """
+    Process items on an asyncio event loop using the async HTTP client.
+
+    Returns:
+        Number of items read from the input
+    """
+    return asyncio.run(_run_async(items, build_lookups, build_result_row, on_row, item_key,
+                                  concurrency, queue_size, controls))
+
+def run_lookups(items, build_lookups, build_result_row, on_row, item_key=None, engine=None, metrics=None):
+    """
+    Run the lookups for every item with the selected engine.
+
+    Args:
+        items: Iterable of input items (IDs, CSV rows, ...), consumed lazily
+        build_lookups: Function returning the (api_name, url) pairs for an item
+        build_result_row: Function turning an item and its responses into an output row
+        on_row: Callback receiving each output row as on_row(row, key, final)
+        item_key: Optional function returning the ID of an item
+        engine: 'thread' or 'async' (defaults to LOOKUP_ENGINE / NETWORK_CONFIG)
+        metrics: Optional RunMetrics recording every lookup
+
+    Returns:
+        Number of items processed
+    """
+    network_config = get_network_config()
+    concurrency_config = get_concurrency_config()
+    circuit_config = get_circuit_breaker_config()
+    engine = engine or network_config['engine']
+    queue_size = network_config['input_queue_size']
+
+    if concurrency_config['adaptive']:
+        print(f"Adaptive concurrency: in-flight requests per service between "
+              f"{concurrency_config['floor']} and {concurrency_config['ceiling']}.")
+    if circuit_config['enabled']:
+        print(f"Circuit breakers: a service's lookups fail fast and wait for it to recover once "
+              f"{circuit_config['failure_ratio']:.0%} of its last {circuit_config['window']} requests fail.")
+
+    if engine not in ('thread', 'async'):
+        raise ValueError(f"Unknown lookup engine '{engine}'. Use 'thread' or 'async'.")
+
+    cache = open_response_cache()
+    controls = ServiceControls(cache, metrics)
+    try:
+        if engine == 'thread':
+            # With adaptive concurrency the threads of a service follow its limit up to the
+            # ceiling; the connection pools hold as many connections (see get_http_session)
+            max_workers = get_concurrency_ceiling()
+            print(f"Using the thread engine with up to {max_workers} workers per service.")
+            return run_with_threads(items, build_lookups, build_result_row, on_row, item_key,
+                                    max_workers, queue_size, controls)
+        else:
+            print(f"Using the async engine with up to {network_config['async_concurrency']} requests in flight.")
+            return run_with_asyncio(items, build_lookups, build_result_row, on_row, item_key,
+                                    network_config['async_concurrency'], queue_size, controls)
+    finally:
+        if cache:
+            cache.close()
+            print(f"Response cache: {cache.hits} lookups answered from '{cache.path}', "
+                  f"{cache.stored} responses cached.")
+
+class LookupJob:
+    """
+    One lookup job: an input, how to look up and report each of its items,
+    and the output file the result rows go to.
+
+    Progress is journaled next to the output file ('<output_file>.journal').
+    If an earlier attempt of the same run was interrupted, its final rows are
+    restored from the journal and those IDs are skipped; only missing or
+    failed IDs are looked up again.
+
+    If items can be iterated more than once (see InputItems), IDs repeated
+    in the input are looked up only once and their result row is written
+    once per input line, so the output still has a row for every line.
+    Re-iterable items are also counted up front, so progress lines can show
+    an ETA.
+
+    With SHARD_COUNT above 1 only the items whose key hashes to this host's
+    shard (SHARD_INDEX) are looked up; write the output to the shard's own
+    file (see get_shard_output_file) and combine the shards with
+    merge_shards.py.
+
+    Usage:
+        with LookupJob(items, build_lookups, build_result_row, ...) as job:
+            run_lookups(job.pending(), ..., on_row=job.write)
+        job.summary()
+    """
+
+    def __init__(self, items, build_lookups, build_result_row, output_file, header, item_key, run_name, column_types=None):
+        self.shard = get_shard_config()
+        self.items = shard_items(items, item_key, self.shard) if self.shard['count'] > 1 else items
+        self.build_lookups = build_lookups
+        self.build_result_row = build_result_row
+        self.output_file = output_file
+        cache_config = get_cache_config()
+        # run_lookups() ends every row with its response source while the cache is on
+        self.header = list(header) + [cache_config['source_column']] if cache_config['enabled'] else header
+        self.item_key = item_key
+        self.run_name = run_name
+        self.column_types = column_types
+        self.duplicates = None
+        self.total = None
+        self.processed = 0
+        self.writer = None
+
+    def __enter__(self):
+        if self.shard['count'] > 1:
+            print(f"Shard {self.shard['index']} of {self.shard['count']}: looking up only the IDs of this shard.")
+        if iter(self.items) is not self.items:
+            if get_network_config()['dedupe_input']:
+                ids = CompactIdSet(id_hash(self.item_key(item)) for item in self.items)
+                self.total = len(ids)
+                self.duplicates = ids.repeated() or None
+            else:
+                self.total = sum(1 for _ in self.items)
+            if self.duplicates:
+                print(f"{self.duplicates.lines - len(self.duplicates)} input lines repeat one of "
+                      f"{len(self.duplicates)} IDs; each of those IDs is looked up once.")
+
+        journal = ProgressJournal(f"{self.output_file}.journal", f"{self.run_name}|{','.join(self.header)}")
+        self.writer = ResultWriter(self.output_file, self.header, journal=journal, column_types=self.column_types)
+        self.writer.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.close(completed=exc_type is None)
+
+    def pending(self):
+        """
+        Lazily yield the items that still need a lookup: items without a
+        final result in the journal, and only the first occurrence of a
+        repeated ID. Every input line passed on counts as processed.
+        """
+        if self.duplicates:
+            self.duplicates.reset()
+        for item in self.writer.journal.skip_completed(self.items, self.item_key):
+            self.processed += 1
+            if self.duplicates and not self.duplicates.dispatch(id_hash(self.item_key(item))):
+                continue
+            yield item
+
+    def write(self, row, key, final):
+        """
+        Write an output row once for every input line with its ID.
+
+        Returns:
+            Number of rows written
+        """
+        copies = self.duplicates.count(id_hash(key)) if self.duplicates else 1
+        self.writer.write(row, key, final, copies=copies)
+        return copies
+
+    def summary(self):
+        return LookupSummary(self.processed, self.writer.rows_restored, self.writer.rows_failed)
+
+def interleave(iterables):
+    """
+    Lazily yield items from several iterables in turn (round robin).
+    """
+    iterators = deque(iter(iterable) for iterable in iterables)
+    while iterators:
+        iterator = iterators.popleft()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            continue
+        yield item
+        iterators.append(iterator)
+
+class LookupProcesses:
+    """
+    Runs the lookups in several forked worker processes (LOOKUP_PROCESSES),
+    so TLS, JSON decoding and bookkeeping use more than one core.
+
+    The parent reads the input and hands items to the processes in batches
+    through one bounded queue, so an idle process takes the next batch.
+    Each process runs run_lookups() with its own engine, connection pools
+    and share of the rate limits, and sends its result rows and request
+    stats back; the parent passes the rows to on_row, so one output file
+    and progress journal receive them all.
+
+    The processes are forked when the object is entered, which must happen
+    before any other thread is started (result writers, metrics), so no
+    lock is inherited while held.
+
+    Usage:
+        with LookupProcesses(4, build_lookups, build_result_row, item_key) as processes:
+            processes.run(items, on_row, metrics)
+    """
+
+    # Input items per batch sent to a process
+    ITEM_BATCH_SIZE = 256
+    # Result rows a process collects before sending them (sent at least every ROW_BATCH_INTERVAL seconds)
+    ROW_BATCH_SIZE = 256
+    ROW_BATCH_INTERVAL = 0.5
+
+    def __init__(self, count, build_lookups, build_result_row, item_key):
+        self.count = count
+        self.build_lookups = build_lookups
+        self.build_result_row = build_result_row
+        self.item_key = item_key
+        self._processes = []
+        self._context = multiprocessing.get_context('fork')
+        self._tasks = self._context.Queue(maxsize=count * 4)
+        self._results = self._context.Queue()
+
+    def __enter__(self):
+        print(f"Running the lookups in {self.count} processes.")
+        for index in range(self.count):
+            process = self._context.Process(target=self._process_main, args=(index,), daemon=True)
+            process.start()
+            self._processes.append(process)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for process in self._processes:
+            process.join(timeout=0 if exc_type else 5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    def run(self, items, on_row, metrics):
+        """
+        Look up every item in the worker processes.
+
+        Args:
+            items: Iterable of input items, read lazily in a feeder thread
+            on_row: Callback receiving each output row as on_row(row, key, final)
+            metrics: RunMetrics the processes' request stats are added to
+
+        Returns:
+            Number of items processed
+        """
+        stop = threading.Event()
+        feed_error = []
+
+        def feed():
+            try:
+                batch = []
+                for item in items:
+                    batch.append(item)
+                    if len(batch) >= self.ITEM_BATCH_SIZE:
+                        if not self._put(batch, stop):
+                            return
+                        batch = []
+                if batch:
+                    self._put(batch, stop)
+            except BaseException as e:
+                feed_error.append(e)
+            finally:
+                for _ in self._processes:
+                    self._put(None, stop)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        processed = 0
+        running = len(self._processes)
+        try:
+            while running:
+                try:
+                    message = self._results.get(timeout=1)
+                except queue.Empty:
+                    failed = [process for process in self._processes if process.exitcode not in (None, 0)]
+                    if failed:
+                        raise RuntimeError(f"A lookup process exited with code {failed[0].exitcode}.")
+                    continue
+                kind, payload, stats = message
+                if stats:
+                    metrics.merge_stats(*stats)
+                if kind == 'rows':
+                    for row, key, final in payload:
+                        on_row(row, key, final)
+                elif kind == 'done':
+                    processed += payload
+                    running -= 1
+                else:
+                    raise RuntimeError(f"A lookup process failed:\n{payload}")
+        finally:
+            stop.set()
+            feeder.join()
+        if feed_error:
+            raise feed_error[0]
+        return processed
+
+    def _put(self, batch, stop):
+        """
+        Queue a batch for the processes, waiting while the queue is full.
+
+        Returns:
+            False if the run was stopped before the batch could be queued
+        """
+        while not stop.is_set():
+            try:
+                self._tasks.put(batch, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _process_main(self, index):
+        # Ctrl+C is handled by the parent, which stops the processes
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        reset_http_session()
+        share_rate_limits(self.count)
+        metrics = RunMetrics(progress_interval=0, path='')
+        rows = []
+        rows_lock = threading.Lock()
+        last_sent = [time.monotonic()]
+
+        def items():
+            while True:
+                batch = self._tasks.get()
+                if batch is None:
+                    return
+                yield from batch
+
+        def send(force=False):
+            # Called with rows_lock held
+            if rows and (force or len(rows) >= self.ROW_BATCH_SIZE
+                         or time.monotonic() - last_sent[0] >= self.ROW_BATCH_INTERVAL):
+                self._results.put(('rows', list(rows), metrics.take_stats()))
+                rows.clear()
+                last_sent[0] = time.monotonic()
+
+        def on_row(row, key, final):
+            with rows_lock:
+                rows.append((row, key, final))
+                send()
+
+        try:
+            processed = run_lookups(items(), self.build_lookups, self.build_result_row, on_row,
+                                    item_key=self.item_key, metrics=metrics)
+            with rows_lock:
+                send(force=True)
+            self._results.put(('done', processed, metrics.take_stats()))
+        except BaseException:
+            self._results.put(('error', f"process {index}: {traceback.format_exc()}", None))
+
+def run_lookup_jobs(jobs):
+    """
+    Run several LookupJobs together in one process.
+
+    The jobs' items are interleaved into a single run of the lookup engine,
+    so all jobs share its workers, connection pools, response cache, rate
+    limits, concurrency limits and retry scheduler, while each job keeps its
+    own output file and progress journal. With LOOKUP_PROCESSES above 1 the
+    run is spread over that many worker processes (see LookupProcesses).
+
+    Progress of the whole run is reported periodically and its metrics are
+    written to METRICS_FILE at the end (see RunMetrics).
+
+    Returns:
+        List with a LookupSummary per job
+    """
+    if len(jobs) == 1:
+        job = jobs[0]
+        build_lookups, build_result_row, item_key = job.build_lookups, job.build_result_row, job.item_key
+
+        def items():
+            return job.pending()
+
+        def write(row, key, final):
+            return job.write(row, key, final)
+    else:
+        # Items travel through the engine tagged with the index of their job
+        def tagged(index, items):
+            for item in items:
+                yield index, item
+
+        def build_lookups(task):
+            return jobs[task[0]].build_lookups(task[1])
+
+        def build_result_row(task, responses):
+            return task[0], jobs[task[0]].build_result_row(task[1], responses)
+
+        def item_key(task):
+            return jobs[task[0]].item_key(task[1])
+
+        def items():
+            return interleave(tagged(index, job.pending()) for index, job in enumerate(jobs))
+
+        def write(result, key, final):
+            return jobs[result[0]].write(result[1], key, final)
+
+    processes = get_network_config()['processes']
+    if processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print("LOOKUP_PROCESSES needs the fork start method, which this platform lacks; using one process.")
+        processes = 1
+
+    with ExitStack() as stack:
+        # Forked first, before the jobs and metrics start their threads
+        pool = stack.enter_context(LookupProcesses(processes, build_lookups, build_result_row, item_key)) if processes > 1 else None
+        for job in jobs:
+            stack.enter_context(job)
+
+        totals = [job.total for job in jobs]
+        metrics = RunMetrics(total_rows=None if None in totals else sum(totals))
+        metrics.add_rows(sum(job.writer.rows_restored for job in jobs))
+        stack.enter_context(metrics)
+
+        def on_row(row, key, final):
+            metrics.add_rows(write(row, key, final))
+
+        if pool:
+            pool.run(items(), on_row, metrics)
+        else:
+            run_lookups(items(), build_lookups, build_result_row, on_row, item_key=item_key, metrics=metrics)
+
+    return [job.summary() for job in jobs]
+
+def run_lookup_job(items, build_lookups, build_result_row, output_file, header, item_key, run_name, column_types=None):
+    """
+    Run the lookups for every item and write the result rows to output_file
+    (see LookupJob for resuming and de-duplication).
+
+    Args:
+        items: Iterable of input items, consumed lazily
+        build_lookups: Function returning the (api_name, url) pairs for an item
+        build_result_row: Function turning an item and its responses into an output row
+        output_file: Path of the output file (CSV, or Parquet with OUTPUT_FORMAT=parquet)
+        header: Output header
+        item_key: Function returning the ID of an item
+        run_name: Name identifying the run (e.g. script and input file)
+        column_types: Parquet types of non-text columns, e.g. {"status_code": "int64"}
+
+    Returns:
+        LookupSummary with the number of items processed, restored and failed
+    """
+    job = LookupJob(items, build_lookups, build_result_row, output_file, header, item_key, run_name, column_types)
+    return run_lookup_jobs([job])[0]
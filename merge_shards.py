@@ -0,0 +1,263 @@
+"""
+Merge tool for lookups split across hosts with SHARD_INDEX / SHARD_COUNT.
+
+Every host runs the same script on the same input with its own
+SHARD_INDEX and writes 'output/api_responses.shard-<index>-of-<count>.csv'.
+Once the shard files are copied into one directory, this tool combines them
+into a single 'output/api_responses.csv' (CSV, compressed CSV or Parquet,
+like the shards). Shards are always concatenated in shard order, so the
+merged file depends only on the shard files, not on the order they arrived.
+
+Given the input file, it also reports every ID that has no row in any
+shard and writes those IDs to a file that can be fed back to the script.
+
+Usage:
+    python merge_shards.py                                            # merge output/api_responses.shard-*
+    python merge_shards.py --input assets/refund_ids.txt              # ... and report IDs missing from all shards
+    python merge_shards.py output/recon.shard-*-of-4.csv.gz --input assets/rows.csv --id-column Payment_Transaction_Id
+
+Exit status: 0 when every shard (and every input ID) is present, 1 if
+shards or IDs are missing, 2 for invalid arguments.
+"""
+
+import argparse
+import csv
+import glob
+import os
+import re
+import sys
+from array import array
+from utils import (get_output_file, get_asset_file_path, open_file, strip_compression, id_hash, iter_ids,
+                   CompactIdSet)
+from constants import DEFAULT_PATHS
+
+# ================================================================
+# CONFIGURATION
+# ================================================================
+
+# Shard output files: <name>.shard-<index>-of-<count>.<csv|parquet>[.gz|.zst]
+SHARD_FILE_PATTERN = re.compile(r'^(?P<base>.+)\.shard-(?P<index>\d+)-of-(?P<count>\d+)(?P<extension>\.(csv|parquet)(\.gz|\.zst)?)$')
+
+# Missing IDs listed on screen (all of them are written to the missing IDs file)
+MISSING_IDS_SHOWN = 10
+
+# ================================================================
+# SCRIPT LOGIC
+# ================================================================
+
+def find_shard_files(paths=None):
+    """
+    Group shard files by run and check that they belong to one sharded run.
+
+    Args:
+        paths: Shard files (default: the shards of output/api_responses)
+
+    Returns:
+        (merged output path, shard count, dict mapping shard index to file)
+
+    Raises:
+        ValueError: if no shard files are found or they come from different runs
+    """
+    if not paths:
+        root, extension = os.path.splitext(strip_compression(get_output_file(DEFAULT_PATHS['output_responses'])))
+        paths = sorted(glob.glob(f"{root}.shard-*-of-*{extension}*"))
+    if not paths:
+        raise ValueError("No shard files found. Pass the shard files to merge, "
+                         "e.g. output/api_responses.shard-*-of-4.csv")
+
+    runs = set()
+    shards = {}
+    for path in paths:
+        match = SHARD_FILE_PATTERN.match(path)
+        if not match:
+            raise ValueError(f"'{path}' is not a shard file (<name>.shard-<index>-of-<count>.csv).")
+        runs.add((match['base'], int(match['count']), match['extension']))
+        shards[int(match['index'])] = path
+    if len(runs) > 1:
+        raise ValueError(f"The shard files come from {len(runs)} different runs (name, shard count or format); "
+                         f"merge one run at a time.")
+    base, count, extension = runs.pop()
+    return f"{base}{extension}", count, dict(sorted(shards.items()))
+
+def _csv_rows(path):
+    """
+    Returns:
+        (header, iterator of rows) of a CSV shard
+    """
+    f = open_file(path, newline='')
+    reader = csv.reader(f)
+
+    def rows():
+        with f:
+            yield from reader
+    return next(reader, None), rows()
+
+def merge_csv(shards, output_path, id_hashes):
+    """
+    Concatenate CSV shards (compressed as their extension says) into output_path,
+    collecting the hash of each row's first column in id_hashes.
+
+    Returns:
+        Number of rows written
+    """
+    rows_written = 0
+    header = None
+    with open_file(output_path, 'w', newline='') as output:
+        writer = csv.writer(output)
+        for index, path in shards.items():
+            shard_header, rows = _csv_rows(path)
+            if header is None:
+                header = shard_header
+                writer.writerow(header)
+            elif shard_header != header:
+                rows.close()
+                raise ValueError(f"Shard {index} ('{path}') has a different header: {shard_header} instead of {header}.")
+            for row in rows:
+                writer.writerow(row)
+                if row:
+                    id_hashes.append(id_hash(row[0]))
+                rows_written += 1
+    return rows_written
+
+def merge_parquet(shards, output_path, id_hashes):
+    """
+    Concatenate Parquet shards into output_path batch by batch, collecting the
+    hash of each row's first column in id_hashes.
+
+    Returns:
+        Number of rows written
+    """
+    from parquet_output import require_pyarrow, ParquetTableWriter
+    pa = require_pyarrow()
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for index, path in shards.items():
+            shard = pq.ParquetFile(path)
+            if writer is None:
+                writer = ParquetTableWriter(output_path, shard.schema_arrow)
+            elif not shard.schema_arrow.equals(writer.schema):
+                raise ValueError(f"Shard {index} ('{path}') has different columns: {shard.schema_arrow.names} "
+                                 f"instead of {writer.schema.names}.")
+            for batch in shard.iter_batches():
+                writer.write(pa.Table.from_batches([batch]))
+                id_hashes.extend(id_hash(str(value)) for value in batch.column(0).to_pylist() if value is not None)
+    finally:
+        if writer is not None:
+            writer.close()
+    return writer.rows_written
+
+def read_input_ids(input_file, id_column=None, first_output_column=None):
+    """
+    Lazily read the IDs of the input file: one per line, or for a CSV the
+    values of id_column (default: the column named like the first output column).
+    """
+    with open_file(input_file, newline='') as f:
+        if not strip_compression(input_file).endswith('.csv'):
+            yield from iter_ids(f)
+            return
+        reader = csv.DictReader(f)
+        column = id_column or first_output_column
+        if column not in (reader.fieldnames or []):
+            raise ValueError(f"Column '{column}' not found in '{input_file}'. Use --id-column to name the input "
+                             f"column holding the IDs of the first output column. Available columns: {reader.fieldnames}")
+        for row in reader:
+            if row[column]:
+                yield row[column].strip()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge the per-shard outputs of a sharded lookup run into one file.")
+    parser.add_argument('shards', nargs='*', help="Shard files (default: output/api_responses.shard-*)")
+    parser.add_argument('--output', help="Merged output file (default: the shard name without '.shard-<i>-of-<n>')")
+    parser.add_argument('--input', help="Input file of the run, to report IDs missing from every shard (.txt or .csv)")
+    parser.add_argument('--id-column', help="CSV input: column holding the IDs of the first output column")
+    parser.add_argument('--missing', default=f"{DEFAULT_PATHS['output_dir']}/missing_ids.txt",
+                        help="File the missing IDs are written to (default: output/missing_ids.txt)")
+    return parser.parse_args()
+
+def main():
+    """
+    Main function to merge the shard files and report missing shards and IDs.
+    """
+    args = parse_args()
+
+    try:
+        output_path, shard_count, shards = find_shard_files(args.shards)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 2
+    output_path = args.output or output_path
+    if output_path in shards.values():
+        print("Error: The merged output must not be one of the shard files.")
+        return 2
+    input_file = None
+    if args.input:
+        input_file = args.input if os.path.isfile(args.input) else get_asset_file_path(args.input)
+        if not os.path.isfile(input_file):
+            print(f"Error: The input file '{args.input}' was not found.")
+            return 2
+
+    complete = True
+    missing_shards = [index for index in range(shard_count) if index not in shards]
+    if missing_shards:
+        complete = False
+        print(f"Warning: {len(missing_shards)} of {shard_count} shards have no output file: "
+              f"{', '.join(str(index) for index in missing_shards)}.")
+    for index, path in shards.items():
+        # The journal is removed once a shard's run has finished without failed lookups
+        if os.path.exists(f"{path}.journal"):
+            complete = False
+            print(f"Warning: Shard {index} has not finished ('{path}.journal' exists); "
+                  f"re-run it on its host to retry its failed or missing lookups.")
+
+    print(f"Merging {len(shards)} shard(s) into '{output_path}'...")
+    id_hashes = array('Q')
+    try:
+        if strip_compression(output_path).endswith('.parquet') != strip_compression(next(iter(shards.values()))).endswith('.parquet'):
+            raise ValueError("The merged output must have the format of the shards (.csv or .parquet).")
+        if strip_compression(output_path).endswith('.parquet'):
+            rows_written = merge_parquet(shards, output_path, id_hashes)
+        else:
+            rows_written = merge_csv(shards, output_path, id_hashes)
+    except (ValueError, ImportError) as e:
+        print(f"Error: {e.args[0] if e.args else e}")
+        return 2
+    print(f"{rows_written:,} rows written to '{output_path}'.")
+
+    if input_file:
+        found = CompactIdSet(id_hashes)
+        del id_hashes
+        if strip_compression(output_path).endswith('.parquet'):
+            import pyarrow.parquet as pq
+            first_output_column = pq.read_schema(output_path).names[0]
+        else:
+            with open_file(output_path, newline='') as f:
+                first_output_column = next(csv.reader(f))[0]
+
+        missing = {}
+        try:
+            for value in read_input_ids(input_file, args.id_column, first_output_column):
+                if value not in missing and not found.contains_id(value):
+                    missing[value] = None
+        except ValueError as e:
+            print(f"Error: {e}")
+            return 2
+
+        if missing:
+            complete = False
+            directory = os.path.dirname(args.missing)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(args.missing, 'w', encoding='utf-8') as f:
+                f.writelines(f"{value}\n" for value in missing)
+            shown = list(missing)[:MISSING_IDS_SHOWN]
+            print(f"{len(missing):,} IDs of '{input_file}' are missing from every shard "
+                  f"(e.g. {', '.join(shown)}); all of them were written to '{args.missing}'.")
+        else:
+            print(f"Every ID of '{input_file}' has a row in the merged output.")
+
+    return 0 if complete else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""
+Run metrics for PhonePe API scripts.
+Latency histograms, status counters and throughput for the lookups of a run, with a periodic progress line.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from utils import get_metrics_config
+
+class LatencyHistogram:
+    """
+    Latency histogram with logarithmic buckets (10% wide, 0.5 ms to 2 min),
+    so percentiles cost a fixed amount of memory however many requests are
+    recorded, with at most 10% error.
+    """
+
+    # Upper bounds of the buckets in seconds; the last bucket takes everything slower
+    _BOUNDS = [0.0005 * 1.1 ** index for index in range(int(math.log(120 / 0.0005, 1.1)) + 2)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self._BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        self.counts[bisect_left(self._BOUNDS, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def merge(self, other):
+        """
+        Add the latencies recorded by another histogram (e.g. of another process).
+        """
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """
+        Returns:
+            Upper bound in seconds of the latency below which `fraction` of requests fall
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._BOUNDS[index], self.max) if index < len(self._BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        """
+        Latency summary in milliseconds.
+        """
+        return {
+            'p50': round(self.percentile(0.50) * 1000, 1),
+            'p95': round(self.percentile(0.95) * 1000, 1),
+            'p99': round(self.percentile(0.99) * 1000, 1),
+            'max': round(self.max * 1000, 1),
+            'mean': round(self.total / self.count * 1000, 1) if self.count else 0.0
+        }
+
+class RequestStats:
+    """
+    Latency histogram and status counters of one service or endpoint.
+    Statuses are HTTP status codes, 'timeout', 'connection', 'failed', 'cached' or
+    'circuit_open' (not sent: the service's circuit breaker was open).
+    """
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.statuses = Counter()
+
+    def record(self, latency, status):
+        self.statuses[status] += 1
+        if latency is not None:
+            self.latency.record(latency)
+
+    def merge(self, other):
+        self.statuses.update(other.statuses)
+        self.latency.merge(other.latency)
+
+    def summary(self):
+        return {
+            'requests': self.latency.count,
+            'latency_ms': self.latency.summary(),
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items(), key=lambda entry: str(entry[0]))}
+        }
+
+class RunMetrics:
+    """
+    Metrics of one lookup run, shared by all of its workers.
+
+    Records every lookup per service and per endpoint (api name), counts
+    output rows for progress and ETA, prints a progress line at most every
+    `progress_interval` seconds from a background thread, and writes a
+    JSON metrics file when the run ends.
+
+    Usage:
+        with RunMetrics(total_rows) as metrics:
+            metrics.record(service, api_name, latency, response)
+            metrics.add_rows(1)
+    """
+
+    def __init__(self, total_rows=None, progress_interval=None, path=None):
+        metrics_config = get_metrics_config()
+        self.total_rows = total_rows
+        self.progress_interval = progress_interval if progress_interval is not None else metrics_config['progress_interval']
+        self.path = path if path is not None else metrics_config['path']
+        self.rows_done = 0
+        self._rows_at_start = 0
+        self.services = {}
+        self.endpoints = {}
+        self._lock = threading.Lock()
+        self._started = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._last_report = (0.0, 0)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._started = time.monotonic()
+        self._rows_at_start = self.rows_done
+        self._last_report = (self._started, 0)
+        if self.progress_interval > 0:
+            self._thread = threading.Thread(target=self._report_loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the progress line, print the final one and write the metrics file.
+        """
+        if self._started is None:
+            return
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        # The final line shows the request rate of the whole run
+        self._last_report = (self._started, 0)
+        print(self.progress_line())
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.summary(), f, indent=2)
+            print(f"Run metrics written to '{self.path}'.")
+        self._started = None
+
+    def record(self, service, api_name, latency, response, cached=False):
+        """
+        Record one lookup.
+
+        Args:
+            service: Service the request went to
+            api_name: Endpoint (key of get_api_config())
+            latency: Seconds the request took (ignored for cached responses;
+                None for requests refused by a circuit breaker)
+            response: FetchResult of the request
+            cached: True if the response came from the response cache
+        """
+        status = 'cached' if cached else (response.error or response.status_code)
+        latency = None if cached else latency
+        with self._lock:
+            for stats, key in ((self.services, service), (self.endpoints, api_name)):
+                if key not in stats:
+                    stats[key] = RequestStats()
+                stats[key].record(latency, status)
+
+    def take_stats(self):
+        """
+        Take the stats recorded since the last call, leaving this object empty
+        (a lookup process sends them to the parent's metrics with merge_stats).
+
+        Returns:
+            (stats per service, stats per endpoint)
+        """
+        with self._lock:
+            stats = (self.services, self.endpoints)
+            self.services = {}
+            self.endpoints = {}
+        return stats
+
+    def merge_stats(self, services, endpoints):
+        """
+        Add stats taken from another RunMetrics (see take_stats).
+        """
+        with self._lock:
+            for stats, other in ((self.services, services), (self.endpoints, endpoints)):
+                for key, other_stats in other.items():
+                    if key not in stats:
+                        stats[key] = RequestStats()
+                    stats[key].merge(other_stats)
+
+    def add_rows(self, count):
+        """
+        Count output rows as done (for progress and ETA).
+        """
+        with self._lock:
+            self.rows_done += count
+
+    def requests(self):
+        return sum(stats.latency.count for stats in self.services.values())
+
+    def progress_line(self):
+        """
+        One-line progress report: rows, request rate, per-service latency, errors and ETA.
+        """
+        now = time.monotonic()
+        with self._lock:
+            rows_done = self.rows_done
+            requests = self.requests()
+            errors = sum(count for stats in self.services.values()
+                         for status, count in stats.statuses.items()
+                         if status not in ('cached', 'circuit_open') and (isinstance(status, str) or status >= 400))
+            held = sum(stats.statuses['circuit_open'] for stats in self.services.values())
+            services = [(service, stats.latency.percentile(0.50), stats.latency.percentile(0.99))
+                        for service, stats in sorted(self.services.items()) if stats.latency.count]
+
+        last_time, last_requests = self._last_report
+        self._last_report = (now, requests)
+        rate = (requests - last_requests) / (now - last_time) if now > last_time else 0.0
+
+        elapsed = now - self._started
+        parts = [f"[{_format_duration(elapsed)}]"]
+        if self.total_rows:
+            parts.append(f"{rows_done:,}/{self.total_rows:,} rows ({100.0 * rows_done / self.total_rows:.1f}%)")
+        else:
+            parts.append(f"{rows_done:,} rows")
+        parts.append(f"{rate:,.0f} req/s")
+        parts.extend(f"{service} p50 {p50 * 1000:.0f}ms p99 {p99 * 1000:.0f}ms" for service, p50, p99 in services)
+        parts.append(f"{errors:,} errors")
+        if held:
+            parts.append(f"{held:,} refused by open circuits")
+        # ETA from the rows done in this run (rows restored from a previous run took no time)
+        rows_this_run = rows_done - self._rows_at_start
+        if self.total_rows and rows_this_run > 0 and not self._stopped.is_set():
+            remaining = max(0, self.total_rows - rows_done)
+            parts.append(f"ETA {_format_duration(remaining * elapsed / rows_this_run)}")
+        return " | ".join(parts)
+
+    def summary(self):
+        """
+        Metrics of the run as a JSON-serializable dict.
+        """
+        elapsed = time.monotonic() - self._started
+        with self._lock:
+            requests = self.requests()
+            return {
+                'duration_s': round(elapsed, 3),
+                'rows': {'done': self.rows_done, 'total': self.total_rows},
+                'requests': requests,
+                'requests_per_second': round(requests / elapsed, 1) if elapsed else 0.0,
+                'services': {service: stats.summary() for service, stats in sorted(self.services.items())},
+                'endpoints': {api_name: stats.summary() for api_name, stats in sorted(self.endpoints.items())}
+            }
+
+    def _report_loop(self):
+        while not self._stopped.wait(self.progress_interval):
+            print(self.progress_line(), flush=True)
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
@@ -0,0 +1,234 @@
+"""
+Local stand-in for Hermes, Refund Orchestrator and Payment Service.
+
+Serves the routes of API_ENDPOINTS over plain HTTP, one port per service,
+with configurable latency, error rate and payload size, so the lookup
+scripts can be exercised (see benchmark.py) without touching production.
+
+Usage:
+    python mock_server.py                    # baseline profile
+    python mock_server.py --profile degraded
+
+Then point a script at it with the printed environment variables.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import socket
+import threading
+import time
+from http import HTTPStatus
+from constants import API_BASE_URLS, API_ENDPOINTS
+
+# ================================================================
+# CONFIGURATION
+# ================================================================
+
+# Server behaviour per profile. Latency is log-normal: half of the requests
+# take less than median_ms, and sigma widens the tail (p99 is about
+# median_ms * e^(2.33 * sigma)). A fraction error_rate of the requests fails
+# with HTTP 503. Every 200 body is padded to about payload_bytes.
+# "services" overrides any of these for one service.
+MOCK_PROFILES = {
+    "fast": {
+        "latency_ms": {"median": 2, "sigma": 0.2},
+        "error_rate": 0.0,
+        "payload_bytes": 256
+    },
+    "baseline": {
+        "latency_ms": {"median": 20, "sigma": 0.5},
+        "error_rate": 0.01,
+        "payload_bytes": 1024
+    },
+    "degraded": {
+        "latency_ms": {"median": 80, "sigma": 1.0},
+        "error_rate": 0.05,
+        "payload_bytes": 4096,
+        "services": {
+            "payment_service": {"latency_ms": {"median": 250, "sigma": 1.0}, "error_rate": 0.1}
+        }
+    }
+}
+
+# Body of a successful response per endpoint, shaped like the real service's
+RESPONSE_BODIES = {
+    ("hermes", "accounting_event_details"): lambda: {"success": True, "data": {"reconciliationState": "RECONCILED"}},
+    ("hermes", "db_status_check"): lambda: {"success": True, "message": "PAYMENT_SUCCESS"},
+    ("hermes", "refunds_housekeeping"): lambda: {"success": True, "state": "COMPLETED"},
+    ("refund_orchestrator", "accounting_events"): lambda: {"success": True, "data": [{"eventType": "MERCHANT_FULFILMENT_REVERSAL", "state": "COMPLETED"}]},
+    ("payment_service", "housekeeping_debug"): lambda: {"success": True, "data": {"executionState": "COMPLETED"}},
+    ("payment_service", "housekeeping_debug_with_id"): lambda: {"success": True, "data": {"executionState": "COMPLETED"}},
+}
+
+# ================================================================
+# SERVER
+# ================================================================
+
+def get_service_profile(profile, service):
+    """
+    Merge the per-service overrides of a profile into its defaults.
+    """
+    settings = {key: value for key, value in profile.items() if key != 'services'}
+    settings.update(profile.get('services', {}).get(service, {}))
+    return settings
+
+class _ServiceMock:
+    """
+    One mocked service: a minimal HTTP/1.1 keep-alive server on asyncio,
+    so thousands of concurrent connections cost one coroutine each.
+    """
+
+    def __init__(self, service, settings):
+        self.service = service
+        self.settings = settings
+        self.padding = "x" * max(0, settings['payload_bytes'] - 100)
+        # Longest path first, so '/v1/housekeeping/debug/' wins over '/v1/housekeeping/debug'
+        self.routes = sorted(((path.rstrip('/'), endpoint) for endpoint, path in API_ENDPOINTS.get(service, {}).items()),
+                             key=lambda route: len(route[0]), reverse=True)
+        self.server = None
+        self.port = None
+        self.connections = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve_connection, '127.0.0.1', 0, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """
+        Stop accepting connections and end the open keep-alive connections.
+        """
+        self.server.close()
+        connections = list(self.connections)
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def match_route(self, path):
+        # The IDs follow the endpoint path with or without a '/': payments_transactions_v1
+        # appends them directly, e.g. '/v1/housekeeping/dbM0001/MT000000001'
+        for prefix, endpoint in self.routes:
+            if path.startswith(prefix):
+                return endpoint
+        return None
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                path = head.split(b' ', 2)[1].decode('latin-1')
+                status_code, body = await self._handle(path.split('?', 1)[0])
+                payload = json.dumps(body).encode('utf-8')
+                writer.write(
+                    f"HTTP/1.1 {status_code} {HTTPStatus(status_code).phrase}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode('latin-1')
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # Cancelled by stop(); end normally, as asyncio streams expect of a connection handler
+            pass
+        finally:
+            writer.close()
+            self.connections.discard(task)
+
+    async def _handle(self, path):
+        endpoint = self.match_route(path)
+        if endpoint is None:
+            return 404, {"success": False, "message": "No such route"}
+
+        latency = self.settings['latency_ms']
+        await asyncio.sleep(latency['median'] * math.exp(random.gauss(0.0, latency['sigma'])) / 1000.0)
+
+        if random.random() < self.settings['error_rate']:
+            return 503, {"success": False, "message": "Service unavailable"}
+
+        body = RESPONSE_BODIES.get((self.service, endpoint), lambda: {"success": True})()
+        body["padding"] = self.padding
+        return 200, body
+
+class MockApiServer:
+    """
+    Mock of every service in API_BASE_URLS, each on its own local port,
+    served from an event loop on a background thread.
+
+    Usage:
+        with MockApiServer('baseline') as mock:
+            env = mock.environment()   # HERMES_BASE_URL=http://127.0.0.1:..., ...
+    """
+
+    def __init__(self, profile='baseline'):
+        if isinstance(profile, str):
+            if profile not in MOCK_PROFILES:
+                raise ValueError(f"Unknown mock profile '{profile}'. Use one of: {', '.join(MOCK_PROFILES)}.")
+            profile = MOCK_PROFILES[profile]
+        self.profile = profile
+        self.services = {}
+        self._loop = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        for service in API_BASE_URLS:
+            mock = _ServiceMock(service, get_service_profile(self.profile, service))
+            asyncio.run_coroutine_threadsafe(mock.start(), self._loop).result()
+            self.services[service] = mock
+
+    def stop(self):
+        if self._loop is None:
+            return
+        for mock in self.services.values():
+            asyncio.run_coroutine_threadsafe(mock.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self.services = {}
+
+    def environment(self):
+        """
+        Environment variables pointing the scripts at the mock.
+        """
+        env = {f"{service.upper()}_BASE_URL": f"http://127.0.0.1:{mock.port}"
+               for service, mock in self.services.items()}
+        env['USE_PROXY'] = '0'
+        return env
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local mock of the PhonePe services.")
+    parser.add_argument('--profile', default='baseline', choices=list(MOCK_PROFILES), help="Latency/error profile")
+    args = parser.parse_args()
+
+    with MockApiServer(args.profile) as mock:
+        print(f"Mock services running with the '{args.profile}' profile. Export these to use them:")
+        for name, value in mock.environment().items():
+            print(f"export {name}={value}")
+        print("Press Ctrl+C to stop.", flush=True)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Parquet output for the lookup scripts, filter_mids.py and split_large_files.py.
+Rows are written as typed, compressed columns in row groups as they arrive, so the output never has to fit in memory.
+"""
+
+import io
+import os
+from utils import get_output_config, open_file
+
+# Bytes read from the start of a CSV to infer its column types
+SCHEMA_SAMPLE_SIZE = 4 * 1024 * 1024
+
+# Column types a result writer can be given
+ROW_TYPES = ('string', 'int64', 'float64')
+
+def require_pyarrow():
+    """
+    Import pyarrow, with a clear message when Parquet output is asked for without it.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401 (loads the Parquet module)
+    except ImportError:
+        raise ImportError("OUTPUT_FORMAT=parquet needs pyarrow. Install it with: pip install pyarrow") from None
+    return pyarrow
+
+def _read_csv(data, column_types=None):
+    import pyarrow.csv as pacsv
+    return pacsv.read_csv(
+        io.BytesIO(data),
+        read_options=pacsv.ReadOptions(use_threads=False),
+        convert_options=pacsv.ConvertOptions(column_types=column_types, strings_can_be_null=False,
+                                             quoted_strings_can_be_null=False)
+    )
+
+def infer_csv_schema(source_file, header, data_start, infer_types=True):
+    """
+    Column types for a CSV, inferred by pyarrow from the first few MB of rows.
+
+    Numbers with leading zeros or 16+ digits (IDs, account numbers) and empty
+    columns stay text, so converting never changes a value. With infer_types
+    False every column is text.
+
+    Args:
+        source_file: Path of the CSV (may be compressed)
+        header: Header line as the parser should see it (see parser_header)
+        data_start: Offset of the first data line
+
+    Returns:
+        pyarrow Schema
+    """
+    pa = require_pyarrow()
+    import pyarrow.compute as pc
+
+    with open_file(source_file, 'rb') as f:
+        f.read(data_start)
+        sample = f.read(SCHEMA_SAMPLE_SIZE)
+        if sample and not sample.endswith(b'\n'):
+            sample += f.readline()
+    names = _read_csv(header).column_names
+    text = _read_csv(header + sample, column_types={name: pa.string() for name in names})
+    if not infer_types or not sample:
+        return text.schema
+
+    fields = []
+    for field in _read_csv(header + sample).schema:
+        column = text.column(field.name)
+        if pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        elif (pa.types.is_integer(field.type) or pa.types.is_floating(field.type)) and (
+                pc.any(pc.match_substring_regex(column, r'^\s*[+-]?0\d|\d{16}')).as_py()):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+def csv_table(header, data, schema):
+    """
+    Parse a block of CSV lines (without header) into a table with the given schema.
+
+    Raises:
+        ValueError: if a value does not fit the type of its column
+    """
+    import pyarrow as pa
+    try:
+        return _read_csv(header + data, column_types=dict(zip(schema.names, schema.types))).select(schema.names)
+    except pa.ArrowInvalid as e:
+        raise ValueError(f"A value does not match the column types inferred from the start of the file ({e}). "
+                         f"Set PARQUET_INFER_TYPES=0 to write every column as text.") from None
+
+class ParquetTableWriter:
+    """
+    Writes tables to a Parquet file in row groups of `row_group_rows` rows.
+
+    Tables are collected until a row group is full, so small tables (one
+    byte range's matches, one batch of results) still make large row groups.
+    The file is only readable once it is closed.
+
+    Usage:
+        with ParquetTableWriter(path, schema) as writer:
+            writer.write(table)
+    """
+
+    def __init__(self, path, schema, config=None):
+        pa = require_pyarrow()
+        import pyarrow.parquet as pq
+
+        config = config or get_output_config()
+        compression = config['parquet_compression']
+        self.path = path
+        self.schema = schema
+        self.row_group_rows = config['parquet_row_group_rows']
+        self.rows_written = 0
+        self._pa = pa
+        self._pending = []
+        self._pending_rows = 0
+        self._writer = pq.ParquetWriter(path, schema, compression=None if compression == 'none' else compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, table):
+        if not table.num_rows:
+            return
+        self._pending.append(table)
+        self._pending_rows += table.num_rows
+        self.rows_written += table.num_rows
+        if self._pending_rows >= self.row_group_rows:
+            self._write_pending(whole_groups_only=True)
+
+    def _write_pending(self, whole_groups_only=False):
+        table = self._pa.concat_tables(self._pending)
+        rows = table.num_rows - table.num_rows % self.row_group_rows if whole_groups_only else table.num_rows
+        if rows:
+            self._writer.write_table(table.slice(0, rows), row_group_size=self.row_group_rows)
+        self._pending = [table.slice(rows)] if rows < table.num_rows else []
+        self._pending_rows = table.num_rows - rows
+
+    def close(self):
+        if self._writer is None:
+            return
+        if self._pending_rows:
+            self._write_pending()
+        self._writer.close()
+        self._writer = None
+
+class ParquetRowWriter:
+    """
+    Writes result rows (lists matching a header) to a Parquet file, with the
+    same writerow / flush / close interface as the result writer's CSV output.
+
+    Columns are text unless column_types says otherwise (e.g.
+    {"status_code": "int64"}); a value that is not a number of that type
+    (such as "Error" for a failed request) is stored as null.
+    """
+
+    def __init__(self, path, header, column_types=None, config=None):
+        pa = require_pyarrow()
+        column_types = column_types or {}
+        unknown = set(column_types.values()) - set(ROW_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown column type(s) {sorted(unknown)}. Use one of: {', '.join(ROW_TYPES)}.")
+
+        self.types = [column_types.get(name, 'string') for name in header]
+        self.schema = pa.schema([(name, pa.type_for_alias(column_type)) for name, column_type in zip(header, self.types)])
+        self._writer = ParquetTableWriter(path, self.schema, config)
+        self._pa = pa
+        self._rows = []
+
+    def writerow(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self._writer.row_group_rows:
+            self._write_rows()
+
+    def _write_rows(self):
+        columns = [[_convert(row[index] if index < len(row) else None, column_type) for row in self._rows]
+                   for index, column_type in enumerate(self.types)]
+        self._writer.write(self._pa.Table.from_arrays(
+            [self._pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+        self._rows = []
+
+    def flush(self, fsync=False):
+        # Rows are buffered until a row group is full; an interrupted run is rebuilt from its journal
+        pass
+
+    def close(self, fsync=False):
+        if self._rows:
+            self._write_rows()
+        self._writer.close()
+        if fsync:
+            fd = os.open(self._writer.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+def _convert(value, column_type):
+    """
+    A row value as the column type, or None if it is not one.
+    """
+    if value is None:
+        return None
+    if column_type == 'string':
+        return value if isinstance(value, str) else str(value)
+    try:
+        if isinstance(value, bool):
+            return None
+        return int(value) if column_type == 'int64' else float(value)
+    except (TypeError, ValueError):
+        return None
@@ -1,115 +1,114 @@
-import requests
 import json
-import threading
 import csv
 import sys
-from concurrent.futures import ThreadPoolExecutor
-from utils import setup_proxy, get_headers, disable_ssl_warnings, get_network_config, get_api_config, ensure_output_dir
+from utils import setup_proxy, disable_ssl_warnings, get_api_config, show_available_assets, get_asset_file_path, ensure_output_dir, get_http_session, InputItems, log_verbose, get_output_file, get_shard_output_file, open_file
+from lookup_engine import run_lookup_job, process_item, fetch_lookup
 from constants import DEFAULT_PATHS, DEFAULTS
 
-# ================================================================
-# INITIALIZATION
-# ================================================================
-
-# Setup proxy and disable SSL warnings
-if not setup_proxy():
-    sys.exit(1)
-
-disable_ssl_warnings()
-
 # ================================================================
 # CONFIGURATION
 # ================================================================
 
-# Show available CSV files and let user choose
-from utils import show_available_assets, get_asset_file_path
-
-print("Payments Transactions Processing")
-print("===============================")
-
-show_available_assets(['.csv'])
-
-input_filename = input("Please enter the input CSV file name (e.g., 'input_data.csv'): ").strip()
-
-# Get the full path to the input file
-INPUT_FILE = get_asset_file_path(input_filename) if input_filename else DEFAULT_PATHS['input_data']
-OUTPUT_FILE = DEFAULT_PATHS['output_responses']
+# CSV, or Parquet with OUTPUT_FORMAT=parquet; one file per shard with SHARD_COUNT
+OUTPUT_FILE = get_shard_output_file(get_output_file(DEFAULT_PATHS['output_responses']))
 
-# Get API configuration and network settings
+# Get API configuration
 API_CONFIG = get_api_config()
-HEADERS = get_headers()
-network_config = get_network_config()
-MAX_WORKERS = network_config['max_workers']
 
 # ================================================================
 # SCRIPT LOGIC
 # ================================================================
 
-# Shared list to store results and a lock for thread-safe appends
-results = []
-lock = threading.Lock()
-
-def make_api_call(service_name, id1, id2=None):
+def build_api_call_url(service_name, id1, id2=None):
     """
-    Makes a single API call and returns the parsed response.
-    This is a helper function.
+    Builds the URL for a single API call based on the service name.
+    Returns None for an unknown service.
     """
-    url = ""
-    # --- Step 1: Configure the API call based on the service name ---
     if service_name == "hermes_status_check":
         base_url = API_CONFIG[service_name]["base_url"]
-        url = f"{base_url}{id1}/{id2}" # Uses merchant_id and merchant_txn_id
+        return f"{base_url}{id1}/{id2}" # Uses merchant_id and merchant_txn_id
 
     elif service_name == "payments_debug":
         base_url = API_CONFIG[service_name]["base_url"]
         endpoint_suffix = API_CONFIG[service_name]["endpoint_suffix"]
-        url = f"{base_url}{id1}{endpoint_suffix}" # Uses payment_id
+        return f"{base_url}{id1}{endpoint_suffix}" # Uses payment_id
 
-    else:
-        return DEFAULTS['unknown_service']
+    return None
 
-    try:
-        # --- Step 2: Make the API request ---
-        response = requests.get(url, headers=HEADERS, verify=False, timeout=network_config['timeout'])
-
-        if response.status_code == 200:
-            try:
-                data = response.json()
-                # --- Step 3: Parse the response differently for each service ---
-                if service_name == "hermes_status_check":
-                    return data.get('message', DEFAULTS['message_not_found'])
-                elif service_name == "payments_debug":
-                    return data.get('data', {}).get('executionState', DEFAULTS['execution_state_not_found'])
-            except json.JSONDecodeError:
-                return DEFAULTS['json_decode_error']
-        else:
-            # For non-200 responses, return the status and error message
-            return f"Error {response.status_code}: {response.text}"
-
-    except (requests.exceptions.RequestException, Exception):
+def parse_api_response(service_name, response):
+    """
+    Parses the response of a single API call differently for each service.
+    """
+    if response.error:
         # Handle network, timeout, or proxy errors
         return DEFAULTS['no_response']
 
-def process_csv_row(row):
+    if response.status_code == 200:
+        try:
+            if service_name == "hermes_status_check":
+                return response.field('message', DEFAULTS['message_not_found'])
+            elif service_name == "payments_debug":
+                return response.field('data.executionState', DEFAULTS['execution_state_not_found'])
+        except json.JSONDecodeError:
+            return DEFAULTS['json_decode_error']
+    else:
+        # For non-200 responses, return the status and error message
+        return f"Error {response.status_code}: {response.text}"
+
+def make_api_call(service_name, id1, id2=None):
     """
-    Processes a single row from the CSV file.
-    It makes two sequential API calls (Hermes, then Payments) and combines the results.
+    Makes a single API call and returns the parsed response.
+    This is a helper function.
+    """
+    url = build_api_call_url(service_name, id1, id2)
+    if url is None:
+        return DEFAULTS['unknown_service']
+    return parse_api_response(service_name, fetch_lookup(service_name, url))
+
+def get_row_key(row):
+    """
+    Returns the IDs of a CSV row joined into one key (used by the progress journal).
+    """
+    return "|".join(row.get(column) or "" for column in ('Merchant ID', 'Merchant Transaction Id', 'Payment Id'))
+
+def build_lookups(row):
+    """
+    Returns the API calls needed for a single row from the CSV file
+    (Hermes and Payments), skipping any call whose IDs are missing.
+    The lookup engine runs them concurrently, each on its own service's workers.
     """
     # Get the required IDs from the row
     merchant_id = row.get('Merchant ID')
     merchant_txn_id = row.get('Merchant Transaction Id')
     payment_id = row.get('Payment Id')
 
-    hermes_response = DEFAULTS['skipped']
-    payments_response = DEFAULTS['skipped']
+    lookups = []
 
     # Call Hermes API if the required IDs are present
     if merchant_id and merchant_txn_id:
-        hermes_response = make_api_call("hermes_status_check", merchant_id, merchant_txn_id)
+        lookups.append(("hermes_status_check", build_api_call_url("hermes_status_check", merchant_id, merchant_txn_id)))
 
     # Call Payments Debug API if the required ID is present
     if payment_id:
-        payments_response = make_api_call("payments_debug", payment_id)
+        lookups.append(("payments_debug", build_api_call_url("payments_debug", payment_id)))
+
+    return lookups
+
+def build_result_row(row, responses):
+    """
+    Combines the Hermes and Payments responses for a single CSV row into an output row.
+    """
+    merchant_txn_id = row.get('Merchant Transaction Id')
+    payment_id = row.get('Payment Id')
+
+    hermes_response = DEFAULTS['skipped']
+    payments_response = DEFAULTS['skipped']
+
+    if "hermes_status_check" in responses:
+        hermes_response = parse_api_response("hermes_status_check", responses["hermes_status_check"])
+
+    if "payments_debug" in responses:
+        payments_response = parse_api_response("payments_debug", responses["payments_debug"])
 
     # Prepare the final output row
     output_row = [
@@ -119,53 +118,79 @@ def process_csv_row(row):
         payments_response
     ]
 
-    # Safely append the result to the shared list
-    with lock:
-        results.append(output_row)
+    log_verbose(f"Processed row for Payment ID: {payment_id or DEFAULTS['not_available']}")
+    return output_row
 
-    print(f"Processed row for Payment ID: {payment_id or DEFAULTS['not_available']}")
+def process_csv_row(row):
+    """
+    Processes a single row from the CSV file.
+    It makes the Hermes and Payments API calls concurrently and returns the combined output row.
+    """
+    return process_item(row, build_lookups, build_result_row)
 
 def main():
     """
     Main function to read a CSV, process each row concurrently,
     and write the combined results to a new file.
     """
-    rows_to_process = []
-    try:
-        with open(INPUT_FILE, mode='r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            # Read all rows into a list to be processed
-            rows_to_process = list(reader)
+    # Setup proxy and disable SSL warnings
+    if not setup_proxy():
+        sys.exit(1)
 
-    except FileNotFoundError:
-        print(f"Error: The input file '{INPUT_FILE}' was not found.")
-        return
-    except KeyError as e:
-        print(f"Error: Missing required column in CSV: {e}. Please ensure columns 'Merchant ID', 'Merchant Transaction Id', and 'Payment Id' exist.")
-        return
+    disable_ssl_warnings()
 
-    if not rows_to_process:
-        print(f"The file '{INPUT_FILE}' is empty or no valid data found. No tasks to process.")
-        return
+    # Show available CSV files and let user choose
+    print("Payments Transactions Processing")
+    print("===============================")
 
-    print(f"Starting to process {len(rows_to_process)} rows...")
+    show_available_assets(['.csv'])
 
-    # Use a thread pool to process each CSV row in parallel
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        executor.map(process_csv_row, rows_to_process)
+    input_filename = input("Please enter the input CSV file name (e.g., 'input_data.csv'): ").strip()
 
-    print("\nAll rows processed. Writing results to file.")
+    # Get the full path to the input file
+    input_file = get_asset_file_path(input_filename) if input_filename else DEFAULT_PATHS['input_data']
+
+    # Create the shared pooled HTTP session up front (fails fast if the token is missing)
+    get_http_session()
+
+    # .gz and .zst inputs are decompressed on the fly
+    try:
+        f = open_file(input_file)
+    except FileNotFoundError:
+        print(f"Error: The input file '{input_file}' was not found.")
+        return
 
     # Ensure output directory exists
     ensure_output_dir()
 
-    # Write the final results to a new CSV file
-    with open(OUTPUT_FILE, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        # Write the new header as requested
-        header = ["Payment Id", "Merchant Transaction Id", "Hermes Response", "Payments Debug Response"]
-        writer.writerow(header)
-        writer.writerows(results)
+    print(f"Starting to process rows from '{input_file}'...")
+
+    # Write the new header as requested
+    header = ["Payment Id", "Merchant Transaction Id", "Hermes Response", "Payments Debug Response"]
+
+    try:
+        with f:
+            # Rows are read lazily and streamed to the workers as they are parsed;
+            # rows repeating the same IDs are looked up once
+            reader = InputItems(f, csv.DictReader)
+            # Process each CSV row in parallel with the selected lookup engine;
+            # result rows are written to the output file as they complete and
+            # an interrupted run resumes from its progress journal
+            summary = run_lookup_job(reader, build_lookups, build_result_row, OUTPUT_FILE, header,
+                                     item_key=get_row_key, run_name=f"payments_transactions_v1:{input_file}")
+    except KeyError as e:
+        print(f"Error: Missing required column in CSV: {e}. Please ensure columns 'Merchant ID', 'Merchant Transaction Id', and 'Payment Id' exist.")
+        return
+
+    if not summary.processed and not summary.restored:
+        print(f"The file '{input_file}' is empty or no valid data found. No tasks to process.")
+        return
+
+    print("\nAll rows processed.")
+    if summary.restored:
+        print(f"{summary.restored} rows were restored from the previous run.")
+    if summary.failed:
+        print(f"{summary.failed} rows had failed lookups and will be retried on the next run.")
 
     # Provide a final confirmation message to the user
     print(f"Results successfully written to '{OUTPUT_FILE}'.")
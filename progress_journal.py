@@ -0,0 +1,118 @@
+"""
+Progress journal for PhonePe API scripts.
+Records every ID that has a final result so an interrupted run can resume where it stopped.
+"""
+
+import json
+import os
+from array import array
+from utils import id_hash, CompactIdSet
+
+class ProgressJournal:
+    """
+    Append-only journal of the IDs that already have a final result.
+
+    Each entry holds an ID and its output row, so a resumed run can rebuild
+    the output file from the journal and skip those IDs. IDs whose lookup
+    failed with a retryable error are never journaled and are retried.
+    The first line names the run; a journal left behind by a different
+    script, input file or output header is discarded instead of resumed.
+
+    File layout:
+        #run<TAB><run name>
+        <id><TAB><output row as JSON>
+    """
+
+    def __init__(self, path, run_name):
+        self.path = path
+        self.run_name = run_name
+        self.completed = CompactIdSet()
+        self._file = None
+
+    def open(self, on_restored_row, resume=True):
+        """
+        Open the journal, restoring the rows of a previous attempt of this run.
+
+        Args:
+            on_restored_row: Callback receiving each output row restored from the journal
+            resume: If False, any existing journal is discarded
+
+        Returns:
+            Number of rows restored
+        """
+        restored = 0
+        if resume and os.path.exists(self.path):
+            restored = self._load(on_restored_row)
+
+        if restored:
+            print(f"Resuming from '{self.path}': {restored} IDs already have a final result. "
+                  f"Set RESUME=0 to start over.")
+            self._file = open(self.path, 'a', encoding='utf-8')
+        else:
+            self._file = open(self.path, 'w', encoding='utf-8')
+            self._file.write(f"#run\t{self.run_name}\n")
+            self._file.flush()
+        return restored
+
+    def _load(self, on_restored_row):
+        hashes = array('Q')
+        valid_size = 0
+
+        with open(self.path, 'rb') as f:
+            first_line = f.readline()
+            if first_line.decode('utf-8', errors='replace').rstrip('\n') != f"#run\t{self.run_name}":
+                print(f"Ignoring '{self.path}': it belongs to a different run.")
+                return 0
+            valid_size = len(first_line)
+
+            for line in f:
+                # A crash can leave a partially written last line behind
+                if not line.endswith(b'\n'):
+                    break
+                key, _, row = line.decode('utf-8').partition('\t')
+                try:
+                    on_restored_row(json.loads(row))
+                except ValueError:
+                    break
+                hashes.append(id_hash(key))
+                valid_size += len(line)
+
+        # Drop any torn tail so new entries start on a clean line
+        with open(self.path, 'r+b') as f:
+            f.truncate(valid_size)
+
+        self.completed = CompactIdSet(hashes)
+        return len(hashes)
+
+    def skip_completed(self, items, item_key):
+        """
+        Lazily yield only the items without a final result in the journal.
+        """
+        if not len(self.completed):
+            yield from items
+            return
+        for item in items:
+            if not self.completed.contains_id(item_key(item)):
+                yield item
+
+    def record(self, entries):
+        """
+        Append (id, row) entries for IDs that reached a final result.
+        """
+        self._file.writelines(f"{key}\t{json.dumps(row)}\n" for key, row in entries)
+
+    def flush(self, fsync=False):
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self, delete=False):
+        """
+        Close the journal, deleting it once the run has nothing left to retry.
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if delete:
+            os.remove(self.path)
@@ -0,0 +1,249 @@
+"""
+Pool of SOCKS5 tunnels for PhonePe API scripts.
+Spreads connections over several SOCKS endpoints, evicts an endpoint whose connections keep failing and brings it back once a health check reaches it again.
+"""
+
+import socket
+import threading
+import time
+from contextlib import asynccontextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from utils import get_proxy_config
+
+class ProxyEndpoint:
+    """
+    One SOCKS5 endpoint and its health.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        # socks5h: host names are resolved by the tunnel, as with the previous global proxy
+        self.url = f"socks5h://{host}:{port}"
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.evicted_until = None
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+class ProxyPool:
+    """
+    Load balancer over SOCKS5 endpoints.
+
+    Every request takes the available endpoint with the fewest requests in
+    flight (in turn when tied). An endpoint is evicted after `max_failures`
+    consecutive failed connections, or when a health check cannot complete
+    a SOCKS5 handshake with it; it is checked again after `eviction_time`
+    seconds and returns to the pool once the check passes. If every endpoint
+    is evicted, requests go to the one due back soonest rather than failing
+    outright.
+
+    Health checks run on a background thread, started with the first
+    request, so a process forked before that inherits no thread.
+
+    Usage:
+        endpoint = pool.acquire()
+        ...connect through endpoint.url...
+        pool.release(endpoint, ok)
+    """
+
+    def __init__(self, endpoints, max_failures, eviction_time, health_check_interval, health_check_timeout):
+        self.endpoints = [ProxyEndpoint(host, port) for host, port in endpoints]
+        self.max_failures = max_failures
+        self.eviction_time = eviction_time
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self._next = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def acquire(self):
+        """
+        Pick the endpoint for a new request.
+
+        Returns:
+            ProxyEndpoint (pass it back to release())
+        """
+        if self._thread is None and self.health_check_interval > 0:
+            self._start_health_checks()
+        with self._lock:
+            available = [endpoint for endpoint in self.endpoints if endpoint.evicted_until is None]
+            if available:
+                count = len(available)
+                start = self._next % count
+                self._next += 1
+                rotated = available[start:] + available[:start]
+                endpoint = min(rotated, key=lambda candidate: candidate.in_flight)
+            else:
+                endpoint = min(self.endpoints, key=lambda candidate: candidate.evicted_until)
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, ok):
+        """
+        Return an endpoint after a request.
+
+        Args:
+            endpoint: The endpoint acquire() returned
+            ok: True if the connection worked, False if it could not be made
+                (counts towards eviction), None if the request failed for
+                another reason (e.g. a read timeout)
+        """
+        with self._lock:
+            endpoint.in_flight -= 1
+            if ok:
+                endpoint.failures = 0
+            elif ok is False:
+                endpoint.failures += 1
+                if endpoint.failures >= self.max_failures and endpoint.evicted_until is None:
+                    self._evict(endpoint, f"after {endpoint.failures} failed connections")
+
+    def check(self, endpoint):
+        """
+        Health check: open a connection and complete a SOCKS5 greeting.
+
+        Returns:
+            True if the endpoint answered like a SOCKS5 proxy without authentication
+        """
+        try:
+            with socket.create_connection((endpoint.host, endpoint.port), timeout=self.health_check_timeout) as sock:
+                sock.sendall(b'\x05\x01\x00')
+                return sock.recv(2) == b'\x05\x00'
+        except OSError:
+            return False
+
+    def check_all(self):
+        """
+        Health-check every endpoint that is due: evict the ones that fail and
+        bring back evicted ones that pass.
+
+        Returns:
+            Number of endpoints available afterwards
+        """
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if endpoint.evicted_until is not None and endpoint.evicted_until > now:
+                continue
+            healthy = self.check(endpoint)
+            with self._lock:
+                if healthy and endpoint.evicted_until is not None:
+                    endpoint.evicted_until = None
+                    endpoint.failures = 0
+                    print(f"SOCKS endpoint {endpoint} passed its health check and is back in the pool.")
+                elif not healthy:
+                    self._evict(endpoint, "after a failed health check")
+        return sum(1 for endpoint in self.endpoints if endpoint.evicted_until is None)
+
+    def _evict(self, endpoint, reason):
+        # Called with the lock held
+        if endpoint.evicted_until is None:
+            print(f"SOCKS endpoint {endpoint} evicted {reason}; checking it again in {self.eviction_time:.0f}s.")
+        endpoint.evicted_until = time.monotonic() + self.eviction_time
+
+    def _start_health_checks(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._health_check_loop, daemon=True)
+            self._thread.start()
+
+    def _health_check_loop(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            self.check_all()
+
+class ProxyPoolAdapter(HTTPAdapter):
+    """
+    requests adapter that sends every request through an endpoint of a
+    ProxyPool. urllib3 keeps a separate connection pool per endpoint, so
+    kept-alive connections stay on their tunnel; only the sessions this
+    adapter is mounted on are proxied.
+    """
+
+    def __init__(self, proxy_pool, **kwargs):
+        self.proxy_pool = proxy_pool
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        endpoint = self.proxy_pool.acquire()
+        ok = None
+        try:
+            kwargs['proxies'] = {'http': endpoint.url, 'https': endpoint.url}
+            response = super().send(request, **kwargs)
+            ok = True
+            return response
+        except requests.exceptions.ConnectionError:
+            # Includes connect timeouts and SOCKS errors; read timeouts are the service's, not the tunnel's
+            ok = False
+            raise
+        finally:
+            self.proxy_pool.release(endpoint, ok)
+
+class ProxyPoolSession:
+    """
+    aiohttp counterpart of ProxyPoolAdapter: one ClientSession per SOCKS
+    endpoint, with get() sending each request through an endpoint of the pool.
+
+    Usage:
+        async with ProxyPoolSession(pool, make_session) as session:
+            async with session.get(url) as response:
+                ...
+    """
+
+    def __init__(self, proxy_pool, make_session):
+        self.proxy_pool = proxy_pool
+        self._sessions = {endpoint.url: make_session(endpoint.url) for endpoint in proxy_pool.endpoints}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        for session in self._sessions.values():
+            await session.close()
+
+    @asynccontextmanager
+    async def get(self, url):
+        import aiohttp
+        from aiohttp_socks import ProxyError, ProxyConnectionError, ProxyTimeoutError
+
+        endpoint = self.proxy_pool.acquire()
+        ok = None
+        try:
+            async with self._sessions[endpoint.url].get(url) as response:
+                ok = True
+                yield response
+        except (aiohttp.ClientConnectionError, ProxyConnectionError, ProxyError, ProxyTimeoutError):
+            ok = False
+            raise
+        finally:
+            self.proxy_pool.release(endpoint, ok)
+
+# Pool shared by every session of the process, created on first use
+_proxy_pool = None
+_proxy_pool_lock = threading.Lock()
+
+def get_proxy_pool():
+    """
+    Get the shared pool of SOCKS endpoints (PROXY_ENDPOINTS, or PROXY_HOST:PROXY_PORT).
+
+    Returns:
+        ProxyPool, or None if the proxy is disabled (USE_PROXY=0)
+    """
+    global _proxy_pool
+    config = get_proxy_config()
+    if not config['enabled']:
+        return None
+    with _proxy_pool_lock:
+        if _proxy_pool is None:
+            _proxy_pool = ProxyPool(
+                config['endpoints'],
+                max_failures=config['max_failures'],
+                eviction_time=config['eviction_time'],
+                health_check_interval=config['health_check_interval'],
+                health_check_timeout=config['health_check_timeout']
+            )
+        return _proxy_pool
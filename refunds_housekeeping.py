@@ -1,126 +1,122 @@
-import requests
 import json
-import threading
-import csv
 import sys
-from concurrent.futures import ThreadPoolExecutor
-from utils import setup_proxy, get_headers, disable_ssl_warnings, get_network_config, get_api_config, ensure_output_dir
+from utils import setup_proxy, disable_ssl_warnings, get_api_config, build_lookup_url, show_available_assets, get_asset_file_path, ensure_output_dir, get_http_session, InputItems, log_verbose, get_output_file, get_shard_output_file, open_file
+from lookup_engine import run_lookup_job, process_item
 from constants import DEFAULT_PATHS, DEFAULTS
 
-# ================================================================
-# INITIALIZATION
-# ================================================================
-
-# Setup proxy and disable SSL warnings
-if not setup_proxy():
-    sys.exit(1)
-
-disable_ssl_warnings()
-
 # ================================================================
 # CONFIGURATION
 # ================================================================
 
-# Show available .txt files and let user choose
-from utils import show_available_assets, get_asset_file_path
-
-print("Refunds Housekeeping API Processing")
-print("==================================")
-
-show_available_assets(['.txt'])
-
-input_filename = input("Please enter the input file name containing refund IDs (e.g., 'refund_ids.txt'): ").strip()
-
-# Get the full path to the input file
-INPUT_FILE = get_asset_file_path(input_filename) if input_filename else DEFAULT_PATHS['input_transactions']
-OUTPUT_FILE = DEFAULT_PATHS['output_responses']
+# CSV, or Parquet with OUTPUT_FORMAT=parquet; one file per shard with SHARD_COUNT
+OUTPUT_FILE = get_shard_output_file(get_output_file(DEFAULT_PATHS['output_responses']))
 
-# Get API configuration and network settings
+# Get API configuration
 API_CONFIG = get_api_config()
-HEADERS = get_headers()
-network_config = get_network_config()
-MAX_WORKERS = network_config['max_workers']
 
 # ================================================================
 # SCRIPT LOGIC
 # ================================================================
 
-# Shared list to store results and a lock for thread-safe updates
-results = []
-lock = threading.Lock()
+def build_lookups(refund_id):
+    """
+    Constructs the API URL for refunds housekeeping endpoint.
+    """
+    return [('refunds_housekeeping', build_lookup_url(API_CONFIG['refunds_housekeeping'], refund_id))]
 
-def process_refund_id(refund_id):
+def build_result_row(refund_id, responses):
     """
-    Constructs the API URL for refunds housekeeping endpoint, makes a GET request, and records the response.
+    Turns the refunds housekeeping response for a refund ID into an output row.
     """
-    base_url = API_CONFIG['refunds_housekeeping']['base_url']
-    url = f"{base_url}{refund_id}"
+    response = responses['refunds_housekeeping']
 
     status_code = "Error"
     response_output = DEFAULTS['no_response']
 
-    try:
-        response = requests.get(url, headers=HEADERS, verify=False, timeout=network_config['timeout'])
+    if response.error == 'timeout':
+        response_output = "Request timeout"
+    elif response.error == 'connection':
+        response_output = "Connection error"
+    elif response.error:
+        response_output = f"Request failed: {response.detail}"
+    else:
         status_code = response.status_code
 
         if response.status_code == 200:
             try:
-                # Parse the JSON response and extract the state field
-                data = response.json()
-                response_output = data.get('state', DEFAULTS['not_available'])
+                # Extract the state field from the JSON response
+                response_output = response.field('state', DEFAULTS['not_available'])
             except json.JSONDecodeError:
                 response_output = DEFAULTS['json_decode_error']
         else:
             # For non-200 responses, record the status code and response text
             response_output = f"HTTP {response.status_code}: {response.text}"
 
-    except requests.exceptions.Timeout:
-        response_output = "Request timeout"
-    except requests.exceptions.ConnectionError:
-        response_output = "Connection error"
-    except (requests.exceptions.RequestException, Exception) as e:
-        response_output = f"Request failed: {str(e)}"
-
-    # Use a lock to safely append the result to the shared list
-    with lock:
-        results.append([refund_id, status_code, response_output])
+    log_verbose(f"Processed: {refund_id} - Status: {status_code}")
+    return [refund_id, status_code, response_output]
 
-    print(f"Processed: {refund_id} - Status: {status_code}")
+def process_refund_id(refund_id):
+    """
+    Looks up a single refund ID and returns its output row.
+    """
+    return process_item(refund_id, build_lookups, build_result_row)
 
 def main():
     """
     Main function to read refund IDs and process them using the refunds housekeeping API.
     """
-    try:
-        with open(INPUT_FILE, 'r') as f:
-            refund_ids = [line.strip() for line in f if line.strip()]
-    except FileNotFoundError:
-        print(f"Error: The file '{INPUT_FILE}' was not found.")
-        return
+    # Setup proxy and disable SSL warnings
+    if not setup_proxy():
+        sys.exit(1)
 
-    if not refund_ids:
-        print(f"The file '{INPUT_FILE}' is empty. No refund IDs to process.")
-        return
+    disable_ssl_warnings()
+
+    # Show available .txt files and let user choose
+    print("Refunds Housekeeping API Processing")
+    print("==================================")
 
-    print(f"Starting to process {len(refund_ids)} refund IDs using the refunds housekeeping API...")
+    show_available_assets(['.txt'])
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        executor.map(process_refund_id, refund_ids)
+    input_filename = input("Please enter the input file name containing refund IDs (e.g., 'refund_ids.txt'): ").strip()
 
-    print("\nAll refund IDs processed. Writing results to file.")
+    # Get the full path to the input file
+    input_file = get_asset_file_path(input_filename) if input_filename else DEFAULT_PATHS['input_transactions']
+
+    # Create the shared pooled HTTP session up front (fails fast if the token is missing)
+    get_http_session()
+
+    # .gz and .zst inputs are decompressed on the fly
+    try:
+        f = open_file(input_file)
+    except FileNotFoundError:
+        print(f"Error: The file '{input_file}' was not found.")
+        return
 
     # Ensure output directory exists
     ensure_output_dir()
 
-    # Write the final results to a CSV file
-    with open(OUTPUT_FILE, 'w', newline='') as f:
-        writer = csv.writer(f)
-        header = ["refund_id", "status_code", "state"]
-        writer.writerow(header)
-        writer.writerows(results)
+    print(f"Starting to process refund IDs from '{input_file}' using the refunds housekeeping API...")
+
+    # IDs are streamed from the file straight into the workers, and each
+    # result row is written to the output CSV as it completes. An interrupted
+    # run resumes from its progress journal.
+    header = ["refund_id", "status_code", "state"]
+    with f:
+        summary = run_lookup_job(InputItems(f), build_lookups, build_result_row, OUTPUT_FILE, header,
+                                 item_key=str, run_name=f"refunds_housekeeping:{input_file}",
+                                 column_types={"status_code": "int64"})
+
+    if not summary.processed and not summary.restored:
+        print(f"The file '{input_file}' is empty. No refund IDs to process.")
+        return
 
+    print("\nAll refund IDs processed.")
     print(f"Results successfully written to '{OUTPUT_FILE}'.")
-    print(f"Processed {len(results)} refund IDs total.")
+    if summary.restored:
+        print(f"{summary.restored} results were restored from the previous run.")
+    if summary.failed:
+        print(f"{summary.failed} lookups failed and will be retried on the next run.")
+    print(f"Processed {summary.processed + summary.restored} refund IDs total.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,156 @@
+"""
+Persistent response cache for PhonePe API scripts.
+Keeps successful lookup responses in a local SQLite database so repeat runs skip IDs whose answer cannot have changed.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from utils import get_cache_config, get_field, FetchResult
+from constants import TERMINAL_STATES
+
+class ResponseCache:
+    """
+    SQLite-backed cache of HTTP 200 responses, keyed by request URL.
+
+    A response that reports a terminal state (see TERMINAL_STATES) is kept
+    for `terminal_ttl` seconds; any other response only for `ttl` seconds,
+    since its state may still change. Errors and non-200 responses are never
+    cached. Beyond `max_entries` the entries closest to expiry are evicted.
+
+    New entries are buffered and written in batches, so workers never wait
+    on a commit. The cache is safe to share between threads.
+
+    Usage:
+        with ResponseCache() as cache:
+            response = cache.get(url)
+            ...
+            cache.put(url, response)
+    """
+
+    # Buffered entries written per commit
+    _BATCH_SIZE = 500
+
+    def __init__(self, path=None, ttl=None, terminal_ttl=None, max_entries=None):
+        cache_config = get_cache_config()
+        self.path = path or cache_config['path']
+        self.ttl = ttl if ttl is not None else cache_config['ttl']
+        self.terminal_ttl = terminal_ttl if terminal_ttl is not None else cache_config['terminal_ttl']
+        self.max_entries = max_entries or cache_config['max_entries']
+        self.state_fields = cache_config['state_fields']
+        self.hits = 0
+        self.stored = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Open (or create) the cache database and drop expired entries.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, status_code INTEGER, body BLOB, expires REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires)")
+        self._db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+        self._db.commit()
+
+    def get(self, url):
+        """
+        Look up a URL.
+
+        Returns:
+            The cached FetchResult, or None if the URL is not cached or has expired
+        """
+        with self._lock:
+            entry = self._pending.get(url)
+            if entry is None:
+                entry = self._db.execute(
+                    "SELECT status_code, body, expires FROM responses WHERE url = ?", (url,)
+                ).fetchone()
+            if entry is None or entry[2] < time.time():
+                return None
+            self.hits += 1
+        return FetchResult(entry[0], bytes(entry[1]), None, 'cached')
+
+    def put(self, url, response):
+        """
+        Cache a response if it is a successful one.
+        """
+        if response.error or response.status_code != 200:
+            return
+        ttl = self.terminal_ttl if self._is_terminal(response) else self.ttl
+        with self._lock:
+            self._pending[url] = (response.status_code, response.body, time.time() + ttl)
+            self.stored += 1
+            if len(self._pending) >= self._BATCH_SIZE:
+                self._write_pending()
+
+    def close(self):
+        """
+        Write buffered entries, enforce max_entries and close the database.
+        """
+        if self._db is None:
+            return
+        with self._lock:
+            self._write_pending()
+            self._db.execute(
+                "DELETE FROM responses WHERE url IN "
+                "(SELECT url FROM responses ORDER BY expires LIMIT "
+                "max(0, (SELECT count(*) FROM responses) - ?))",
+                (self.max_entries,)
+            )
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+        self._db.executemany(
+            "INSERT OR REPLACE INTO responses (url, status_code, body, expires) VALUES (?, ?, ?, ?)",
+            ((url, status_code, body, expires) for url, (status_code, body, expires) in self._pending.items())
+        )
+        self._db.commit()
+        self._pending.clear()
+
+    def _is_terminal(self, response):
+        # Parsed rather than read with response.field(): a state must only
+        # count at its exact path from the top of the body
+        try:
+            data = response.json()
+        except ValueError:
+            return False
+        for path in self.state_fields:
+            value = get_field(data, path)
+            if isinstance(value, str) and value.upper() in TERMINAL_STATES:
+                return True
+        return False
+
+def open_response_cache():
+    """
+    Open the response cache if it is enabled.
+
+    Returns:
+        An open ResponseCache, or None if RESPONSE_CACHE is disabled
+    """
+    if not get_cache_config()['enabled']:
+        return None
+    cache = ResponseCache()
+    cache.open()
+    return cache
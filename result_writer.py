@@ -0,0 +1,196 @@
+"""
+Incremental result writer for PhonePe API scripts.
+Writes output rows to CSV (or Parquet) from a dedicated thread while the run is in progress.
+"""
+
+import csv
+import os
+import queue
+import threading
+import time
+from utils import get_output_config, open_file
+from parquet_output import ParquetRowWriter
+
+# Sentinel telling the writer thread that no more rows will arrive
+_STOP = object()
+
+class _CsvRows:
+    """
+    CSV output of the result writer (same interface as ParquetRowWriter),
+    compressed on the fly for a .csv.gz or .csv.zst path.
+    """
+
+    def __init__(self, path, header):
+        self._file = open_file(path, 'w', newline='')
+        self._csv_writer = csv.writer(self._file)
+        self._csv_writer.writerow(header)
+
+    def writerow(self, row):
+        self._csv_writer.writerow(row)
+
+    def flush(self, fsync=False):
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self, fsync=False):
+        if fsync:
+            self.flush(fsync=True)
+        self._file.close()
+
+class ResultWriter:
+    """
+    Writes result rows to a CSV or Parquet file in batches from a background thread.
+
+    Workers hand rows over with write(), which only puts them on a bounded
+    queue, so they never wait on the file or on each other. Rows are flushed
+    every `batch_size` rows or `flush_interval` seconds, whichever comes first,
+    so a crash or Ctrl-C only loses the rows of the current batch.
+
+    With a ProgressJournal attached, rows restored from an earlier attempt are
+    written first, and each flushed batch of final rows is journaled right
+    after it reaches the output file.
+
+    With OUTPUT_FORMAT=parquet the rows go to a Parquet file instead, typed by
+    column_types (e.g. {"status_code": "int64"}; other columns are text).
+    Parquet rows are written a row group at a time and the file is only
+    complete once closed; an interrupted run is rebuilt from the journal.
+
+    fsync policy:
+        'batch' - fsync after every flushed batch
+        'close' - fsync once, when the writer is closed
+        'never' - leave it to the operating system
+
+    Usage:
+        with ResultWriter(path, header) as writer:
+            writer.write(row)
+    """
+
+    def __init__(self, path, header, journal=None, batch_size=None, flush_interval=None, fsync=None, queue_size=None,
+                 column_types=None, output_format=None):
+        output_config = get_output_config()
+        self.path = path
+        self.header = header
+        self.column_types = column_types
+        self.output_format = output_format or output_config['format']
+        self.journal = journal
+        self.resume = output_config['resume']
+        self.batch_size = batch_size or output_config['batch_size']
+        self.flush_interval = flush_interval or output_config['flush_interval']
+        self.fsync = fsync or output_config['fsync']
+        self.rows_written = 0
+        self.rows_restored = 0
+        self.rows_failed = 0
+        self._queue = queue.Queue(maxsize=queue_size or output_config['queue_size'])
+        self._rows = None
+        self._thread = None
+        self._error = None
+
+        if self.fsync not in ('batch', 'close', 'never'):
+            raise ValueError(f"Unknown fsync policy '{self.fsync}'. Use 'batch', 'close' or 'never'.")
+        if self.output_format not in ('csv', 'parquet'):
+            raise ValueError(f"Unknown output format '{self.output_format}'. Use 'csv' or 'parquet'.")
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(completed=exc_type is None)
+
+    def open(self):
+        """
+        Create the output file, write the header and start the writer thread.
+        """
+        if self.output_format == 'parquet':
+            self._rows = ParquetRowWriter(self.path, self.header, self.column_types)
+        else:
+            self._rows = _CsvRows(self.path, self.header)
+        if self.journal:
+            self.rows_restored = self.journal.open(self._rows.writerow, resume=self.resume)
+        self._rows.flush()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, row, key=None, final=True, copies=1):
+        """
+        Hand a result row to the writer thread (blocks only while the buffer is full).
+
+        Args:
+            row: Output row
+            key: ID the row belongs to, used by the progress journal
+            final: False if the row records a retryable failure
+            copies: Number of times to write the row (once per input line
+                    repeating the ID); all copies land in the same batch
+        """
+        if self._error:
+            raise IOError(f"Result writer for '{self.path}' failed: {self._error}")
+        self._queue.put((row, key, final, copies))
+
+    def close(self, completed=True):
+        """
+        Flush every pending row and close the file. The progress journal is
+        removed once a completed run has no failed rows left to retry.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self._rows.close(fsync=self.fsync == 'close' and not self._error)
+        if self.journal:
+            if self.fsync == 'close' and not self._error:
+                self.journal.flush(fsync=True)
+            self.journal.close(delete=completed and not self.rows_failed and not self._error)
+        if self._error:
+            raise IOError(f"Result writer for '{self.path}' failed: {self._error}")
+
+    def _flush(self, batch):
+        for row, _, _, copies in batch:
+            for _ in range(copies):
+                self._rows.writerow(row)
+        self._rows.flush(fsync=self.fsync == 'batch')
+
+        # Journal only after the rows are safely in the output file
+        if self.journal:
+            self.journal.record((key, row) for row, key, final, copies in batch
+                                for _ in range(copies) if final and key is not None)
+            self.journal.flush(fsync=self.fsync == 'batch')
+
+        self.rows_written += sum(copies for _, _, _, copies in batch)
+        self.rows_failed += sum(copies for _, _, final, copies in batch if not final)
+
+    def _run(self):
+        try:
+            self._write_loop()
+        except Exception as e:
+            self._error = e
+            # Keep draining so producers blocked on a full queue can finish
+            while self._queue.get() is not _STOP:
+                pass
+
+    def _write_loop(self):
+        batch = []
+        last_flush = time.monotonic()
+
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                row = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                row = None
+
+            if row is _STOP:
+                if batch:
+                    self._flush(batch)
+                return
+
+            if row is not None:
+                batch.append(row)
+
+            if len(batch) >= self.batch_size or (batch and time.monotonic() - last_flush >= self.flush_interval):
+                self._flush(batch)
+                batch = []
+                last_flush = time.monotonic()
+            elif not batch:
+                last_flush = time.monotonic()
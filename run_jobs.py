@@ -0,0 +1,230 @@
+"""
+Multi-job runner for PhonePe API lookups.
+
+Runs several lookup jobs in one process, sharing connection pools, rate
+limits, concurrency limits and the retry scheduler. Each job is described
+declaratively in terms of an entry of get_api_config():
+
+    {
+        "name": "subscription_recon",            # optional, defaults to the api name
+        "api": "mandate_check",                  # key of get_api_config()
+        "input": "oma_ids.txt",                  # .txt (one ID per line) or .csv, optionally .gz/.zst, looked up in assets/
+        "id_columns": ["Merchant_Id", "..."],    # CSV only: columns forming the URL path
+        "extract": "data.reconciliationState",   # optional dotted field, defaults to the full body
+        "output": "output/subscription.csv"      # optional, defaults to output/<name>.csv
+    }
+
+With OUTPUT_FORMAT=parquet every job writes a .parquet file instead. With
+SHARD_INDEX/SHARD_COUNT every job looks up only this host's shard of its
+input, into '<output>.shard-<index>-of-<count>.csv'.
+
+Usage:
+    python run_jobs.py                                   # pick a jobs file from assets/
+    python run_jobs.py --jobs assets/nightly_jobs.json   # non-interactive, e.g. from cron
+    python run_jobs.py --api mandate_check --input oma_ids.txt --extract data.reconciliationState
+
+Exit status: 0 when every job completed, 1 if some lookups failed and will
+be retried on the next run, 2 for invalid job definitions.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+from contextlib import ExitStack
+from utils import (setup_proxy, disable_ssl_warnings, get_api_config, show_available_assets,
+                   get_asset_file_path, ensure_output_dir, get_http_session, build_lookup_url,
+                   InputItems, get_output_file, get_shard_output_file, open_file, strip_compression)
+from lookup_engine import LookupJob, run_lookup_jobs
+from constants import DEFAULT_PATHS, DEFAULTS
+
+# ================================================================
+# CONFIGURATION
+# ================================================================
+
+# Get API configuration
+API_CONFIG = get_api_config()
+
+# ================================================================
+# SCRIPT LOGIC
+# ================================================================
+
+def load_job_specs(path):
+    """
+    Reads a list of job specs from a JSON file.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        specs = json.load(f)
+    if not isinstance(specs, list):
+        raise ValueError(f"'{path}' must contain a JSON list of jobs.")
+    return specs
+
+def validate_job_spec(spec):
+    """
+    Checks a job spec and fills in its defaults.
+    Raises ValueError with a readable message for an invalid spec.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError(f"Invalid job {spec!r}: expected a JSON object.")
+    if spec.get('api') not in API_CONFIG:
+        raise ValueError(f"Job {spec.get('name', spec.get('api'))!r}: unknown api {spec.get('api')!r}. "
+                         f"Use one of: {', '.join(API_CONFIG)}.")
+    if not spec.get('input'):
+        raise ValueError(f"Job {spec.get('name', spec['api'])!r}: missing 'input'.")
+
+    name = spec.get('name') or spec['api']
+    input_file = get_asset_file_path(spec['input'])
+    if not os.path.exists(input_file):
+        raise ValueError(f"Job {name!r}: the input file '{input_file}' was not found.")
+
+    id_columns = spec.get('id_columns')
+    is_csv = strip_compression(input_file).endswith('.csv')
+    if is_csv:
+        if not id_columns:
+            raise ValueError(f"Job {name!r}: CSV input needs 'id_columns'.")
+        with open_file(input_file) as f:
+            columns = next(csv.reader(f), [])
+        missing = [column for column in id_columns if column not in columns]
+        if missing:
+            raise ValueError(f"Job {name!r}: missing required column(s) in '{input_file}': {', '.join(missing)}.")
+
+    return {
+        'name': name,
+        'api': spec['api'],
+        'input': input_file,
+        'id_columns': id_columns if is_csv else None,
+        'extract': spec.get('extract'),
+        'output': get_shard_output_file(get_output_file(spec.get('output') or f"{DEFAULT_PATHS['output_dir']}/{name}.csv"))
+    }
+
+def extract_response(response, extract):
+    """
+    Turns a response into the (status code, value) pair of an output row.
+    """
+    if response.error:
+        return "Error", DEFAULTS['no_response']
+    if response.status_code != 200:
+        return response.status_code, f"HTTP {response.status_code}: {response.text}"
+    if not extract:
+        return response.status_code, response.text
+
+    try:
+        value = response.field(extract, DEFAULTS['not_available'])
+    except json.JSONDecodeError:
+        return response.status_code, DEFAULTS['json_decode_error']
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    return response.status_code, value
+
+def build_job(job, f):
+    """
+    Builds a LookupJob for a validated job spec and its open input file.
+    """
+    api_name = job['api']
+    id_columns = job['id_columns']
+
+    if id_columns:
+        items = InputItems(f, csv.DictReader)
+        get_ids = lambda row: [row.get(column) or "" for column in id_columns]
+        header = id_columns + ["status_code", job['extract'] or "response"]
+    else:
+        items = InputItems(f)
+        get_ids = lambda value: [value]
+        header = ["id", "status_code", job['extract'] or "response"]
+
+    def item_key(item):
+        return "|".join(get_ids(item))
+
+    def build_lookups(item):
+        ids = get_ids(item)
+        if not all(ids):
+            return []
+        return [(api_name, build_lookup_url(API_CONFIG[api_name], *ids))]
+
+    def build_result_row(item, responses):
+        if api_name not in responses:
+            return get_ids(item) + [DEFAULTS['not_available'], DEFAULTS['skipped']]
+        return get_ids(item) + list(extract_response(responses[api_name], job['extract']))
+
+    return LookupJob(items, build_lookups, build_result_row, job['output'], header,
+                     item_key=item_key, run_name=f"run_jobs:{job['name']}:{job['input']}",
+                     column_types={"status_code": "int64"})
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run several PhonePe API lookup jobs in one process.")
+    parser.add_argument('--jobs', help="JSON file with the list of jobs to run (non-interactive)")
+    parser.add_argument('--api', choices=list(API_CONFIG), help="Run a single job against this api")
+    parser.add_argument('--input', help="Input file of the single job (.txt or .csv)")
+    parser.add_argument('--id-columns', help="Comma-separated CSV columns forming the URL path")
+    parser.add_argument('--extract', help="Dotted response field to record, e.g. data.reconciliationState")
+    parser.add_argument('--output', help="Output file of the single job")
+    parser.add_argument('--name', help="Name of the single job")
+    return parser.parse_args()
+
+def main():
+    """
+    Main function to load the job definitions, run all jobs together and report on each.
+    """
+    args = parse_args()
+
+    if args.api:
+        specs = [{
+            'name': args.name, 'api': args.api, 'input': args.input, 'extract': args.extract, 'output': args.output,
+            'id_columns': args.id_columns.split(',') if args.id_columns else None
+        }]
+    else:
+        jobs_file = args.jobs
+        if not jobs_file:
+            print("Multi-Job Runner")
+            print("================")
+            show_available_assets(['.json'])
+            jobs_file = get_asset_file_path(input("Please enter the jobs file name (e.g., 'nightly_jobs.json'): ").strip())
+        try:
+            specs = load_job_specs(jobs_file)
+        except (OSError, ValueError) as e:
+            print(f"Error: Could not read jobs from '{jobs_file}': {e}")
+            return 2
+
+    try:
+        jobs = [validate_job_spec(spec) for spec in specs]
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 2
+
+    outputs = [job['output'] for job in jobs]
+    if len(set(outputs)) != len(outputs):
+        print("Error: Every job needs its own output file.")
+        return 2
+
+    # Setup proxy and disable SSL warnings
+    if not setup_proxy():
+        return 2
+
+    disable_ssl_warnings()
+
+    # Create the shared pooled HTTP session up front (fails fast if the token is missing)
+    get_http_session()
+
+    # Ensure output directory exists
+    ensure_output_dir()
+
+    for job in jobs:
+        print(f"Job '{job['name']}': {job['api']} lookups for '{job['input']}' -> '{job['output']}'")
+
+    with ExitStack() as stack:
+        files = [stack.enter_context(open_file(job['input'])) for job in jobs]
+        summaries = run_lookup_jobs([build_job(job, f) for job, f in zip(jobs, files)])
+
+    failed = False
+    print("\nAll jobs processed.")
+    for job, summary in zip(jobs, summaries):
+        print(f"Job '{job['name']}': {summary.processed + summary.restored} IDs, "
+              f"{summary.restored} restored from the previous run, {summary.failed} failed.")
+        failed = failed or summary.failed > 0
+    if failed:
+        print("Failed lookups will be retried on the next run.")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,38 +1,441 @@
-import pandas as pd
+"""
+Large file splitter.
+
+Cuts a large CSV into parts, each with the header row. The default raw
+modes never parse the file: line boundaries are found by scanning bytes,
+and the parts are copied byte for byte in parallel, so values (leading
+zeros, float formatting) are kept exactly and splitting runs at disk speed.
+
+The hash mode instead partitions the rows into shards by a key column, so
+all rows of a merchant (or transaction) end up in the same shard and every
+shard can be processed on its own.
+
+With OUTPUT_FORMAT=parquet every part or shard is written as a Parquet
+file instead, with column types inferred from the start of the file.
+
+Compressed files (.csv.gz, .csv.zst) are split as they are decompressed,
+in one sequential pass; OUTPUT_COMPRESSION compresses the CSV parts.
+"""
+
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from constants import DEFAULT_PATHS
-from utils import show_available_assets, get_asset_file_path, ensure_output_dir
+from utils import (show_available_assets, get_asset_file_path, ensure_output_dir, get_file_processing_config,
+                   get_byte_ranges, next_line_start, read_line_range, copy_byte_range, get_shard, get_output_config,
+                   get_output_file, open_file, get_compression, strip_compression, iter_line_blocks)
+from csv_ranges import (resolve_engine, read_csv_header, parser_header, get_chunks, chunk_size, read_range_rows,
+                        worker_settings, scan_ranges, progress_line)
+from parquet_output import require_pyarrow, infer_csv_schema, csv_table, ParquetTableWriter
+
+# ================================================================
+# CONFIGURATION
+# ================================================================
+
+# Rows per part, parallel writers and part size defaults
+FILE_CONFIG = get_file_processing_config()
+
+# Output format (csv or parquet) and Parquet settings
+OUTPUT_CONFIG = get_output_config()
+
+# Bytes scanned at a time when looking for line boundaries
+SCAN_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Write buffer per shard file when partitioning by a key column
+SHARD_BUFFER_SIZE = 1024 * 1024
+
+# ================================================================
+# SCRIPT LOGIC
+# ================================================================
+
+def find_row_boundaries(source_file, data_start, rows_per_part):
+    """
+    Find where every part of `rows_per_part` lines starts by counting line
+    breaks in large blocks, without parsing the file.
+
+    Returns:
+        List of (start, end) byte ranges, one per part
+    """
+    size = os.path.getsize(source_file)
+    starts = [data_start]
+    # Line breaks still to pass before the next part starts
+    remaining = rows_per_part
+    with open(source_file, 'rb') as f:
+        f.seek(data_start)
+        position = data_start
+        while True:
+            block = f.read(SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            count = block.count(b'\n')
+            if count >= remaining:
+                newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+                cuts = newlines[remaining - 1::rows_per_part]
+                starts.extend(position + int(cut) + 1 for cut in cuts)
+                remaining = rows_per_part - (count - (remaining + (len(cuts) - 1) * rows_per_part))
+            else:
+                remaining -= count
+            position += len(block)
+    starts = [start for start in starts if start < size] or [data_start]
+    return list(zip(starts, starts[1:] + [size]))
+
+def find_size_boundaries(source_file, data_start, part_size):
+    """
+    Cut the file into parts of about `part_size` bytes, each moved forward to a line start.
+
+    Returns:
+        List of (start, end) byte ranges, one per part
+    """
+    size = os.path.getsize(source_file)
+    with open(source_file, 'rb') as f:
+        starts = sorted({next_line_start(f, start, data_start) for start, _ in get_byte_ranges(source_file, data_start, part_size)})
+    starts = [start for start in starts if start < size] or [data_start]
+    return list(zip(starts, starts[1:] + [size]))
+
+class PartWriter:
+    """
+    One output part: whole CSV lines go after the header into a CSV file
+    (compressed by its extension), or into a Parquet file when a schema is given.
+    """
+
+    def __init__(self, path, header, schema=None, output_config=None):
+        self.path = path
+        self.header = parser_header(header)
+        self.schema = schema
+        if schema is not None:
+            self._file = ParquetTableWriter(path, schema, output_config)
+        else:
+            self._file = open_file(path, 'wb')
+            self._file.write(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, lines):
+        self._file.write(lines if self.schema is None else csv_table(self.header, lines, self.schema))
+
+    def close(self):
+        self._file.close()
+
+def write_part(source_file, header, byte_range, output_file, schema=None, output_config=None):
+    """
+    Write one part: the header followed by a byte range of the source file.
+    Plain CSV parts are copied in the kernel; compressed or Parquet parts are
+    converted a block at a time.
+    """
+    start, end = byte_range
+    with open(source_file, 'rb') as source:
+        if schema is None and get_compression(output_file) is None:
+            with open(output_file, 'wb') as destination:
+                destination.write(header)
+                copy_byte_range(source, destination, start, end)
+            return output_file
+
+        with PartWriter(output_file, header, schema, output_config) as part:
+            for block_start in range(start, end, SCAN_BLOCK_SIZE):
+                block = read_line_range(source, block_start, min(block_start + SCAN_BLOCK_SIZE, end), start)
+                if block:
+                    part.write(block)
+    return output_file
+
+def _output_schema(source_file, header, output_format, output_config):
+    """
+    Column types of the Parquet parts (None for CSV output).
+    """
+    if output_format != 'parquet':
+        return None
+    return infer_csv_schema(source_file, parser_header(header), len(header), output_config['parquet_infer_types'])
+
+def split_raw(source_file, output_prefix, ranges, workers, output_format='csv', output_config=None):
+    """
+    Write every byte range as its own part, several parts at a time
+    (as Parquet with output_format 'parquet').
+
+    Returns:
+        List of the part files written
+    """
+    output_config = output_config or get_output_config()
+    header = read_csv_header(source_file)[0]
+    schema = _output_schema(source_file, header, output_format, output_config)
+    output_files = [get_output_file(f"{output_prefix}_{index + 1}.csv", output_format, output_config['compression'])
+                    for index in range(len(ranges))]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for output_file in executor.map(lambda part: write_part(source_file, header, *part, schema, output_config),
+                                        zip(ranges, output_files)):
+            print(f"Saved {output_file}")
+    return output_files
+
+def split_stream(source_file, output_prefix, rows_per_part=None, part_size=None, output_format='csv', output_config=None):
+    """
+    Split a compressed CSV, which cannot be read by byte range: it is
+    decompressed once as a stream and cut into parts of rows_per_part lines
+    (or of about part_size bytes, at a line end) on the way.
 
-print("Large File Splitter")
-print("==================")
+    Returns:
+        List of the part files written
+    """
+    output_config = output_config or get_output_config()
+    header = read_csv_header(source_file)[0]
+    schema = _output_schema(source_file, header, output_format, output_config)
+    limit = rows_per_part or part_size
 
-# Show available CSV files in assets directory
-available_files = show_available_assets(['.csv'])
+    def take(block, wanted):
+        # Bytes of the block (and lines or bytes counted) that fill up to `wanted` more of the part
+        if rows_per_part:
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            if len(newlines) < wanted:
+                return len(block), len(newlines)
+            return int(newlines[wanted - 1]) + 1, wanted
+        line_end = block.find(b'\n', wanted - 1)
+        cut = len(block) if line_end < 0 else line_end + 1
+        return cut, cut
+
+    output_files = []
+    part = None
+    filled = 0
+    try:
+        with open_file(source_file, 'rb') as source:
+            source.read(len(header))
+            for block in iter_line_blocks(source, SCAN_BLOCK_SIZE):
+                while block:
+                    if part is None:
+                        output_files.append(get_output_file(f"{output_prefix}_{len(output_files) + 1}.csv", output_format,
+                                                            output_config['compression']))
+                        part = PartWriter(output_files[-1], header, schema, output_config)
+                        filled = 0
+                    cut, counted = take(block, limit - filled)
+                    part.write(block[:cut])
+                    block = block[cut:]
+                    filled += counted
+                    if filled >= limit:
+                        part.close()
+                        print(f"Saved {part.path}")
+                        part = None
+    finally:
+        if part is not None:
+            part.close()
+            print(f"Saved {part.path}")
+    return output_files
+
+def split_with_pandas(source_file, output_prefix, rows_per_part, output_format='csv', output_config=None):
+    """
+    Split by parsing the CSV with pandas (handles line breaks inside quoted
+    values). Values are read as text, so they are written back unchanged;
+    Parquet parts from this mode keep every column as text. pandas reads and
+    writes .gz and .zst files by their extension.
+
+    Returns:
+        List of the part files written
+    """
+    import pandas as pd
+
+    output_config = output_config or get_output_config()
+    if output_format == 'parquet':
+        pa = require_pyarrow()
+
+    output_files = []
+    chunk_iterator = pd.read_csv(source_file, chunksize=rows_per_part, dtype=str, keep_default_na=False)
+    for index, chunk in enumerate(chunk_iterator):
+        output_file = get_output_file(f"{output_prefix}_{index + 1}.csv", output_format, output_config['compression'])
+        print(f"Saving {output_file}...")
+        if output_format == 'parquet':
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            table = table.cast(pa.schema([(name, pa.string()) for name in table.column_names]))
+            with ParquetTableWriter(output_file, table.schema, output_config) as writer:
+                writer.write(table)
+        else:
+            chunk.to_csv(output_file, index=False)
+        output_files.append(output_file)
+    return output_files
+
+def _shard_numbers(values, shard_count, engine):
+    """
+    Shard number of every value, hashing each distinct value only once.
+    """
+    if engine == 'pyarrow':
+        encoded = values.combine_chunks().dictionary_encode()
+        distinct, codes = encoded.dictionary.to_pylist(), encoded.indices.to_numpy(zero_copy_only=False)
+    else:
+        import pandas as pd
+        codes, distinct = pd.factorize(values)
+    shard_of = np.array([get_shard(value, shard_count) for value in distinct], dtype=np.int64)
+    return shard_of[codes]
+
+def shard_range(byte_range):
+    """
+    Group the lines of one chunk (byte range or block of a compressed file)
+    by shard (runs in a worker process).
+
+    Returns:
+        (bytes scanned, groups, table). For CSV output, groups lists (shard
+        number, lines of that shard as bytes) and table is None. For Parquet
+        output, table holds the rows converted and ordered by shard, and
+        groups lists (shard number, (offset, rows)) spans of it.
+    """
+    settings = worker_settings()
+    lines, values = read_range_rows(settings, byte_range)
+    range_bytes = chunk_size(byte_range)
+    if not lines:
+        return range_bytes, [], None
+
+    shards = _shard_numbers(values, settings['shard_count'], settings['engine'])
+    # Stable sort keeps the input order of the rows within every shard
+    order = np.argsort(shards, kind='stable')
+    counts = np.bincount(shards, minlength=settings['shard_count'])
+
+    if settings['schema'] is not None:
+        table = csv_table(settings['header'], b''.join(lines[index] + b'\n' for index in order), settings['schema'])
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        return range_bytes, [(shard, (int(offsets[shard]), int(count))) for shard, count in enumerate(counts) if count], table
+
+    groups = []
+    position = 0
+    for shard, count in enumerate(counts):
+        if count:
+            groups.append((shard, b''.join(lines[index] + b'\n' for index in order[position:position + count])))
+            position += count
+    return range_bytes, groups, None
+
+def split_by_key(source_file, output_prefix, key_column, shard_count, config, output_format='csv', output_config=None):
+    """
+    Partition the rows into shard_count shards by a stable hash of key_column
+    (see get_shard), in one streaming pass. Worker processes hash byte ranges
+    in parallel and every shard has its own buffered writer (a Parquet
+    writer with output_format 'parquet').
+
+    Returns:
+        List of the shard files written (shard i is '<prefix>_shard_<i>.csv', or .parquet)
+    """
+    header, raw_column, columns = read_csv_header(source_file, key_column)
+    if raw_column is None:
+        raise KeyError(f"Column '{key_column}' not found! Available columns: {columns}")
+
+    settings = {
+        'source_file': source_file,
+        'data_start': len(header),
+        'header': parser_header(header),
+        'column': raw_column,
+        'engine': resolve_engine(config['engine']),
+        'shard_count': shard_count,
+        'schema': None
+    }
+    output_config = output_config or get_output_config()
+    settings['schema'] = _output_schema(source_file, header, output_format, output_config)
+    chunks, total_bytes = get_chunks(source_file, len(header), config['range_size'])
+    size = 'a compressed file' if total_bytes is None else f"{total_bytes / 1024 / 1024:,.0f} MB"
+    print(f"Partitioning {size} into {shard_count} shards by '{key_column}' with "
+          f"{config['workers']} {settings['engine']} worker(s)...")
+
+    width = len(str(shard_count - 1))
+    output_files = [get_output_file(f"{output_prefix}_shard_{shard:0{width}d}.csv", output_format, output_config['compression'])
+                    for shard in range(shard_count)]
+    writers = []
+    try:
+        for output_file in output_files:
+            if settings['schema'] is not None:
+                writers.append(ParquetTableWriter(output_file, settings['schema'], output_config))
+            else:
+                writers.append(open_file(output_file, 'wb', buffering=SHARD_BUFFER_SIZE))
+                writers[-1].write(header)
+        scanned = 0
+        for range_bytes, groups, table in scan_ranges(shard_range, chunks, settings, config['workers']):
+            for shard, data in groups:
+                writers[shard].write(data if table is None else table.slice(*data))
+            scanned += range_bytes
+            print(progress_line("Partitioned", scanned, total_bytes))
+    finally:
+        for writer in writers:
+            writer.close()
+    return output_files
+
+def main():
+    """
+    Main function to select the large CSV file and split mode, then write the parts.
+    """
+    print("Large File Splitter")
+    print("==================")
+
+    # Show available CSV files in assets directory
+    available_files = show_available_assets(['.csv'])
+
+    if not available_files:
+        print("No CSV files found in assets directory!")
+        sys.exit(1)
 
-if available_files:
     file_name = input("Enter the name of the large CSV file (with .csv extension): ").strip()
-else:
-    print("No CSV files found in assets directory!")
-    exit(1)
-
-# The name of your large CSV file
-source_file = get_asset_file_path(file_name)
-# Number of rows per smaller file
-chunk_size = 500000
-# The prefix for the new files
-file_prefix = file_name.replace('.csv', '')
-
-# Ensure output directory exists
-output_dir = DEFAULT_PATHS["output_dir"]
-ensure_output_dir()
-
-# Create an iterator that reads the CSV in chunks
-chunk_iterator = pd.read_csv(source_file, chunksize=chunk_size)
-
-# Loop through the chunks and save each one to a new file
-for i, chunk in enumerate(chunk_iterator):
-    output_file = f"{output_dir}/{file_prefix}_{i+1}.csv"
-    print(f"Saving {output_file}...")
-    chunk.to_csv(output_file, index=False)
-
-print("Splitting complete!")
\ No newline at end of file
+    source_file = get_asset_file_path(file_name)
+    if not os.path.isfile(source_file):
+        print(f"Error: The file '{source_file}' was not found.")
+        sys.exit(1)
+
+    print("\nSplit modes:")
+    print("  rows   - parts with a fixed number of rows, copied without parsing (default)")
+    print("  size   - parts of about a given size in MB, copied without parsing")
+    print("  hash   - shards by a key column, so each merchant's rows stay together")
+    print("  pandas - parse the rows with pandas (for line breaks inside quoted values)")
+    mode = input("Enter the split mode (rows/size/hash/pandas): ").strip().lower() or 'rows'
+    if mode not in ('rows', 'size', 'hash', 'pandas'):
+        print(f"Error: Unknown split mode '{mode}'.")
+        sys.exit(1)
+
+    try:
+        if mode == 'size':
+            part_size_mb = float(input("Enter the part size in MB (default: 1024): ").strip() or 1024)
+        elif mode == 'hash':
+            key_column = input(f"Enter the key column (default: {FILE_CONFIG['filter_column']}): ").strip() or FILE_CONFIG['filter_column']
+            shard_count = int(input(f"Enter the number of shards (default: {FILE_CONFIG['shard_count']}): ").strip()
+                              or FILE_CONFIG['shard_count'])
+            if shard_count < 1:
+                raise ValueError(shard_count)
+        else:
+            rows_per_part = int(input(f"Enter the rows per part (default: {FILE_CONFIG['rows_per_part']}): ").strip()
+                                or FILE_CONFIG['rows_per_part'])
+    except ValueError:
+        print("Error: Please enter a positive number.")
+        sys.exit(1)
+
+    # The prefix for the new files
+    output_prefix = f"{DEFAULT_PATHS['output_dir']}/{os.path.basename(strip_compression(file_name)).removesuffix('.csv')}"
+
+    # Ensure output directory exists
+    ensure_output_dir()
+
+    output_format = OUTPUT_CONFIG['format']
+    try:
+        get_output_file(output_prefix, output_format)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    start_time = time.time()
+    try:
+        if mode == 'pandas':
+            output_files = split_with_pandas(source_file, output_prefix, rows_per_part, output_format, OUTPUT_CONFIG)
+        elif mode == 'hash':
+            output_files = split_by_key(source_file, output_prefix, key_column, shard_count, FILE_CONFIG,
+                                        output_format, OUTPUT_CONFIG)
+        elif get_compression(source_file):
+            print("Splitting the compressed file as it is decompressed...")
+            output_files = split_stream(source_file, output_prefix, rows_per_part if mode == 'rows' else None,
+                                        None if mode == 'rows' else int(part_size_mb * 1024 * 1024), output_format, OUTPUT_CONFIG)
+        else:
+            data_start = len(read_csv_header(source_file)[0])
+            if mode == 'rows':
+                print(f"Finding the boundaries of {rows_per_part:,}-row parts...")
+                ranges = find_row_boundaries(source_file, data_start, rows_per_part)
+            else:
+                ranges = find_size_boundaries(source_file, data_start, int(part_size_mb * 1024 * 1024))
+            output_files = split_raw(source_file, output_prefix, ranges, FILE_CONFIG['workers'], output_format, OUTPUT_CONFIG)
+    except (KeyError, ValueError, ImportError) as e:
+        print(f"Error: {e.args[0] if e.args else e}")
+        sys.exit(1)
+
+    print(f"Splitting complete! {len(output_files)} parts written in {time.time() - start_time:.2f} seconds.")
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,27 @@ Handles environment loading, common configurations, and shared functionality.
 """
 
 import os
+import json
+import asyncio
+import time
+import random
+import gzip
+import hashlib
+import io
+import threading
 import warnings
 import urllib3
-import socks
-import socket
-from constants import NETWORK_CONFIG, API_BASE_URLS, API_ENDPOINTS, EVENT_TYPES, QUERY_PARAMS, DEFAULT_PATHS
+import requests
+from array import array
+from bisect import bisect_left
+from collections import Counter, namedtuple
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from constants import NETWORK_CONFIG, RATE_LIMITS, CONCURRENCY_CONFIG, CIRCUIT_BREAKER_CONFIG, RETRY_CONFIG, OUTPUT_CONFIG, SHARD_CONFIG, PARSING_CONFIG, CACHE_CONFIG, METRICS_CONFIG, FILE_PROCESSING_CONFIG, COMPRESSION_CODECS, API_BASE_URLS, API_ENDPOINTS, EVENT_TYPES, QUERY_PARAMS, DEFAULT_PATHS
 
 def load_env():
     """
@@ -44,21 +60,302 @@ def get_headers():
         'Authorization': get_auth_token()
     }
 
+def get_rate_limit(service=None, endpoint=None):
+    """
+    Get the token-bucket limit for a service or an endpoint.
+    Service limits can be overridden with RATE_LIMIT_<SERVICE>=rate[:burst].
+    
+    Args:
+        service: Service name from API_BASE_URLS
+        endpoint: Endpoint name from get_api_config()
+    
+    Returns:
+        Dict with 'rate' and 'burst', or None if unlimited
+    """
+    if endpoint is not None:
+        limit = RATE_LIMITS['endpoints'].get(endpoint)
+    else:
+        limit = RATE_LIMITS['services'].get(service)
+        override = os.getenv(f"RATE_LIMIT_{service.upper()}")
+        if override:
+            rate, _, burst = override.partition(':')
+            limit = {
+                'rate': float(rate),
+                'burst': int(burst) if burst else (limit or {}).get('burst') or max(1, int(float(rate)))
+            }
+
+    if not limit or not limit.get('rate'):
+        return None
+    return {'rate': float(limit['rate']), 'burst': int(limit.get('burst') or 1)}
+
+def get_concurrency_config():
+    """
+    Get adaptive concurrency configuration with environment overrides.
+    """
+    return {
+        'adaptive': os.getenv('ADAPTIVE_CONCURRENCY', str(CONCURRENCY_CONFIG['adaptive'])).lower() not in ('0', 'false', 'no'),
+        'floor': int(os.getenv('CONCURRENCY_FLOOR', CONCURRENCY_CONFIG['floor'])),
+        'ceiling': int(os.getenv('CONCURRENCY_CEILING', CONCURRENCY_CONFIG['ceiling'])),
+        'initial': int(os.getenv('MAX_WORKERS', CONCURRENCY_CONFIG['initial'])),
+        'backoff_ratio': CONCURRENCY_CONFIG['backoff_ratio'],
+        'latency_tolerance': CONCURRENCY_CONFIG['latency_tolerance'],
+        'services': CONCURRENCY_CONFIG['services']
+    }
+
+def get_circuit_breaker_config():
+    """
+    Get circuit breaker configuration with environment overrides.
+    """
+    return {
+        'enabled': os.getenv('CIRCUIT_BREAKER', str(CIRCUIT_BREAKER_CONFIG['enabled'])).lower() not in ('0', 'false', 'no'),
+        'window': int(os.getenv('CIRCUIT_BREAKER_WINDOW', CIRCUIT_BREAKER_CONFIG['window'])),
+        'min_requests': int(os.getenv('CIRCUIT_BREAKER_MIN_REQUESTS', CIRCUIT_BREAKER_CONFIG['min_requests'])),
+        'failure_ratio': float(os.getenv('CIRCUIT_BREAKER_FAILURE_RATIO', CIRCUIT_BREAKER_CONFIG['failure_ratio'])),
+        'open_time': float(os.getenv('CIRCUIT_BREAKER_OPEN_TIME', CIRCUIT_BREAKER_CONFIG['open_time'])),
+        'max_open_time': float(os.getenv('CIRCUIT_BREAKER_MAX_OPEN_TIME', CIRCUIT_BREAKER_CONFIG['max_open_time'])),
+        'probes': int(os.getenv('CIRCUIT_BREAKER_PROBES', CIRCUIT_BREAKER_CONFIG['probes'])),
+        'give_up_after': float(os.getenv('CIRCUIT_BREAKER_GIVE_UP_AFTER', CIRCUIT_BREAKER_CONFIG['give_up_after'])),
+        'services': CIRCUIT_BREAKER_CONFIG['services']
+    }
+
+def get_concurrency_ceiling():
+    """
+    Get the most requests that may be in flight to one service: MAX_WORKERS,
+    or with adaptive concurrency the highest ceiling of any service.
+    """
+    concurrency_config = get_concurrency_config()
+    ceiling = get_network_config()['max_workers']
+    if concurrency_config['adaptive']:
+        ceiling = max([ceiling, concurrency_config['ceiling']] +
+                      [service.get('ceiling', 0) for service in concurrency_config['services'].values()])
+    return ceiling
+
+def get_retry_config():
+    """
+    Get retry configuration with environment overrides.
+    """
+    return {
+        'max_attempts': int(os.getenv('RETRY_MAX_ATTEMPTS', RETRY_CONFIG['max_attempts'])),
+        'base_delay': float(os.getenv('RETRY_BASE_DELAY', RETRY_CONFIG['base_delay'])),
+        'max_delay': float(os.getenv('RETRY_MAX_DELAY', RETRY_CONFIG['max_delay']))
+    }
+
+def backoff_delay(attempt, retry_config=None):
+    """
+    Exponential backoff with full jitter for the given retry attempt (0-based).
+    
+    Returns:
+        Seconds to wait before retrying
+    """
+    retry_config = retry_config or get_retry_config()
+    ceiling = min(retry_config['max_delay'], retry_config['base_delay'] * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+def get_output_config():
+    """
+    Get result writer configuration with environment overrides.
+    """
+    return {
+        'batch_size': int(os.getenv('OUTPUT_BATCH_SIZE', OUTPUT_CONFIG['batch_size'])),
+        'flush_interval': float(os.getenv('OUTPUT_FLUSH_INTERVAL', OUTPUT_CONFIG['flush_interval'])),
+        'fsync': os.getenv('OUTPUT_FSYNC', OUTPUT_CONFIG['fsync']).lower(),
+        'queue_size': int(os.getenv('OUTPUT_QUEUE_SIZE', OUTPUT_CONFIG['queue_size'])),
+        'resume': os.getenv('RESUME', str(OUTPUT_CONFIG['resume'])).lower() not in ('0', 'false', 'no'),
+        'format': os.getenv('OUTPUT_FORMAT', OUTPUT_CONFIG['format']).lower(),
+        'compression': os.getenv('OUTPUT_COMPRESSION', OUTPUT_CONFIG['compression']).lower(),
+        'parquet_compression': os.getenv('PARQUET_COMPRESSION', OUTPUT_CONFIG['parquet_compression']).lower(),
+        'parquet_row_group_rows': int(os.getenv('PARQUET_ROW_GROUP_ROWS', OUTPUT_CONFIG['parquet_row_group_rows'])),
+        'parquet_infer_types': os.getenv('PARQUET_INFER_TYPES', str(OUTPUT_CONFIG['parquet_infer_types'])).lower() not in ('0', 'false', 'no')
+    }
+
+def get_output_file(path, output_format=None, compression=None):
+    """
+    The output path with the file extension of the output format and
+    compression (OUTPUT_FORMAT and OUTPUT_COMPRESSION unless given), e.g.
+    'output/api_responses.parquet' or 'output/api_responses.csv.gz'.
+    Parquet files are compressed internally and get no extra extension.
+    """
+    output_config = get_output_config()
+    output_format = output_format or output_config['format']
+    compression = compression or output_config['compression']
+    if output_format not in ('csv', 'parquet'):
+        raise ValueError(f"Unknown output format '{output_format}'. Use 'csv' or 'parquet'.")
+    extensions = {settings['codec']: extension for extension, settings in COMPRESSION_CODECS.items()}
+    if compression != 'none' and compression not in extensions:
+        raise ValueError(f"Unknown compression '{compression}'. Use 'none', {', '.join(repr(codec) for codec in extensions)}.")
+
+    root, extension = os.path.splitext(strip_compression(path))
+    if extension.lower() not in ('.csv', '.parquet'):
+        root = strip_compression(path)
+    if output_format == 'parquet' or compression == 'none':
+        return f"{root}.{output_format}"
+    return f"{root}.{output_format}{extensions[compression]}"
+
+def get_shard_config():
+    """
+    Get the shard of this host with environment overrides (SHARD_INDEX, SHARD_COUNT).
+
+    Raises:
+        ValueError: if the index is not between 0 and count - 1
+    """
+    shard_config = {
+        'index': int(os.getenv('SHARD_INDEX', SHARD_CONFIG['index'])),
+        'count': int(os.getenv('SHARD_COUNT', SHARD_CONFIG['count']))
+    }
+    if shard_config['count'] < 1 or not 0 <= shard_config['index'] < shard_config['count']:
+        raise ValueError(f"SHARD_INDEX must be between 0 and SHARD_COUNT - 1 "
+                         f"(got SHARD_INDEX={shard_config['index']}, SHARD_COUNT={shard_config['count']}).")
+    return shard_config
+
+def get_shard_output_file(path, shard_config=None):
+    """
+    The output path of this host's shard, e.g. 'output/api_responses.shard-1-of-4.csv'
+    (the path unchanged without sharding). merge_shards.py combines the shard files.
+    """
+    shard_config = shard_config or get_shard_config()
+    if shard_config['count'] == 1:
+        return path
+    compression_extension = path[len(strip_compression(path)):]
+    root, extension = os.path.splitext(strip_compression(path))
+    return f"{root}.shard-{shard_config['index']}-of-{shard_config['count']}{extension}{compression_extension}"
+
+def shard_items(items, item_key, shard_config):
+    """
+    The items whose key falls in a shard (see get_shard), lazily. Re-iterable
+    items (see InputItems) stay re-iterable.
+    """
+    def select():
+        for item in items:
+            if get_shard(item_key(item), shard_config['count']) == shard_config['index']:
+                yield item
+
+    if iter(items) is items:
+        return select()
+    return _ReiterableItems(select)
+
+class _ReiterableItems:
+    def __init__(self, make_iterator):
+        self.make_iterator = make_iterator
+
+    def __iter__(self):
+        return self.make_iterator()
+
+def get_parsing_config():
+    """
+    Get response parsing configuration with environment overrides.
+    """
+    return {
+        'json_backend': os.getenv('JSON_BACKEND', PARSING_CONFIG['json_backend']).lower()
+    }
+
+def get_cache_config():
+    """
+    Get response cache configuration with environment overrides.
+    """
+    return {
+        'enabled': os.getenv('RESPONSE_CACHE', str(CACHE_CONFIG['enabled'])).lower() not in ('0', 'false', 'no'),
+        'path': os.getenv('RESPONSE_CACHE_PATH', CACHE_CONFIG['path']),
+        'ttl': float(os.getenv('RESPONSE_CACHE_TTL', CACHE_CONFIG['ttl'])),
+        'terminal_ttl': float(os.getenv('RESPONSE_CACHE_TERMINAL_TTL', CACHE_CONFIG['terminal_ttl'])),
+        'max_entries': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', CACHE_CONFIG['max_entries'])),
+        'state_fields': CACHE_CONFIG['state_fields'],
+        'source_column': CACHE_CONFIG['source_column']
+    }
+
+def get_metrics_config():
+    """
+    Get run metrics configuration with environment overrides.
+    """
+    return {
+        'progress_interval': float(os.getenv('PROGRESS_INTERVAL', METRICS_CONFIG['progress_interval'])),
+        'path': os.getenv('METRICS_FILE', METRICS_CONFIG['path']),
+        'verbose': os.getenv('VERBOSE', str(METRICS_CONFIG['verbose'])).lower() not in ('0', 'false', 'no')
+    }
+
+def log_verbose(message):
+    """
+    Print a per-ID message, only when VERBOSE is enabled.
+    """
+    if get_metrics_config()['verbose']:
+        print(message)
+
+def get_file_processing_config():
+    """
+    Get large-file processing configuration with environment overrides.
+    """
+    workers = os.getenv('FILE_WORKERS', FILE_PROCESSING_CONFIG['workers'])
+    return {
+        'filter_column': os.getenv('FILTER_COLUMN', FILE_PROCESSING_CONFIG['filter_column']),
+        'default_mids': FILE_PROCESSING_CONFIG['default_mids'],
+        'engine': os.getenv('FILE_ENGINE', FILE_PROCESSING_CONFIG['engine']).lower(),
+        'workers': int(workers) if workers else (os.cpu_count() or 1),
+        'range_size': int(float(os.getenv('FILE_RANGE_SIZE_MB', FILE_PROCESSING_CONFIG['range_size_mb'])) * 1024 * 1024),
+        'rows_per_part': int(os.getenv('SPLIT_ROWS_PER_PART', FILE_PROCESSING_CONFIG['rows_per_part'])),
+        'shard_count': int(os.getenv('SPLIT_SHARDS', FILE_PROCESSING_CONFIG['shard_count']))
+    }
+
+def get_proxy_config():
+    """
+    Get SOCKS proxy configuration with environment overrides.
+    PROXY_ENDPOINTS ("host:port,host:port") lists several endpoints to spread
+    connections over; without it the single PROXY_HOST:PROXY_PORT is used.
+    """
+    proxy_config = NETWORK_CONFIG['proxy']
+    endpoints = os.getenv('PROXY_ENDPOINTS')
+    endpoints = [endpoint.strip() for endpoint in endpoints.split(',') if endpoint.strip()] if endpoints else proxy_config['endpoints']
+    if not endpoints:
+        endpoints = [f"{os.getenv('PROXY_HOST', proxy_config['host'])}:{os.getenv('PROXY_PORT', proxy_config['port'])}"]
+    parsed = []
+    for endpoint in endpoints:
+        host, _, port = endpoint.rpartition(':')
+        if not host or not port.isdigit():
+            raise ValueError(f"Invalid SOCKS endpoint '{endpoint}'. Use host:port.")
+        parsed.append((host, int(port)))
+    return {
+        'enabled': proxy_enabled(),
+        'endpoints': parsed,
+        'max_failures': int(os.getenv('PROXY_MAX_FAILURES', proxy_config['max_failures'])),
+        'eviction_time': float(os.getenv('PROXY_EVICTION_TIME', proxy_config['eviction_time'])),
+        'health_check_interval': float(os.getenv('PROXY_HEALTH_CHECK_INTERVAL', proxy_config['health_check_interval'])),
+        'health_check_timeout': float(proxy_config['health_check_timeout'])
+    }
+
+def proxy_enabled():
+    """
+    Whether requests go through the SOCKS proxy (USE_PROXY=0 connects directly).
+    """
+    return os.getenv('USE_PROXY', str(NETWORK_CONFIG['proxy']['enabled'])).lower() not in ('0', 'false', 'no')
+
 def setup_proxy():
     """
-    Configure SOCKS proxy for all socket traffic.
+    Check the SOCKS proxy endpoints before a run.
+
+    The proxy is attached to the HTTP sessions of the lookup engines (see
+    get_http_session and create_async_http_session) rather than to every
+    socket of the process, and connections are spread over all endpoints
+    of PROXY_ENDPOINTS (see proxy_pool). Endpoints that fail the first
+    health check start out evicted.
+
+    Returns:
+        False if the proxy is enabled but no endpoint is reachable
     """
-    try:
-        proxy_host = os.getenv('PROXY_HOST', NETWORK_CONFIG['proxy']['host'])
-        proxy_port = int(os.getenv('PROXY_PORT', NETWORK_CONFIG['proxy']['port']))
-        
-        socks.set_default_proxy(socks.SOCKS5, proxy_host, proxy_port)
-        socket.socket = socks.socksocket
-        print(f"SOCKS5 proxy configured successfully ({proxy_host}:{proxy_port}).")
+    if not proxy_enabled():
+        print("SOCKS proxy disabled (USE_PROXY=0); connecting directly.")
         return True
-    except socks.ProxyError as e:
-        print(f"Error: Could not configure SOCKS proxy. Is the proxy server running? {e}")
+
+    from proxy_pool import get_proxy_pool
+    try:
+        pool = get_proxy_pool()
+    except ValueError as e:
+        print(f"Error: {e}")
+        return False
+    endpoints = ', '.join(str(endpoint) for endpoint in pool.endpoints)
+    available = pool.check_all()
+    if not available:
+        print(f"Error: Could not reach any SOCKS proxy ({endpoints}). Is the proxy server running?")
         return False
+    print(f"SOCKS5 proxy configured successfully ({available} of {len(pool.endpoints)} reachable: {endpoints}).")
+    return True
 
 def disable_ssl_warnings():
     """
@@ -72,9 +369,228 @@ def get_network_config():
     """
     return {
         'max_workers': int(os.getenv('MAX_WORKERS', NETWORK_CONFIG['max_workers'])),
-        'timeout': int(os.getenv('REQUEST_TIMEOUT', NETWORK_CONFIG['request_timeout']))
+        'timeout': int(os.getenv('REQUEST_TIMEOUT', NETWORK_CONFIG['request_timeout'])),
+        'engine': os.getenv('LOOKUP_ENGINE', NETWORK_CONFIG['engine']).lower(),
+        'processes': int(os.getenv('LOOKUP_PROCESSES', NETWORK_CONFIG['processes'])),
+        'async_concurrency': int(os.getenv('ASYNC_CONCURRENCY', NETWORK_CONFIG['async_concurrency'])),
+        'input_queue_size': int(os.getenv('INPUT_QUEUE_SIZE', NETWORK_CONFIG['input_queue_size'])),
+        'dedupe_input': os.getenv('DEDUPE_INPUT', str(NETWORK_CONFIG['dedupe_input'])).lower() not in ('0', 'false', 'no')
     }
 
+# Shared HTTP session, created lazily on first use
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """
+    Get the shared HTTP session used by all lookup scripts.
+    
+    The session keeps connections alive and pools them per host, with each
+    host pool holding as many connections as requests may be in flight to a
+    service (see get_concurrency_ceiling), so workers reuse already
+    established proxied TLS connections instead of handshaking again for
+    every ID, and never wait for a connection of the pool.
+    With the proxy enabled, requests are spread over the SOCKS endpoints of
+    the proxy pool, with a connection pool per endpoint and host.
+    
+    Returns:
+        requests.Session shared by every thread in the process
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                from proxy_pool import get_proxy_pool, ProxyPoolAdapter
+                pool_config = NETWORK_CONFIG['connection_pool']
+                pool_settings = {
+                    'pool_connections': pool_config['max_hosts'],
+                    'pool_maxsize': get_concurrency_ceiling(),
+                    'pool_block': pool_config['block']
+                }
+                proxy_pool = get_proxy_pool()
+                adapter = ProxyPoolAdapter(proxy_pool, **pool_settings) if proxy_pool else HTTPAdapter(**pool_settings)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update(get_headers())
+                session.verify = False
+                _http_session = session
+    return _http_session
+
+def reset_http_session():
+    """
+    Drop the shared HTTP session without closing its connections, so that a
+    forked process opens its own instead of sharing the parent's sockets.
+    """
+    global _http_session
+    _http_session = None
+
+def http_get(url, timeout=None):
+    """
+    Make a GET request through the shared, pooled HTTP session.
+    
+    Args:
+        url: Complete URL to request
+        timeout: Optional timeout in seconds (defaults to REQUEST_TIMEOUT)
+    
+    Returns:
+        requests.Response
+    """
+    if timeout is None:
+        timeout = get_network_config()['timeout']
+    return get_http_session().get(url, timeout=timeout)
+
+# JSON decoder, chosen on first use
+_json_loads = None
+
+def json_loads(data):
+    """
+    Decode JSON with the configured backend (orjson when available).
+    Invalid JSON raises json.JSONDecodeError with either backend.
+    """
+    global _json_loads
+    if _json_loads is None:
+        backend = get_parsing_config()['json_backend']
+        if backend == 'orjson' and orjson is None:
+            raise ImportError("JSON_BACKEND=orjson needs the orjson package. Install it with: pip install orjson")
+        _json_loads = orjson.loads if backend != 'json' and orjson is not None else json.loads
+    return _json_loads(data)
+
+class FetchResult(namedtuple('FetchResult', ['status_code', 'body', 'error', 'detail'])):
+    """
+    Outcome of a single lookup, independent of the HTTP client that made it.
+    
+    Fields:
+        status_code: HTTP status code, or None if no response was received
+        body: Raw response body as bytes
+        error: None, 'timeout', 'connection' or 'failed'
+        detail: Error message when error is set, or 'cached' for a response
+                served from the response cache
+    """
+    __slots__ = ()
+    
+    @property
+    def text(self):
+        return self.body.decode('utf-8', errors='replace')
+    
+    def json(self):
+        return json_loads(self.body)
+    
+    def field(self, path, default=None):
+        """
+        Get a single field of the JSON body by its dotted path (e.g. 'data.reconciliationState').
+        
+        The body is decoded with json_loads (orjson when installed), so
+        invalid JSON raises json.JSONDecodeError.
+        
+        Returns:
+            The field value, or default if it is missing
+        """
+        value = get_field(self.json(), path)
+        return default if value is None else value
+
+def is_retryable_response(response):
+    """
+    Check whether a FetchResult is a transient failure worth retrying:
+    timeouts, connection errors, HTTP 429 and HTTP 5xx, and requests not sent
+    because the service's circuit breaker was open.
+    """
+    if response.error:
+        return response.error in ('timeout', 'connection', 'circuit_open')
+    return response.status_code == 429 or response.status_code >= 500
+
+def fetch(url):
+    """
+    Make a GET request through the shared session and return a FetchResult.
+    Network errors are captured in the result instead of being raised.
+    """
+    try:
+        response = http_get(url)
+        return FetchResult(response.status_code, response.content, None, None)
+    except requests.exceptions.Timeout as e:
+        return FetchResult(None, b'', 'timeout', str(e))
+    except requests.exceptions.ConnectionError as e:
+        return FetchResult(None, b'', 'connection', str(e))
+    except Exception as e:
+        return FetchResult(None, b'', 'failed', str(e))
+
+def fetch_with_retry(url):
+    """
+    fetch() with retries for retryable failures, sleeping between attempts.
+    Bypasses the rate limits, circuit breakers and response cache; lookups
+    of the scripts go through lookup_engine (fetch_lookup, process_item).
+    """
+    retry_config = get_retry_config()
+    for attempt in range(retry_config['max_attempts']):
+        response = fetch(url)
+        if not is_retryable_response(response) or attempt + 1 == retry_config['max_attempts']:
+            return response
+        time.sleep(backoff_delay(attempt, retry_config))
+
+def create_async_http_session(concurrency):
+    """
+    Create an aiohttp session that connects through the SOCKS proxy pool,
+    spreading requests over its endpoints (or directly when the proxy is
+    disabled).
+    
+    Args:
+        concurrency: Maximum number of open connections
+    
+    Returns:
+        aiohttp.ClientSession, or ProxyPoolSession with the same get()
+        (must be used from a running event loop)
+    """
+    try:
+        import aiohttp
+        from aiohttp_socks import ProxyConnector
+    except ImportError as e:
+        raise ImportError(
+            "The async engine needs aiohttp and aiohttp-socks. "
+            "Install them with: pip install aiohttp aiohttp-socks"
+        ) from e
+    
+    def make_session(proxy_url=None):
+        if proxy_url:
+            connector = ProxyConnector.from_url(proxy_url.replace('socks5h://', 'socks5://'), rdns=True,
+                                                limit=concurrency, ssl=False)
+        else:
+            connector = aiohttp.TCPConnector(limit=concurrency, ssl=False)
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers=get_headers(),
+            timeout=aiohttp.ClientTimeout(total=get_network_config()['timeout'])
+        )
+
+    from proxy_pool import get_proxy_pool, ProxyPoolSession
+    proxy_pool = get_proxy_pool()
+    if proxy_pool:
+        return ProxyPoolSession(proxy_pool, make_session)
+    return make_session()
+
+async def fetch_async(session, url):
+    """
+    Async counterpart of fetch(), using an aiohttp session.
+    """
+    import aiohttp
+    from aiohttp_socks import ProxyError, ProxyConnectionError, ProxyTimeoutError
+    try:
+        async with session.get(url) as response:
+            body = await response.read()
+            return FetchResult(response.status, body, None, None)
+    except (asyncio.TimeoutError, ProxyTimeoutError) as e:
+        return FetchResult(None, b'', 'timeout', str(e) or 'Request timed out')
+    except (aiohttp.ClientConnectionError, ProxyConnectionError, ProxyError, OSError) as e:
+        return FetchResult(None, b'', 'connection', str(e))
+    except Exception as e:
+        return FetchResult(None, b'', 'failed', str(e))
+
+def get_api_base_url(service):
+    """
+    Get the base URL of a service, overridable with <SERVICE>_BASE_URL
+    (e.g. HERMES_BASE_URL=http://127.0.0.1:8001 to use a local mock).
+    """
+    return os.getenv(f"{service.upper()}_BASE_URL", API_BASE_URLS[service])
+
 def build_api_url(service, endpoint, event_type=None, query_params=None):
     """
     Build a complete API URL from components.
@@ -88,7 +604,7 @@ def build_api_url(service, endpoint, event_type=None, query_params=None):
     Returns:
         Complete URL string
     """
-    base_url = API_BASE_URLS[service]
+    base_url = get_api_base_url(service)
     endpoint_path = API_ENDPOINTS[service][endpoint]
     
     url = f"{base_url}{endpoint_path}"
@@ -101,6 +617,32 @@ def build_api_url(service, endpoint, event_type=None, query_params=None):
     
     return url
 
+def build_lookup_url(api_config, *ids):
+    """
+    Build the request URL for an entry of get_api_config() and one or more IDs.
+    
+    Args:
+        api_config: Entry of get_api_config() (e.g., get_api_config()['mandate_check'])
+        ids: Path segments identifying the record (e.g., merchant ID and transaction ID)
+    
+    Returns:
+        Complete URL string: base URL, the IDs separated by '/', then the endpoint suffix
+    """
+    return f"{api_config['base_url'].rstrip('/')}/{'/'.join(ids)}{api_config['endpoint_suffix']}"
+
+def get_field(data, path):
+    """
+    Get a nested field from parsed JSON by its dotted path (e.g., 'data.reconciliationState').
+    
+    Returns:
+        The field value, or None if any part of the path is missing
+    """
+    for key in path.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
 def ensure_output_dir():
     """
     Ensure the output directory exists.
@@ -133,8 +675,8 @@ def show_available_assets(file_extensions=None):
         
         file_path = os.path.join(assets_dir, file)
         if os.path.isfile(file_path):
-            # Filter by extensions if provided
-            if file_extensions is None or any(file.endswith(ext) for ext in file_extensions):
+            # Filter by extensions if provided (a compressed 'ids.txt.gz' counts as a .txt file)
+            if file_extensions is None or any(strip_compression(file).endswith(ext) for ext in file_extensions):
                 files.append(file)
                 print(f"  - {file}")
     
@@ -164,36 +706,418 @@ def get_asset_file_path(filename):
         # If just a filename, prepend assets directory
         return f"{DEFAULT_PATHS['assets_dir']}/{filename}"
 
+def get_compression(path):
+    """
+    The compression codec of a file from its extension ('gzip', 'zstd'), or None.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    return COMPRESSION_CODECS[extension]['codec'] if extension in COMPRESSION_CODECS else None
+
+def strip_compression(path):
+    """
+    The path without its compression extension ('ids.csv.gz' -> 'ids.csv').
+    """
+    root, extension = os.path.splitext(path)
+    return root if extension.lower() in COMPRESSION_CODECS else path
+
+class _ZstdReader(io.RawIOBase):
+    """
+    Streaming zstd decompression that can be rewound to the start (by
+    decompressing again), so InputItems can read a .zst input more than once.
+    """
+
+    def __init__(self, path, zstandard):
+        self._path = path
+        self._zstandard = zstandard
+        self._file = None
+        self._reader = None
+        self._rewind()
+
+    def _rewind(self):
+        if self._file:
+            self._reader.close()
+        self._file = open(self._path, 'rb')
+        # Files from pzstd and similar tools hold several frames
+        self._reader = self._zstandard.ZstdDecompressor().stream_reader(self._file, read_across_frames=True)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._reader.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("zstd streams can only seek from the start")
+        if offset < self._position:
+            self._rewind()
+        while self._position < offset:
+            skipped = len(self._reader.read(min(offset - self._position, 16 * 1024 * 1024)))
+            if not skipped:
+                break
+            self._position += skipped
+        return self._position
+
+    def close(self):
+        if self._file:
+            self._reader.close()
+            self._file = None
+        super().close()
+
+def open_file(path, mode='r', encoding='utf-8', newline=None, buffering=-1):
+    """
+    Open a file like open(), decompressing or compressing it on the fly when
+    its extension is .gz or .zst (see COMPRESSION_CODECS). Compressed files
+    are streamed, never decompressed to disk; they can be rewound (seek(0))
+    but not read by byte range.
+    
+    Args:
+        path: File path
+        mode: 'r', 'w', 'a', 'rb', 'wb' or 'ab'
+        encoding: Text encoding (text modes only)
+        newline: Newline handling (text modes only), as for open()
+        buffering: Buffer size for uncompressed files, as for open()
+    
+    Returns:
+        File object
+    """
+    codec = get_compression(path)
+    text = 'b' not in mode
+    if codec is None:
+        if text:
+            return open(path, mode, buffering=buffering, encoding=encoding, newline=newline)
+        return open(path, mode, buffering=buffering)
+
+    level = COMPRESSION_CODECS[os.path.splitext(path)[1].lower()]['level']
+    binary_mode = mode.replace('t', '').replace('b', '') + 'b'
+    if codec == 'gzip':
+        binary = gzip.open(path, binary_mode, compresslevel=level)
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f"Reading or writing '{path}' needs zstandard. Install it with: pip install zstandard") from None
+        if binary_mode == 'rb':
+            binary = io.BufferedReader(_ZstdReader(path, zstandard), buffer_size=1024 * 1024)
+        else:
+            binary = zstandard.ZstdCompressor(level=level).stream_writer(open(path, binary_mode), closefd=True)
+    if text:
+        return io.TextIOWrapper(binary, encoding=encoding, newline=newline)
+    return binary
+
+def iter_line_blocks(file, block_size):
+    """
+    Lazily read an open binary file (e.g. a decompressing stream) in blocks
+    of about `block_size` bytes, each ending at a line break.
+    
+    Yields:
+        Blocks of whole lines as bytes
+    """
+    while True:
+        block = file.read(block_size)
+        if not block:
+            return
+        if not block.endswith(b'\n'):
+            block += file.readline()
+        yield block
+
+def iter_ids(file):
+    """
+    Lazily yield IDs from an open text file, one per line.
+    
+    Args:
+        file: Open text file object
+    
+    Yields:
+        Each stripped, non-empty line
+    """
+    for line in file:
+        line = line.strip()
+        if line:
+            yield line
+
+def get_byte_ranges(file_path, start, range_size):
+    """
+    Split a file from offset `start` to its end into byte ranges of about
+    `range_size` bytes (see read_line_range for turning them into whole lines).
+    
+    Returns:
+        List of (start, end) offsets
+    """
+    size = os.path.getsize(file_path)
+    return [(offset, min(offset + range_size, size)) for offset in range(start, size, range_size)]
+
+def next_line_start(file, offset, data_start=0):
+    """
+    Find the start of the first line that begins at or after `offset` in an open binary file.
+    
+    Returns:
+        The offset, with the file positioned there
+    """
+    if offset > data_start:
+        file.seek(offset - 1)
+        file.readline()
+    else:
+        file.seek(data_start)
+    return file.tell()
+
+def read_line_range(file, start, end, data_start=0):
+    """
+    Read the whole lines that start within [start, end) of an open binary file.
+    
+    A line crossing `end` is read to its end, and a line crossing `start`
+    is left to the previous range, so consecutive ranges yield every line
+    exactly once. Assumes no line breaks inside quoted CSV values.
+    
+    Args:
+        file: File opened in binary mode
+        start: First byte of the range
+        end: First byte after the range
+        data_start: Offset of the first line that may be returned (e.g. after the header)
+    
+    Returns:
+        The lines as bytes, each ending with a line break (except possibly the file's last)
+    """
+    position = next_line_start(file, start, data_start)
+    if position >= end:
+        return b''
+    block = file.read(end - position)
+    if block and not block.endswith(b'\n'):
+        block += file.readline()
+    return block
+
+def copy_byte_range(source, destination, start, end, buffer_size=16 * 1024 * 1024):
+    """
+    Append bytes [start, end) of an open binary file to another one, in the
+    kernel (copy_file_range) where supported and through large buffers otherwise.
+    """
+    destination.flush()
+    position = start
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while position < end:
+                copied = os.copy_file_range(source.fileno(), destination.fileno(), end - position, position)
+                if not copied:
+                    break
+                position += copied
+            destination.seek(0, os.SEEK_END)
+            if position >= end:
+                return
+        except OSError:
+            # Not supported for these files (e.g. across file systems on older kernels)
+            destination.seek(0, os.SEEK_END)
+    source.seek(position)
+    while position < end:
+        data = source.read(min(buffer_size, end - position))
+        if not data:
+            break
+        destination.write(data)
+        position += len(data)
+
+class InputItems:
+    """
+    Re-iterable items parsed from an open input file.
+    
+    Every iteration rewinds the file and parses it again, so the input can
+    be read more than once (e.g. to find duplicate IDs before processing)
+    without holding it in memory.
+    
+    Usage:
+        InputItems(f)                   # IDs, one per line
+        InputItems(f, csv.DictReader)   # CSV rows
+    """
+
+    def __init__(self, file, parse=iter_ids):
+        self.file = file
+        self.parse = parse
+
+    def __iter__(self):
+        self.file.seek(0)
+        return iter(self.parse(self.file))
+
+def id_hash(value):
+    """
+    Stable 64-bit hash of an ID string (the same in every process and on every host).
+    """
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def get_shard(value, shard_count):
+    """
+    Stable shard number (0 to shard_count - 1) of a key such as a merchant ID,
+    the same in every process and on every host.
+    """
+    return id_hash(value) % shard_count
+
+class CompactIdSet:
+    """
+    Read-only set of ID hashes using about 8 bytes per ID.
+    
+    Hashes are kept in sorted arrays bucketed by their top bits, so tens of
+    millions of IDs fit in a few hundred MB instead of several GB of Python
+    strings or ints.
+    
+    Usage:
+        done = CompactIdSet(id_hash(i) for i in ids)
+        done.contains_id('TXN123')
+    """
+    _BUCKET_BITS = 12
+    _SHIFT = 64 - _BUCKET_BITS
+
+    def __init__(self, hashes=()):
+        buckets = [array('Q') for _ in range(1 << self._BUCKET_BITS)]
+        for value_hash in hashes:
+            buckets[value_hash >> self._SHIFT].append(value_hash)
+        self._buckets = [array('Q', sorted(bucket)) for bucket in buckets]
+        self._size = sum(len(bucket) for bucket in self._buckets)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, value_hash):
+        bucket = self._buckets[value_hash >> self._SHIFT]
+        index = bisect_left(bucket, value_hash)
+        return index < len(bucket) and bucket[index] == value_hash
+
+    def contains_id(self, value):
+        return id_hash(value) in self
+
+    def repeated(self):
+        """
+        Count the hashes that were added more than once.
+
+        Returns:
+            RepeatedIdCounts
+        """
+        return RepeatedIdCounts(self._buckets, self._SHIFT)
+
+class RepeatedIdCounts:
+    """
+    Number of occurrences of every ID hash added more than once to a
+    CompactIdSet, with a "dispatched" flag per hash.
+    
+    Like CompactIdSet, hashes are kept in sorted arrays bucketed by their
+    top bits, with the counts in an aligned array and the flags in a
+    bitmap, so each repeated ID takes about 12 bytes instead of a Python
+    dict or set entry.
+    
+    Usage:
+        repeated = ids.repeated()
+        repeated.count(id_hash('TXN123'))      # 1 if the ID is not repeated
+        repeated.dispatch(id_hash('TXN123'))   # True the first time only
+    """
+
+    def __init__(self, buckets, shift):
+        self._shift = shift
+        self._hashes = []
+        self._counts = []
+        self._flags = []
+        self.lines = 0
+        for bucket in buckets:
+            hashes = array('Q')
+            counts = array('I')
+            if len(set(bucket)) != len(bucket):
+                for value_hash, count in sorted(Counter(bucket).items()):
+                    if count > 1:
+                        hashes.append(value_hash)
+                        counts.append(count)
+            self._hashes.append(hashes)
+            self._counts.append(counts)
+            self._flags.append(bytearray((len(hashes) + 7) // 8))
+            self.lines += sum(counts)
+        self._size = sum(len(hashes) for hashes in self._hashes)
+
+    def __len__(self):
+        return self._size
+
+    def _find(self, value_hash):
+        bucket = value_hash >> self._shift
+        hashes = self._hashes[bucket]
+        index = bisect_left(hashes, value_hash)
+        if index < len(hashes) and hashes[index] == value_hash:
+            return bucket, index
+        return None, None
+
+    def count(self, value_hash):
+        """
+        Returns:
+            Number of times the hash was added (1 if it is not repeated)
+        """
+        bucket, index = self._find(value_hash)
+        return 1 if bucket is None else self._counts[bucket][index]
+
+    def dispatch(self, value_hash):
+        """
+        Flag a hash as dispatched.
+
+        Returns:
+            False if the hash is repeated and was already flagged, True otherwise
+        """
+        bucket, index = self._find(value_hash)
+        if bucket is None:
+            return True
+        flags = self._flags[bucket]
+        bit = 1 << (index & 7)
+        if flags[index >> 3] & bit:
+            return False
+        flags[index >> 3] |= bit
+        return True
+
+    def reset(self):
+        """
+        Clear every dispatched flag.
+        """
+        for flags in self._flags:
+            flags[:] = bytes(len(flags))
+
 def get_api_config():
     """
     Get the API configuration dictionary for backward compatibility.
     """
     return {
         "ro": {
+            "service": "refund_orchestrator",
             "base_url": build_api_url('refund_orchestrator', 'accounting_events'),
             "endpoint_suffix": EVENT_TYPES['merchant_fulfilment_reversal']
         },
         "hermes": {
+            "service": "hermes",
             "base_url": build_api_url('hermes', 'accounting_event_details'),
             "endpoint_suffix": EVENT_TYPES['merchant_fulfilment_reversal']
         },
         "mandate_check": {
+            "service": "hermes",
             "base_url": build_api_url('hermes', 'accounting_event_details'),
             "endpoint_suffix": EVENT_TYPES['merchant_mandate_registration']
         },
         "payments_debug": {
+            "service": "payment_service",
             "base_url": build_api_url('payment_service', 'housekeeping_debug'),
             "endpoint_suffix": QUERY_PARAMS['already_reversed_fetch_limit']
         },
         "hermes_status_check": {
+            "service": "hermes",
             "base_url": build_api_url('hermes', 'db_status_check'),
             "endpoint_suffix": ""
         },
         "refunds_housekeeping": {
+            "service": "hermes",
             "base_url": build_api_url('hermes', 'refunds_housekeeping'),
             "endpoint_suffix": ""
         },
         "payment_service_debug": {
+            "service": "payment_service",
             "base_url": build_api_url('payment_service', 'housekeeping_debug_with_id'),
             "endpoint_suffix": "?alreadyReversedFetchLimit=1000"
         }